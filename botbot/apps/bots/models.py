@@ -83,7 +83,10 @@ class ChatBot(models.Model):
             server = self.server.split(':')[0]
             self.slug = pretty_slug(server)
 
-        return super(ChatBot, self).save(*args, **kwargs)
+        super(ChatBot, self).save(*args, **kwargs)
+        # The plugin runners reload the bot (e.g. once activated) along
+        # with its channels
+        plugins_models.notify_chatbot_changed(self.pk)
 
     @classmethod
     def allocate_bot(cls, slug):
@@ -192,12 +195,26 @@ class Channel(TimeStampedModel):
     def plugin_config_cache_key(self, slug):
         return 'channel:{0}:{1}:config'.format(self.name, slug)
 
+    @property
+    def _prefetched_active_plugins(self):
+        """
+        The active plugins, if they were loaded with
+        ``prefetch_related('activeplugin_set__plugin')``, otherwise None
+        """
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if 'activeplugin_set' in prefetched:
+            return prefetched['activeplugin_set']
+        return None
+
     @property
     def active_plugin_slugs(self):
         """A cached set of the active plugins for the channel"""
+        prefetched = self._prefetched_active_plugins
+        if prefetched is not None:
+            return set(actv.plugin.slug for actv in prefetched)
         cache_key = self.active_plugin_slugs_cache_key
         cached_plugins = cache.get(cache_key)
-        if not cached_plugins:
+        if cached_plugins is None:
             plugins = self.activeplugin_set.all().select_related('plugin')
             slug_set = set([actv.plugin.slug for actv in plugins])
             cache.set(cache_key, slug_set)
@@ -206,9 +223,15 @@ class Channel(TimeStampedModel):
 
     def plugin_config(self, plugin_slug):
         """A cached configuration for an active plugin"""
+        prefetched = self._prefetched_active_plugins
+        if prefetched is not None:
+            for actv in prefetched:
+                if actv.plugin.slug == plugin_slug:
+                    return actv.configuration
+            return {}
         cache_key = self.plugin_config_cache_key(plugin_slug)
         cached_config = cache.get(cache_key)
-        if not cached_config:
+        if cached_config is None:
             try:
                 active_plugin = self.activeplugin_set.get(
                     plugin__slug=plugin_slug)
@@ -318,6 +341,7 @@ class Channel(TimeStampedModel):
         self.fingerprint = uuid.uuid4()
 
         super(Channel, self).save(*args, **kwargs)
+        plugins_models.notify_channel_changed(self.pk, self.fingerprint)
 
 
 class UserCount(models.Model):
@@ -18,7 +18,8 @@
 
 """ This script provides a command to import chatlogs in plain text format
 output from MBChatLogger to a BotBot database. It also has some basic support
-for detecting and removing duplicate messages on import.
+for detecting duplicate messages on import: files can be imported again, and
+messages the bot logged itself are skipped.
 """
 
 from django.core.management.base import BaseCommand, CommandError
@@ -27,10 +28,14 @@ from django.db import transaction, reset_queries
 from botbot.apps.logs.models import Log
 from botbot.apps.bots.models import ChatBot, Channel
 
+import collections
 import re
 import os
 import datetime
 
+# Imported messages are timestamped to the second
+DUPLICATE_WINDOW = datetime.timedelta(seconds=3)
+
 
 def _get_channel(channel_name):
     "Attempts to locate a channel with the given name in the BotBot database."
@@ -49,18 +54,25 @@ def _path(directory, filenames):
         yield os.path.join(directory, f)
 
 
-def _get_existing_entries(parsed_log, timestamp, nick, channel):
-    """ Gets entries within 1 second of the parsed log information, to avoid
-    creating duplicate entries when timestamps differ slightly.
+def _get_existing_entries(channel, date):
+    """ Gets the timestamps of the entries of a day, per nick and text, to
+    avoid creating duplicate entries when timestamps differ slightly.
     """
 
-    dt1 = datetime.timedelta(seconds=3)
-    earliest = timestamp - dt1
-    latest = timestamp + dt1
-    return Log.objects.filter(
-        channel=channel, timestamp__gte=earliest, timestamp__lte=latest,
-        nick=nick, text=parsed_log['text']
-    ).all()
+    start = datetime.datetime.strptime(date, "%Y-%m-%d").replace(
+        tzinfo=datetime.timezone.utc)
+    existing = collections.defaultdict(list)
+    for timestamp, nick, text in Log.objects.filter(
+        channel=channel, timestamp__gte=start - DUPLICATE_WINDOW,
+        timestamp__lte=start + datetime.timedelta(days=1) + DUPLICATE_WINDOW
+    ).values_list('timestamp', 'nick', 'text'):
+        existing[(nick, text)].append(timestamp)
+    return existing
+
+
+def _is_duplicate(existing, timestamp, nick, text):
+    return any(abs(other - timestamp) <= DUPLICATE_WINDOW
+               for other in existing.get((nick, text), ()))
 
 
 class Command(BaseCommand):
@@ -112,10 +124,20 @@ class Command(BaseCommand):
     def _import_file(self, path):
         print("Importing {}".format(path))
         date = os.path.splitext(os.path.basename(path))[0]
-        with open(path, 'r') as f:
+        existing = _get_existing_entries(self.channel, date)
+        entries = []
+        with open(path, 'r', encoding='utf8', errors='replace') as f:
             for line in f:
-                line = line.decode('utf8', errors='replace')
-                self._import_line(date, line)
+                entry = self._import_line(date, line)
+                if entry is None:
+                    continue
+                # As stored, to compare it with the logged entries
+                entry.redact()
+                if not _is_duplicate(existing, entry.timestamp, entry.nick,
+                                     entry.text):
+                    entries.append(entry)
+        # Entries of an earlier import of the file are skipped
+        Log.objects.ingest(entries, batch_size=1000)
 
     def _import_line(self, date, line):
         date_match = self.date_regex.match(line)
@@ -131,34 +153,19 @@ class Command(BaseCommand):
 
         msg_time = date_match.groups()[0]
         user = user_match.groups()[0]
-        timestamp = datetime.datetime.strptime(date + 'T' + msg_time,
-                                               "%Y-%m-%dT%H:%M:%S")
+        timestamp = datetime.datetime.strptime(
+            date + 'T' + msg_time, "%Y-%m-%dT%H:%M:%S").replace(
+                tzinfo=datetime.timezone.utc)
 
         result = self._parse_message(user, content)
 
         if result is not None:
-            existing_entries = _get_existing_entries(result, timestamp, user,
-                                                     self.channel)
-            if len(existing_entries) > 1:
-                # Delete the duplicate with the least precise timestamp
-                most_precise = [entry for entry in existing_entries
-                                if entry.timestamp.microsecond]
-                if most_precise:
-                    for entry in existing_entries:
-                        if entry not in most_precise:
-                            entry.delete()
-                    existing_entries = most_precise
-            elif existing_entries:
-                for key, value in result.items():
-                    setattr(existing_entries[0], key, value)
-            else:
-                result.update({
-                    'bot': self.bot, 'channel': self.channel,
-                    'timestamp': timestamp, 'nick': user
-                })
-                existing_entries = [Log(**result)]
-
-            existing_entries[0].save()
+            result.update({
+                'bot': self.bot, 'channel': self.channel,
+                'timestamp': timestamp, 'nick': user
+            })
+            return Log(**result)
+        return None
 
     def _parse_message(self, nick, content):
         if content.startswith("{} has joined {}".format(nick,
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.4 on 2026-10-18 05:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The unique index is built concurrently, so that the log table stays
+    # writable meanwhile, which can't happen in a transaction
+    atomic = False
+
+    dependencies = [
+        ("logs", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="log",
+            name="ingestion_key",
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "
+                    "logs_log_ingestion_key_uniq ON logs_log (ingestion_key)",
+                    reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS "
+                    "logs_log_ingestion_key_uniq",
+                ),
+                migrations.RunSQL(
+                    "ALTER TABLE logs_log ADD CONSTRAINT "
+                    "logs_log_ingestion_key_uniq UNIQUE USING INDEX "
+                    "logs_log_ingestion_key_uniq",
+                    reverse_sql="ALTER TABLE logs_log DROP CONSTRAINT IF EXISTS "
+                    "logs_log_ingestion_key_uniq",
+                ),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name="log",
+                    name="ingestion_key",
+                    field=models.UUIDField(editable=False, null=True,
+                                           unique=True),
+                ),
+            ],
+        ),
+    ]
@@ -1,5 +1,9 @@
+import datetime
+import uuid
+
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from django.template.loader import render_to_string
 from django.urls import reverse
 from django.contrib.postgres.search import SearchVectorField
@@ -7,6 +11,8 @@ from botbot.apps.bots.utils import channel_url_kwargs
 
 
 REDACTED_TEXT = '[redacted]'
+# Namespace of the ingestion keys, see Log.make_ingestion_key
+INGESTION_NAMESPACE = uuid.UUID('5f6b1c0e-3f4a-4d8e-9a57-0c2a1e6d4b93')
 
 MSG_TMPL = {
         "JOIN": "{nick} joined the channel",
@@ -18,6 +24,22 @@ MSG_TMPL = {
         }
 
 
+class LogManager(models.Manager):
+
+    def ingest(self, logs, batch_size=None):
+        """
+        Inserts new rows, skipping those that are already in, e.g. lines
+        delivered again after a crash of the plugin runner or imported
+        twice. Their primary keys aren't set.
+        """
+        for log in logs:
+            log.redact()
+            if log.ingestion_key is None:
+                log.ingestion_key = log.make_ingestion_key()
+        return self.bulk_create(logs, batch_size=batch_size,
+                                ignore_conflicts=True)
+
+
 class Log(models.Model):
     bot = models.ForeignKey('bots.ChatBot', null=True, on_delete=models.CASCADE)
     channel = models.ForeignKey('bots.Channel', null=True, on_delete=models.CASCADE)
@@ -35,6 +57,10 @@ class Log(models.Model):
     room = models.CharField(max_length=100, null=True, blank=True)
 
     search_index = SearchVectorField(null=True)
+    # Identifies a line whichever way it arrives, older rows have none
+    ingestion_key = models.UUIDField(null=True, unique=True, editable=False)
+
+    objects = LogManager()
 
     class Meta:
         ordering = ('-timestamp',)
@@ -76,7 +102,28 @@ class Log(models.Model):
 
         return text
 
-    def save(self, *args, **kwargs):
+    def make_ingestion_key(self):
+        """
+        A hash of the channel (and with it the chatbot), the time the line
+        was received, the nick, the command and the raw line, or the text
+        if there is no raw line
+        """
+        timestamp = self.timestamp
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp)
+        return uuid.uuid5(INGESTION_NAMESPACE, '\n'.join([
+            str(self.channel_id),
+            timestamp.astimezone(datetime.timezone.utc).isoformat(),
+            self.nick,
+            self.command or '',
+            self.raw or self.text,
+        ]))
+
+    def redact(self):
+        """Hides the text of the nicks excluded from the logs"""
         if self.nick in settings.EXCLUDE_NICKS:
             self.text = REDACTED_TEXT
+
+    def save(self, *args, **kwargs):
+        self.redact()
         return super(Log, self).save(*args, **kwargs)
@@ -0,0 +1,106 @@
+"""
+Cooperative I/O for the gevent runner (``run_plugins --with-gevent``).
+
+The standard library is monkey-patched and psycopg2 waits through the
+gevent hub, so a plugin call waiting on the network or on the database
+lets the other calls run. ``patch()`` has to run before anything else
+imports socket or threading, see ``manage.py``.
+
+Only imported with ``--with-gevent``.
+"""
+import logging
+import time
+import uuid
+
+import gevent
+import psycopg2.extensions
+from gevent import monkey
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+
+def patch():
+    """Monkey-patches the standard library and makes psycopg2 green"""
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def is_patched():
+    return (monkey.is_module_patched('socket') and
+            monkey.is_module_patched('time') and
+            psycopg2.extensions.get_wait_callback() is not None)
+
+
+def sleep_probe(seconds):
+    time.sleep(seconds)
+
+
+def redis_probe(bus):
+    def probe(seconds):
+        # Nobody pushes to that key, BLPOP waits for the whole timeout
+        bus.blpop('cooperative-check:{0}'.format(uuid.uuid4().hex), seconds)
+    return probe
+
+
+def database_probe(seconds):
+    from django.db import connection
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_sleep(%s)', [seconds])
+    finally:
+        # Every greenlet has a connection of its own
+        connection.close()
+
+
+def probes(bus):
+    """The kinds of blocking calls plugins make, as (name, probe)"""
+    from django.db import connection
+    yield 'sleep', sleep_probe
+    yield 'redis', redis_probe(bus)
+    if connection.vendor == 'postgresql':
+        yield 'database', database_probe
+
+
+def measure(probe, calls, seconds):
+    """
+    Runs ``calls`` probes of ``seconds`` at once, returns the seconds they
+    took added up and the seconds they took together
+    """
+    durations = []
+
+    def call():
+        start = time.perf_counter()
+        probe(seconds)
+        durations.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    gevent.joinall([gevent.spawn(call) for _ in range(calls)],
+                   raise_error=True)
+    return sum(durations), time.perf_counter() - start
+
+
+def check(bus, calls=2, seconds=0.05):
+    """
+    Logs an error for each kind of blocking call that holds up the
+    others. Returns (total seconds, wall seconds) per kind of call.
+    """
+    if not is_patched():
+        LOG.error('gevent is not patched in, plugin calls waiting on I/O '
+                  'will block each other. Start the runner with manage.py')
+    results = {}
+    for name, probe in probes(bus):
+        try:
+            results[name] = total, wall = measure(probe, calls, seconds)
+        except Exception:
+            LOG.error('Cooperative check of %s calls failed', name,
+                      exc_info=True)
+            continue
+        # Calls that overlap take about as long as one of them
+        if wall > total * 0.75:
+            LOG.error('%s calls block the gevent hub: %s calls of %ss '
+                      'took %.2fs', name, calls, seconds, wall)
+        else:
+            LOG.info('%s calls are cooperative: %s calls of %ss took %.2fs',
+                     name, calls, seconds, wall)
+    return results
@@ -1,4 +1,6 @@
+import functools
 import re
+import time
 
 from botbot.apps.logs.models import Log
 from botbot_plugins.base import BasePlugin
@@ -16,7 +18,59 @@ class Config(config.BaseConfig):
     )
 
 
-def should_ignore_text(text, ignore_prefixes):
+def normalize_prefixes(ignore_prefixes):
+    """The ignore_prefixes setting as a tuple, it may be a single prefix"""
+    if not ignore_prefixes:
+        return ()
+    if not isinstance(ignore_prefixes, list):
+        return (ignore_prefixes,)
+    return tuple(ignore_prefixes)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_prefixes(ignore_prefixes):
+    """
+    Returns the patterns matching the start of the texts to ignore: one
+    alternation of all the prefixes, except for those with groups, which
+    the alternation would renumber. Returns None if a prefix isn't a valid
+    regular expression.
+    """
+    try:
+        patterns = [re.compile(prefix, re.IGNORECASE)
+                    for prefix in ignore_prefixes if prefix]
+    except (re.error, TypeError):
+        return None
+    simple = [pattern for pattern in patterns if not pattern.groups]
+    if len(simple) > 1:
+        try:
+            simple = [re.compile('|'.join(
+                '(?:{0})'.format(pattern.pattern) for pattern in simple),
+                re.IGNORECASE)]
+        except re.error:
+            # e.g. inline flags, only allowed at the start of a pattern
+            pass
+    return tuple(simple) + tuple(pattern for pattern in patterns
+                                 if pattern.groups)
+
+
+def matcher(ignore_prefixes):
+    """Returns a function telling whether a text is to be ignored"""
+    ignore_prefixes = normalize_prefixes(ignore_prefixes)
+    try:
+        patterns = compile_prefixes(ignore_prefixes)
+    except TypeError:
+        # Unhashable prefixes
+        patterns = None
+    if patterns is None:
+        # Fails like it always did, on the lines that get to a bad prefix
+        return functools.partial(_match_each, ignore_prefixes)
+    if len(patterns) == 1:
+        return lambda text: patterns[0].match(text) is not None
+    return lambda text: any(pattern.match(text) is not None
+                            for pattern in patterns)
+
+
+def _match_each(ignore_prefixes, text):
     return any(
         (
             prefix and
@@ -26,6 +80,10 @@ def should_ignore_text(text, ignore_prefixes):
     )
 
 
+def should_ignore_text(text, ignore_prefixes):
+    return matcher(ignore_prefixes)(text)
+
+
 class Plugin(BasePlugin):
     """
     Logs all activity.
@@ -34,27 +92,28 @@ class Plugin(BasePlugin):
     You can read and search them at {{ SITE }}{{ channel.get_absolute_url }}.
     """
     config_class = Config
+    # Set up from the configuration by initialize()
+    should_ignore = None
+
+    def initialize(self):
+        # Channel plugins are set up again when their configuration changes
+        self.should_ignore = matcher(self.config['ignore_prefixes'])
 
     def logit(self, line):
         """Log a message to the database"""
         # If the channel does not start with "#" that means the message
         # is part of a /query
         if line._channel_name.startswith("#"):
-            ignore_prefixes = self.config['ignore_prefixes']
-
-            if ignore_prefixes:
-                if not isinstance(ignore_prefixes, list):
-                    ignore_prefixes = [ignore_prefixes]
-            else:
-                ignore_prefixes = []
+            if self.should_ignore is None:
+                self.initialize()
 
             # Delete ACTION prefix created by /me
             text = line.text
             if text.startswith("ACTION "):
                 text = text[7:]
 
-            if not should_ignore_text(text, ignore_prefixes):
-                Log.objects.create(
+            if not self.should_ignore(text):
+                log = Log(
                     channel_id=line._channel.pk,
                     timestamp=line._received,
                     nick=line.user,
@@ -63,5 +122,16 @@ class Plugin(BasePlugin):
                     host=line._host,
                     command=line._command,
                     raw=line._raw)
+                # Written in batches by the plugin runner, if it buffers
+                buffer = getattr(self.app, 'log_buffer', None)
+                if buffer is not None:
+                    buffer.add(log)
+                else:
+                    start = time.perf_counter()
+                    Log.objects.ingest([log])
+                    # Stage timings of the plugin runner, if it keeps them
+                    timings = getattr(line, '_timings', None)
+                    if timings is not None:
+                        timings.add('db', time.perf_counter() - start)
 
     logit.route_rule = ('firehose', r'(.*)')
@@ -0,0 +1,55 @@
+"""
+Priority lanes for plugin calls under gevent.
+
+Only imported with ``--with-gevent``.
+"""
+import gevent
+import gevent.pool
+import gevent.queue
+
+
+class Lane(object):
+    """
+    A pool of ``size`` greenlets for one priority of plugin calls.
+
+    Calls wait in a backlog of up to ``backlog`` calls for a free greenlet,
+    so a busy lane doesn't hold back the queue consumer (and with it the
+    other lanes) until its backlog is full.
+    """
+
+    def __init__(self, name, size, backlog):
+        self.name = name
+        self.pool = gevent.pool.Pool(size)
+        self.backlog = gevent.queue.JoinableQueue(max(1, backlog))
+        self.feeder = gevent.spawn(self.feed)
+
+    def spawn(self, callback, func, *args):
+        """
+        Queues ``func(*args)``, ``callback``, if any, gets the greenlet
+        once it has returned a value. Blocks while the backlog is full.
+        """
+        self.backlog.put((callback, func, args))
+
+    def feed(self):
+        while True:
+            callback, func, args = self.backlog.get()
+            try:
+                # Blocks until a greenlet of the pool is free
+                greenlet = self.pool.spawn(func, *args)
+                if callback is not None:
+                    greenlet.link_value(callback)
+            finally:
+                self.backlog.task_done()
+
+    def join(self):
+        """Waits for the queued and running calls to finish"""
+        self.backlog.join()
+        self.pool.join()
+
+    @property
+    def queued(self):
+        return self.backlog.qsize()
+
+    @property
+    def running(self):
+        return len(self.pool)
@@ -0,0 +1,102 @@
+"""
+How long lines take from the bot receiving them to the plugin runner being
+done with them, per stage and per channel.
+"""
+import collections
+import logging
+import threading
+import time
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+
+class LineTimings(object):
+    """
+    Stage timings of a line. The line is done once every call holding it
+    (its dispatch, then its plugin calls) has released it.
+    """
+    __slots__ = ('tracker', 'key', 'received', 'stages', 'pending',
+                 'finished', 'lock')
+
+    def __init__(self, tracker, received):
+        self.tracker = tracker
+        # (chatbot id, channel name), once resolved
+        self.key = None
+        # When the bot received the line, as a UNIX timestamp
+        self.received = received
+        self.stages = []
+        self.pending = 0
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        self.stages.append((stage, seconds))
+
+    def hold(self):
+        with self.lock:
+            self.pending += 1
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+            # Calls deferred by load shedding may come after the end
+            done = not self.pending and not self.finished
+            if done:
+                self.finished = True
+        if done and self.key is not None:
+            self.tracker.record(self)
+
+    def breakdown(self):
+        return ', '.join('{0}={1:.3f}s'.format(stage, seconds)
+                         for stage, seconds in self.stages)
+
+
+class LatencyTracker(object):
+    """
+    Keeps the latency (from the bot's Received timestamp to the end of the
+    last plugin call) of the last ``window`` lines of every channel, and
+    logs the breakdown of the lines slower than ``slow_threshold`` seconds
+    """
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, window=1000, slow_threshold=0, clock=time.time):
+        self.window = window
+        self.slow_threshold = slow_threshold
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.latencies = {}
+        # Seconds spent per stage, by all the lines so far
+        self.stages = collections.Counter()
+
+    def start(self, received):
+        return LineTimings(self, received)
+
+    def record(self, timings):
+        latency = self.clock() - timings.received
+        with self.lock:
+            latencies = self.latencies.get(timings.key)
+            if latencies is None:
+                latencies = self.latencies[timings.key] = collections.deque(
+                    maxlen=self.window)
+            latencies.append(latency)
+            for stage, seconds in timings.stages:
+                self.stages[stage] += seconds
+        if self.slow_threshold and latency >= self.slow_threshold:
+            LOG.warning('Slow line on %s (chatbot %s): %.3fs, %s',
+                        timings.key[1], timings.key[0], latency,
+                        timings.breakdown())
+
+    def add_stage(self, stage, seconds):
+        """Time spent on no line in particular, e.g. writing a batch"""
+        with self.lock:
+            self.stages[stage] += seconds
+
+    def percentiles(self):
+        """Returns {quantile: seconds} per (chatbot id, channel name)"""
+        with self.lock:
+            snapshot = [(key, sorted(latencies))
+                        for key, latencies in self.latencies.items()]
+        return {key: {q: latencies[min(len(latencies) - 1,
+                                       int(q * len(latencies)))]
+                      for q in self.quantiles}
+                for key, latencies in snapshot if latencies}
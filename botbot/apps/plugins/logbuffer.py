@@ -0,0 +1,140 @@
+"""
+Log rows of the logger plugin written in batches, rather than with an
+INSERT and a commit per line (``run_plugins --log-batch-size``).
+"""
+import logging
+import threading
+import time
+
+from django.db import DataError, IntegrityError, transaction
+
+from botbot.apps.logs.models import Log
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+
+class LogBuffer(object):
+    """
+    Rows of all the channels, written with a single INSERT once there are
+    ``max_rows`` of them, or by ``tick()`` once the oldest has waited
+    ``max_delay`` seconds. Rows that are already in are skipped, so a batch
+    can be written again.
+
+    Batches are written one at a time, in the order their rows were added,
+    so the rows of a channel keep their order. Rows the database refuses
+    are dropped, the others are written one by one. The rows of a batch
+    that fails otherwise, e.g. while the database is down, are put back to
+    be written with the next one, keeping at most ``max_pending`` rows.
+    """
+
+    def __init__(self, max_rows=500, max_delay=0.2, max_pending=50000,
+                 record_time=None, clock=time.monotonic):
+        self.max_rows = max(1, max_rows)
+        self.max_delay = max_delay
+        self.max_pending = max(max_pending, self.max_rows)
+        # Called with ('db', seconds) for every write, if set
+        self.record_time = record_time
+        self.clock = clock
+        self.rows = []
+        # When the oldest of the rows was added
+        self.since = None
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        # Totals, for the metrics. Rows skipped by the database as already
+        # stored count as flushed, the INSERT doesn't tell them apart.
+        self.flushed = 0
+        self.dropped = 0
+        # Rows added so far, and how many of the first of them are written
+        # or dropped, see settled_upto()
+        self.added = 0
+        self.settled = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, log):
+        """Buffers an unsaved Log, writes the batch once it is full"""
+        with self.lock:
+            if not self.rows:
+                self.since = self.clock()
+            self.rows.append(log)
+            self.added += 1
+            full = len(self.rows) >= self.max_rows
+        if full:
+            self.flush()
+
+    def settled_upto(self, mark):
+        """
+        Tells whether the first ``mark`` rows added (``added`` as of some
+        time) are written or dropped
+        """
+        return self.settled >= mark
+
+    def tick(self):
+        """Writes the rows if the oldest has waited long enough"""
+        if self.rows and self.clock() - self.since >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows, returns how many were sent to the
+        database, those it skipped as already stored included
+        """
+        with self.write_lock:
+            with self.lock:
+                rows, self.rows = self.rows, []
+            if not rows:
+                return 0
+            count = len(rows)
+            start = time.perf_counter()
+            try:
+                try:
+                    written = self.write(rows)
+                except (DataError, IntegrityError):
+                    written = self.write_each(rows)
+            except Exception:
+                LOG.error('Writing %s log rows failed', len(rows),
+                          exc_info=True)
+                # write_each() takes off the rows it's done with
+                self.settled += count - len(rows)
+                self.put_back(rows)
+                return 0
+            finally:
+                if self.record_time is not None:
+                    self.record_time('db', time.perf_counter() - start)
+            self.flushed += written
+            self.settled += count
+            return written
+
+    def write(self, rows):
+        with transaction.atomic():
+            Log.objects.ingest(rows)
+        return len(rows)
+
+    def write_each(self, rows):
+        """Writes the rows one by one, taking them off ``rows``"""
+        written = 0
+        while rows:
+            try:
+                written += self.write(rows[:1])
+            except (DataError, IntegrityError):
+                LOG.error('Dropped a log row of %s on %s', rows[0].nick,
+                          rows[0].room, exc_info=True)
+                self.dropped += 1
+            del rows[0]
+        return written
+
+    def put_back(self, rows):
+        """Puts failed rows ahead of the ones added since"""
+        with self.lock:
+            if not self.rows:
+                self.since = self.clock()
+            self.rows[:0] = rows
+            excess = len(self.rows) - self.max_pending
+            if excess > 0:
+                del self.rows[:excess]
+                self.dropped += excess
+                self.settled += excess
+        if excess > 0:
+            LOG.error('Dropped the %s oldest log rows, more than %s are '
+                      'waiting to be written', excess, self.max_pending)
@@ -0,0 +1,37 @@
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from botbot.apps.plugins import cooperative
+
+
+class Command(BaseCommand):
+
+    help = ("Checks that plugin calls waiting on I/O overlap under gevent, "
+            "and shows by how much")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--calls',
+            type=int,
+            dest='calls',
+            default=20,
+            help='Concurrent calls of each kind'
+        )
+        parser.add_argument(
+            '--seconds',
+            type=float,
+            dest='seconds',
+            default=0.1,
+            help='How long each call waits'
+        )
+
+    def handle(self, **options):
+        bus = redis.StrictRedis.from_url(settings.REDIS_PLUGIN_QUEUE_URL)
+        results = cooperative.check(bus, calls=options['calls'],
+                                    seconds=options['seconds'])
+        for name, (total, wall) in results.items():
+            self.stdout.write(
+                '{0}: {1} calls of {2}s in {3:.2f}s, {4:.1f}x overlap'.format(
+                    name, options['calls'], options['seconds'], wall,
+                    total / wall))
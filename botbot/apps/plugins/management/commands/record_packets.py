@@ -0,0 +1,59 @@
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from botbot.apps.plugins import replay
+
+
+class Command(BaseCommand):
+
+    help = ("Records the packets the bot queues for the plugin runners, "
+            "for replay_packets")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            help='Recording to write, gzipped JSON lines'
+        )
+        parser.add_argument(
+            '--seconds',
+            type=float,
+            dest='seconds',
+            default=60,
+            help='How long to record for, 0 for no limit'
+        )
+        parser.add_argument(
+            '--count',
+            type=int,
+            dest='count',
+            default=0,
+            help='Stop after this many packets, 0 for no limit'
+        )
+        parser.add_argument(
+            '--transport',
+            choices=('list', 'stream'),
+            dest='transport',
+            default='list',
+            help='How the bot queues lines. The list is watched with '
+                 'MONITOR, which slows Redis down while recording'
+        )
+        parser.add_argument(
+            '--queue',
+            dest='queue_key',
+            default=None,
+            help='Redis key of the queue (defaults to "q" for the list '
+                 'transport, "q:stream" for the stream transport)'
+        )
+
+    def handle(self, **options):
+        bus = redis.StrictRedis.from_url(settings.REDIS_PLUGIN_QUEUE_URL)
+        if options['transport'] == 'stream':
+            packets = replay.stream_packets(
+                bus, options['queue_key'] or 'q:stream')
+        else:
+            packets = replay.monitor_packets(bus, options['queue_key'] or 'q')
+        written = replay.record(packets, options['path'],
+                                seconds=options['seconds'],
+                                count=options['count'])
+        self.stdout.write('Recorded {0} packets to {1}'.format(
+            written, options['path']))
@@ -0,0 +1,169 @@
+import argparse
+import gc
+import importlib.util
+import logging
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import (override_settings, setup_databases,
+                               teardown_databases)
+
+from botbot.apps.plugins import replay
+
+
+def mix(value):
+    try:
+        return replay.parse_mix(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+
+
+class Command(BaseCommand):
+
+    help = ("Replays recorded or synthetic packets into a plugin runner "
+            "backed by fakeredis and a test database, and reports its "
+            "throughput, latency and memory use")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            nargs='?',
+            help='Recording made with record_packets'
+        )
+        parser.add_argument(
+            '--synthetic',
+            type=int,
+            dest='synthetic',
+            default=0,
+            help='Replay this many synthetic lines instead of a recording'
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            dest='rate',
+            default=100,
+            help='Synthetic lines per second'
+        )
+        parser.add_argument(
+            '--channels',
+            type=int,
+            dest='channels',
+            default=3,
+            help='Channels the synthetic lines are spread over'
+        )
+        parser.add_argument(
+            '--mix',
+            type=mix,
+            dest='mix',
+            default=replay.DEFAULT_MIX,
+            help='Kinds of synthetic lines with their weights, e.g. '
+                 'message=85,mention=5,command=5,join=5'
+        )
+        parser.add_argument(
+            '--plugins',
+            dest='plugins',
+            default=','.join(replay.DEFAULT_PLUGINS),
+            help='Comma separated plugins active in every channel'
+        )
+        parser.add_argument(
+            '--nick',
+            dest='nick',
+            default='BrainzBot',
+            help='Nick of the chatbots, for mentions'
+        )
+        parser.add_argument(
+            '--speed',
+            type=float,
+            dest='speed',
+            default=1,
+            help='Replay N times faster than the lines arrived, 0 feeds '
+                 'them as fast as the runner takes them'
+        )
+        parser.add_argument(
+            '--with-gevent',
+            action='store_true',
+            dest='with_gevent',
+            default=False,
+            help='Use gevent for concurrency'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=1,
+            help='Maximum number of lines taken off the queue per round trip'
+        )
+        parser.add_argument(
+            '--binary',
+            action='store_true',
+            dest='binary',
+            default=False,
+            help='Queue the lines in the binary wire encoding instead of JSON'
+        )
+        parser.add_argument(
+            '--trace-memory',
+            action='store_true',
+            dest='trace_memory',
+            default=False,
+            help='Report the biggest allocation sites, slows the replay down'
+        )
+        parser.add_argument(
+            '--db-pool-size',
+            type=int,
+            dest='db_pool_size',
+            default=0,
+            help='Database connections shared by the plugin calls, as with '
+                 'run_plugins'
+        )
+
+    def handle(self, **options):
+        # A development requirement, not installed in production
+        if importlib.util.find_spec('fakeredis') is None:
+            raise CommandError('replay_packets needs fakeredis, install it '
+                               'with pip install -r requirements-dev.txt')
+        if options['synthetic']:
+            packets = replay.synthetic_packets(
+                options['synthetic'], rate=options['rate'],
+                channels=options['channels'], mix=options['mix'],
+                nick=options['nick'])
+        elif options['path']:
+            packets = replay.read_recording(options['path'])
+        else:
+            raise CommandError('Give a recording or --synthetic N')
+        if options['verbosity'] < 2:
+            logging.getLogger('botbot.plugin_runner').setLevel(
+                logging.WARNING)
+
+        old_config = setup_databases(0, False, aliases={'default'})
+        try:
+            app = replay.ReplayRunner(use_gevent=options['with_gevent'],
+                                      batch_size=options['batch_size'],
+                                      db_pool_size=options['db_pool_size'])
+            # Keeps channel changes from reaching the live runners
+            with override_settings(REDIS_PLUGIN_QUEUE_URL=''):
+                replay.prepare_channels(
+                    packets, [slug for slug in options['plugins'].split(',')
+                              if slug],
+                    nick=options['nick'])
+            app.register_all_plugins()
+            app.load_registry()
+            if options['trace_memory']:
+                tracemalloc.start()
+            seconds = replay.replay(app, packets, speed=options['speed'],
+                                    binary=options['binary'])
+            output = replay.report(app, len(packets), seconds)
+            output.extend(replay.report_memory())
+            if options['db_pool_size']:
+                output.extend(replay.report_pools())
+            tracemalloc.stop()
+            self.stdout.write('\n'.join(output))
+        finally:
+            # Connections of finished greenlets close once collected
+            gc.collect()
+            if options['db_pool_size']:
+                from botbot.apps.plugins.pooled_postgresql.base import (
+                    close_pools)
+                connections.close_all()
+                close_pools()
+            teardown_databases(old_config, 0)
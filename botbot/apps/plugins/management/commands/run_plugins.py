@@ -1,9 +1,20 @@
+import argparse
 from optparse import make_option
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from botbot.apps.plugins import runner
 
+
+def thresholds(value):
+    """Parses comma separated thresholds, e.g. 1000,5000"""
+    try:
+        return tuple(float(part) for part in value.split(',') if part)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected comma separated numbers, got {0!r}'.format(value))
+
+
 class Command(BaseCommand):
 
     help = "Starts up all plugins in the botbot.apps.bots.plugins module"
@@ -16,6 +27,314 @@ class Command(BaseCommand):
             default=False,
             help='Use gevent for concurrency'
         )
+        parser.add_argument(
+            '--with-asyncio',
+            action='store_true',
+            dest='with_asyncio',
+            default=False,
+            help='Use an asyncio event loop for concurrency'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            dest='max_workers',
+            default=10,
+            help='Size of the thread pool for blocking message and firehose '
+                 'plugin calls (asyncio only)'
+        )
+        parser.add_argument(
+            '--pool-size',
+            type=int,
+            dest='pool_size',
+            default=100,
+            help='Maximum number of message and firehose plugin calls in '
+                 'progress (gevent only)'
+        )
+        parser.add_argument(
+            '--command-pool-size',
+            type=int,
+            dest='command_pool_size',
+            default=20,
+            help='Maximum number of command and mention plugin calls in '
+                 'progress (gevent), or threads for the blocking ones '
+                 '(asyncio)'
+        )
+        parser.add_argument(
+            '--lane-backlog',
+            type=int,
+            dest='lane_backlog',
+            default=10000,
+            help='Plugin calls waiting for a free greenlet before no more '
+                 'lines are read (gevent only)'
+        )
+        parser.add_argument(
+            '--cpu-workers',
+            type=int,
+            dest='cpu_workers',
+            default=0,
+            help='Processes for the plugin methods marked @cpu_bound, 0 runs '
+                 'them like the others'
+        )
+        parser.add_argument(
+            '--db-pool-size',
+            type=int,
+            dest='db_pool_size',
+            default=0,
+            help='Database connections shared by the plugin calls, 0 gives '
+                 'every thread or greenlet a connection of its own'
+        )
+        parser.add_argument(
+            '--db-pool-timeout',
+            type=float,
+            dest='db_pool_timeout',
+            default=10,
+            help='Seconds a plugin call waits for a free database connection'
+        )
+        parser.add_argument(
+            '--log-batch-size',
+            type=int,
+            dest='log_batch_size',
+            default=500,
+            help='Log rows written at once, 0 writes every line as it comes'
+        )
+        parser.add_argument(
+            '--log-batch-delay',
+            type=float,
+            dest='log_batch_delay',
+            default=0.2,
+            help='Seconds a log row waits at most for its batch to fill up'
+        )
+        parser.add_argument(
+            '--plugin-timeout',
+            type=float,
+            dest='plugin_timeout',
+            default=30,
+            help='Seconds before a plugin call is killed (gevent only)'
+        )
+        parser.add_argument(
+            '--plugin-concurrency',
+            type=int,
+            dest='plugin_concurrency',
+            default=10,
+            help='Maximum number of calls in progress per plugin, further '
+                 'calls wait for their turn (gevent only)'
+        )
+        parser.add_argument(
+            '--plugin-backlog',
+            type=int,
+            dest='plugin_backlog',
+            default=1000,
+            help='Calls waiting per plugin before further ones are dropped '
+                 '(gevent only)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=1,
+            help='Maximum number of lines taken off the queue per round trip'
+        )
+
+        parser.add_argument(
+            '--transport',
+            choices=('list', 'stream'),
+            dest='transport',
+            default='list',
+            help='Read lines from a Redis list (the default, as the bot '
+                 'sends them) or from a Redis stream consumer group'
+        )
+        parser.add_argument(
+            '--queue',
+            dest='queue_key',
+            default=None,
+            help='Redis key the lines are read from (default "q" for the '
+                 'list transport, "q:stream" for the stream transport)'
+        )
+        parser.add_argument(
+            '--stream-group',
+            dest='stream_group',
+            default='plugins',
+            help='Consumer group name (stream transport only)'
+        )
+        parser.add_argument(
+            '--consumer',
+            dest='consumer',
+            default=None,
+            help='Consumer name, unique per runner (stream transport only, '
+                 'defaults to <hostname>-<pid>)'
+        )
+        parser.add_argument(
+            '--slow-line-threshold',
+            type=float,
+            dest='slow_line_threshold',
+            default=0,
+            help='Log the stage timings of the lines that take longer than '
+                 'this many seconds from the bot receiving them to the end '
+                 'of their plugin calls, 0 disables it'
+        )
+        parser.add_argument(
+            '--profile-dir',
+            dest='profile_dir',
+            default=None,
+            help='Where the profiles taken on SIGUSR1 (CPU) and SIGUSR2 '
+                 '(memory) are written, defaults to the temporary directory'
+        )
+        parser.add_argument(
+            '--profile-seconds',
+            type=float,
+            dest='profile_seconds',
+            default=30,
+            help='Length of the CPU profiles taken on SIGUSR1'
+        )
+        parser.add_argument(
+            '--metrics-port',
+            type=int,
+            dest='metrics_port',
+            default=0,
+            help='Serve metrics in the Prometheus text format on this port, '
+                 'shard workers use the following ports'
+        )
+        parser.add_argument(
+            '--shards',
+            type=int,
+            dest='shards',
+            default=0,
+            help='Run this many worker processes, each handling the lines '
+                 'of a share of the channels'
+        )
+        parser.add_argument(
+            '--shed-depth',
+            type=thresholds,
+            dest='shed_depth',
+            default=(),
+            help='Queue lengths from which non-essential plugins are '
+                 'skipped and, past the second one, the firehose is '
+                 'deferred, e.g. 1000,5000'
+        )
+        parser.add_argument(
+            '--shed-lag',
+            type=thresholds,
+            dest='shed_lag',
+            default=(),
+            help='Same as --shed-depth, as seconds since the bot received '
+                 'the line, e.g. 10,60'
+        )
+        parser.add_argument(
+            '--outbound-rate',
+            type=float,
+            dest='outbound_rate',
+            default=0,
+            help='Lines per second sent to a channel or nick, on average. '
+                 '0 (the default) sends responses as soon as they are ready'
+        )
+        parser.add_argument(
+            '--outbound-burst',
+            type=int,
+            dest='outbound_burst',
+            default=5,
+            help='Lines sent to a channel or nick at once before pacing '
+                 'kicks in'
+        )
+        parser.add_argument(
+            '--outbound-backlog',
+            type=int,
+            dest='outbound_backlog',
+            default=50,
+            help='Lines queued per channel or nick before low priority '
+                 'ones are dropped'
+        )
+        parser.add_argument(
+            '--coalesce-length',
+            type=int,
+            dest='coalesce_length',
+            default=0,
+            help='Merge queued lines to a channel or nick up to this many '
+                 'characters, 0 disables it'
+        )
+
+    # Options shard workers inherit, as (dest, flag)
+    worker_options = (
+        ('max_workers', '--workers'),
+        ('pool_size', '--pool-size'),
+        ('command_pool_size', '--command-pool-size'),
+        ('lane_backlog', '--lane-backlog'),
+        ('cpu_workers', '--cpu-workers'),
+        ('db_pool_size', '--db-pool-size'),
+        ('db_pool_timeout', '--db-pool-timeout'),
+        ('log_batch_size', '--log-batch-size'),
+        ('log_batch_delay', '--log-batch-delay'),
+        ('plugin_timeout', '--plugin-timeout'),
+        ('plugin_concurrency', '--plugin-concurrency'),
+        ('plugin_backlog', '--plugin-backlog'),
+        ('batch_size', '--batch-size'),
+        ('outbound_rate', '--outbound-rate'),
+        ('outbound_burst', '--outbound-burst'),
+        ('outbound_backlog', '--outbound-backlog'),
+        ('coalesce_length', '--coalesce-length'),
+        ('slow_line_threshold', '--slow-line-threshold'),
+        ('profile_seconds', '--profile-seconds'),
+    )
+
+    def worker_args(self, options):
+        """Command line arguments for shard workers"""
+        args = []
+        if options['with_gevent']:
+            args.append('--with-gevent')
+        if options['with_asyncio']:
+            args.append('--with-asyncio')
+        for dest, flag in self.worker_options:
+            args.extend([flag, str(options[dest])])
+        for dest, flag in (('shed_depth', '--shed-depth'),
+                           ('shed_lag', '--shed-lag')):
+            if options[dest]:
+                args.extend([flag, ','.join(str(t) for t in options[dest])])
+        if options['profile_dir']:
+            args.extend(['--profile-dir', options['profile_dir']])
+        return args
 
     def handle(self, **options):
-        runner.start_plugins(use_gevent=options.get('with_gevent', False))
+        if options.get('with_gevent') and options.get('with_asyncio'):
+            raise CommandError('--with-gevent and --with-asyncio are '
+                               'mutually exclusive')
+        runner.start_plugins(use_gevent=options.get('with_gevent', False),
+                             use_asyncio=options.get('with_asyncio', False),
+                             max_workers=options.get('max_workers', 10),
+                             pool_size=options.get('pool_size', 100),
+                             command_pool_size=options.get(
+                                 'command_pool_size', 20),
+                             lane_backlog=options.get('lane_backlog', 10000),
+                             cpu_workers=options.get('cpu_workers', 0),
+                             db_pool_size=options.get('db_pool_size', 0),
+                             db_pool_timeout=options.get('db_pool_timeout',
+                                                         10),
+                             log_batch_size=options.get('log_batch_size',
+                                                        500),
+                             log_batch_delay=options.get('log_batch_delay',
+                                                         0.2),
+                             plugin_timeout=options.get('plugin_timeout', 30),
+                             plugin_concurrency=options.get(
+                                 'plugin_concurrency', 10),
+                             plugin_backlog=options.get('plugin_backlog',
+                                                        1000),
+                             batch_size=options.get('batch_size', 1),
+                             transport=options.get('transport', 'list'),
+                             queue_key=options.get('queue_key'),
+                             stream_group=options.get('stream_group',
+                                                      'plugins'),
+                             consumer=options.get('consumer'),
+                             outbound_rate=options.get('outbound_rate', 0),
+                             outbound_burst=options.get('outbound_burst', 5),
+                             outbound_backlog=options.get('outbound_backlog',
+                                                          50),
+                             coalesce_length=options.get('coalesce_length',
+                                                         0),
+                             shed_depth=options.get('shed_depth', ()),
+                             shed_lag=options.get('shed_lag', ()),
+                             slow_line_threshold=options.get(
+                                 'slow_line_threshold', 0),
+                             profile_dir=options.get('profile_dir'),
+                             profile_seconds=options.get('profile_seconds',
+                                                         30),
+                             metrics_port=options.get('metrics_port', 0),
+                             shards=options.get('shards', 0),
+                             worker_args=self.worker_args(options))
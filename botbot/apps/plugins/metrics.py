@@ -0,0 +1,251 @@
+"""
+Metrics of the plugin runner, served over HTTP in the Prometheus text
+format (``run_plugins --metrics-port``).
+"""
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+# Seconds, from a quick regex to a slow web API
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                           .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs) + '}'
+
+
+class Metric(object):
+    """A metric with a value per combination of label values"""
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help),
+                 '# TYPE {0} {1}'.format(self.name, self.type)]
+        with self.lock:
+            items = sorted(self.values.items(), key=str)
+        for label_values, value in items:
+            lines.extend(self._samples(label_values, value))
+        return lines
+
+    def _samples(self, label_values, value):
+        return ['{0}{1} {2}'.format(
+            self.name, _format_labels(self.labels, label_values), value)]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = (self.values.get(label_values, 0) +
+                                         amount)
+
+    def set(self, value, *label_values):
+        """For totals kept elsewhere"""
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                # [count per bucket (+Inf last), sum]
+                state = self.values[label_values] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def _samples(self, label_values, state):
+        counts, total = state
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            samples.append('{0}_bucket{1} {2}'.format(
+                self.name, _format_labels(self.labels, label_values,
+                                          [('le', bound)]),
+                cumulative))
+        labels = _format_labels(self.labels, label_values)
+        samples.append('{0}_sum{1} {2}'.format(self.name, labels, total))
+        samples.append('{0}_count{1} {2}'.format(self.name, labels,
+                                                 cumulative))
+        return samples
+
+
+class Metrics(object):
+    """
+    A set of metrics. Collectors are called before rendering, to set the
+    gauges that are cheaper to read on demand than to keep up to date.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception:
+                LOG.error('Metrics collector failed', exc_info=True)
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class PluginRunnerMetrics(Metrics):
+    def __init__(self):
+        super(PluginRunnerMetrics, self).__init__()
+        self.lines = self.add(Counter(
+            'botbot_plugin_lines_total', 'Lines taken off the queue'))
+        self.lines_dropped = self.add(Counter(
+            'botbot_plugin_lines_dropped_total',
+            'Lines dropped for an unknown chatbot or channel, or that '
+            'failed to dispatch'))
+        self.routed = self.add(Counter(
+            'botbot_plugin_routed_total', 'Plugin calls routed',
+            ['router']))
+        self.queue_depth = self.add(Gauge(
+            'botbot_plugin_queue_depth', 'Lines waiting in the queue'))
+        self.dispatch_seconds = self.add(Histogram(
+            'botbot_plugin_dispatch_seconds',
+            'Time to route a line, including the plugin calls that '
+            'run inline'))
+        self.calls = self.add(Counter(
+            'botbot_plugin_calls_total', 'Plugin method calls',
+            ['plugin', 'method']))
+        self.errors = self.add(Counter(
+            'botbot_plugin_errors_total',
+            'Plugin method calls that raised', ['plugin', 'method']))
+        self.timeouts = self.add(Counter(
+            'botbot_plugin_timeouts_total',
+            'Plugin method calls killed after the timeout',
+            ['plugin', 'method']))
+        self.plugin_running = self.add(Gauge(
+            'botbot_plugin_calls_running',
+            'Plugin method calls in progress (gevent)', ['plugin']))
+        self.plugin_waiting = self.add(Gauge(
+            'botbot_plugin_calls_waiting',
+            'Plugin method calls waiting for the plugin\'s concurrency '
+            'limit (gevent)', ['plugin']))
+        self.dropped_calls = self.add(Counter(
+            'botbot_plugin_calls_dropped_total',
+            'Plugin method calls dropped, too many were waiting for the '
+            'plugin (gevent)', ['plugin']))
+        self.call_seconds = self.add(Histogram(
+            'botbot_plugin_call_seconds', 'Plugin method execution time',
+            ['plugin']))
+        self.lane_running = self.add(Gauge(
+            'botbot_plugin_lane_running',
+            'Plugin calls in progress per lane (gevent)', ['lane']))
+        self.lane_queued = self.add(Gauge(
+            'botbot_plugin_lane_queued',
+            'Plugin calls waiting for a free greenlet per lane (gevent)',
+            ['lane']))
+        self.shed = self.add(Counter(
+            'botbot_plugin_shed_total',
+            'Plugin calls skipped or deferred by load shedding',
+            ['decision', 'plugin']))
+        self.shed_level = self.add(Gauge(
+            'botbot_plugin_shed_level', 'Current load shedding level'))
+        self.line_latency = self.add(Gauge(
+            'botbot_plugin_line_latency_seconds',
+            'Time from the bot receiving a line to its last plugin call '
+            'returning, over the last lines of each channel',
+            ['chatbot', 'channel', 'quantile']))
+        self.stage_seconds = self.add(Counter(
+            'botbot_plugin_stage_seconds_total',
+            'Time lines spent in each stage', ['stage']))
+        self.outbound_backlog = self.add(Gauge(
+            'botbot_plugin_outbound_backlog',
+            'Response lines waiting for the outbound scheduler'))
+        self.log_buffered = self.add(Gauge(
+            'botbot_plugin_log_buffered',
+            'Log rows waiting to be written'))
+        self.log_flushed = self.add(Counter(
+            'botbot_plugin_log_flushed_total',
+            'Log rows flushed in batches, including those skipped as already '
+            'stored'))
+        self.log_dropped = self.add(Counter(
+            'botbot_plugin_log_dropped_total',
+            'Log rows dropped after failed writes'))
+        self.db_pool_connections = self.add(Gauge(
+            'botbot_plugin_db_pool_connections',
+            'Database connections of the pool, idle or in use',
+            ['alias', 'state']))
+        self.db_pool_checkouts = self.add(Counter(
+            'botbot_plugin_db_pool_checkouts_total',
+            'Database connections taken from the pool', ['alias']))
+        self.db_pool_waits = self.add(Counter(
+            'botbot_plugin_db_pool_waits_total',
+            'Checkouts that waited for a connection to be free', ['alias']))
+        self.db_pool_timeouts = self.add(Counter(
+            'botbot_plugin_db_pool_timeouts_total',
+            'Checkouts that gave up waiting', ['alias']))
+        self.db_pool_wait_seconds = self.add(Counter(
+            'botbot_plugin_db_pool_wait_seconds_total',
+            'Time spent waiting for a free connection', ['alias']))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        body = self.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug('Metrics request: ' + format, *args)
+
+
+def serve(metrics, port, address=''):
+    """Serves the metrics on http://<address>:<port>/ from a thread"""
+    handler = type('Handler', (MetricsHandler,), {'metrics': metrics})
+    server = ThreadingHTTPServer((address, port), handler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics', daemon=True)
+    thread.start()
+    LOG.info('Serving metrics on port %s', port)
+    return server
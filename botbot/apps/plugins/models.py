@@ -1,9 +1,65 @@
+import logging
 from inspect import cleandoc
 
+import redis
+from django.conf import settings
 from django.core.cache import cache
-from django.db import models
+from django.db import models, transaction
 from importlib import import_module
 
+LOG = logging.getLogger(__name__)
+
+# Redis pub/sub channel telling plugin runners a channel's or a chatbot's
+# settings changed
+CHANNEL_CHANGES = 'plugins:channel-changes'
+
+_publisher = None
+# Seconds, saving a model shouldn't hang on an unreachable Redis
+PUBLISH_TIMEOUT = 1
+
+
+def _publish_change(message, what):
+    """
+    Publishes ``message`` once the current transaction commits. Runners
+    refresh everything periodically anyway, so a Redis outage only delays
+    the change: it is logged, never raised to the code saving the model.
+    """
+    def publish():
+        global _publisher
+        if not settings.REDIS_PLUGIN_QUEUE_URL:
+            return
+        try:
+            if _publisher is None:
+                _publisher = redis.StrictRedis.from_url(
+                    settings.REDIS_PLUGIN_QUEUE_URL,
+                    socket_timeout=PUBLISH_TIMEOUT,
+                    socket_connect_timeout=PUBLISH_TIMEOUT)
+            _publisher.publish(CHANNEL_CHANGES, message)
+        except redis.RedisError:
+            LOG.warning('Could not notify plugin runners of a change to %s',
+                        what, exc_info=True)
+    transaction.on_commit(publish)
+
+
+def notify_channel_changed(channel_id, fingerprint=''):
+    """
+    Tells the plugin runners to reload a channel once the current
+    transaction commits. The message is ``<channel id> <fingerprint>``,
+    runners that already have that fingerprint skip the reload.
+    """
+    _publish_change('{0} {1}'.format(channel_id, fingerprint or ''),
+                    'channel {0}'.format(channel_id))
+
+
+def notify_chatbot_changed(chatbot_id):
+    """
+    Tells the plugin runners to reload a chatbot along with all of its
+    channels once the current transaction commits. The message is
+    ``chatbot <chatbot id>``.
+    """
+    _publish_change('chatbot {0}'.format(chatbot_id),
+                    'chatbot {0}'.format(chatbot_id))
+
 
 class Plugin(models.Model):
     """A global plugin registered in botbot"""
@@ -39,7 +95,15 @@ class ActivePlugin(models.Model):
         # Let the plugin_runner auto-reload the new values
         cache.delete(self.channel.plugin_config_cache_key(self.plugin.slug))
         cache.delete(self.channel.active_plugin_slugs_cache_key)
+        notify_channel_changed(self.channel_id)
         return obj
 
+    def delete(self, *args, **kwargs):
+        result = super(ActivePlugin, self).delete(*args, **kwargs)
+        cache.delete(self.channel.plugin_config_cache_key(self.plugin.slug))
+        cache.delete(self.channel.active_plugin_slugs_cache_key)
+        notify_channel_changed(self.channel_id)
+        return result
+
     def __str__(self):
         return '{} for {}'.format(self.plugin.name, self.channel.name)
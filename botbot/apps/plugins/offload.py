@@ -0,0 +1,44 @@
+"""
+A pool of processes for the plugin methods marked ``@cpu_bound``, so that
+they don't hold up the other plugin calls (``run_plugins --cpu-workers``).
+
+The method runs on a fresh instance of its plugin class, with a copy of
+the line and of the channel's configuration of the plugin.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+
+
+class LineCopy(object):
+    """The attributes of a line a plugin method can use, in another process"""
+    __slots__ = ('text', 'full_text', 'user', 'is_direct_message',
+                 '_chatbot_id', '_channel_name', '_command', '_is_message',
+                 '_host', '_raw', '_received')
+
+    def __init__(self, line):
+        for name in self.__slots__:
+            setattr(self, name, getattr(line, name))
+
+    def __str__(self):
+        return self.full_text
+
+    def __repr__(self):
+        return str(self)
+
+
+def create_pool(workers):
+    # Spawned rather than forked, a gevent hub doesn't survive a fork
+    return ProcessPoolExecutor(workers,
+                               mp_context=multiprocessing.get_context('spawn'),
+                               initializer=django.setup)
+
+
+def call_in_process(plugin_class, slug, config, method_name, line, arg_dict):
+    """Runs in the pool: calls the method on a new instance of the plugin"""
+    plugin = plugin_class()
+    plugin.slug = slug
+    if config is not None:
+        plugin.prod_config = config
+    return getattr(plugin, method_name)(line, **arg_dict)
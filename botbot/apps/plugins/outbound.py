@@ -0,0 +1,157 @@
+"""
+Pacing of the responses the plugin runner sends back to the bot.
+"""
+import collections
+import logging
+import threading
+import time
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+# Replies to commands and mentions, someone is waiting for them
+HIGH_PRIORITY = 'high'
+# Everything else, e.g. issue lookups triggered by any message
+LOW_PRIORITY = 'low'
+
+
+class TokenBucket(object):
+    """Allows ``rate`` sends per second on average, ``burst`` at once"""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    @property
+    def full(self):
+        self.refill()
+        return self.tokens >= self.burst
+
+
+def write_command(chatbot_id, target, text):
+    """The bot command that sends a line of text to a channel or nick"""
+    return 'WRITE {0} {1} {2}'.format(chatbot_id, target, text)
+
+
+OutboundLine = collections.namedtuple('OutboundLine',
+                                      'priority text queued')
+
+
+class OutboundScheduler(object):
+    """
+    Queues response lines per (chatbot, target) and releases them at the
+    pace of the target's token bucket, so that several plugins replying
+    at once don't get the bot flood-throttled. Lines the bucket has room
+    for are released as they are added, the others by ``due()``.
+
+    Consecutive lines to a target are merged (separated by `` | ``) while
+    they fit in ``coalesce_length`` characters, 0 disables it. Once a
+    target has more than ``max_backlog`` lines queued, its oldest low
+    priority lines are dropped.
+    """
+    separator = ' | '
+
+    def __init__(self, rate=1.0, burst=5, max_backlog=50, coalesce_length=0,
+                 clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_backlog = max_backlog
+        self.coalesce_length = coalesce_length
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Queued OutboundLines per (chatbot id, target)
+        self.queues = {}
+        self.buckets = {}
+        # Lines dropped per (chatbot id, target)
+        self.dropped = collections.Counter()
+
+    def add(self, chatbot_id, target, lines, priority=LOW_PRIORITY):
+        """
+        Queues lines for a target, returns the WRITE commands of those that
+        may be sent now
+        """
+        key = (chatbot_id, target)
+        now = self.clock()
+        commands = []
+        with self.lock:
+            queue = self.queues.setdefault(key, collections.deque())
+            queue.extend(OutboundLine(priority, text, now) for text in lines)
+            self._release(key, queue, commands)
+            if len(queue) > self.max_backlog:
+                self._shed(key, queue)
+        return commands
+
+    def _shed(self, key, queue):
+        """Drops the oldest low priority lines beyond the backlog limit"""
+        excess = len(queue) - self.max_backlog
+        kept = collections.deque()
+        for line in queue:
+            if excess and line.priority == LOW_PRIORITY:
+                excess -= 1
+                self.dropped[key] += 1
+            else:
+                kept.append(line)
+        LOG.warning('Outbound backlog for %s on %s over %s lines, dropped '
+                    '%s so far', key[1], key[0], self.max_backlog,
+                    self.dropped[key])
+        self.queues[key] = kept
+
+    def due(self):
+        """
+        Takes the lines that may be sent now off the queues, returns them
+        as WRITE commands in order per target
+        """
+        commands = []
+        with self.lock:
+            for key, queue in list(self.queues.items()):
+                self._release(key, queue, commands)
+            # Forget the targets that are back to a full bucket
+            for key, bucket in list(self.buckets.items()):
+                if key not in self.queues and bucket.full:
+                    del self.buckets[key]
+        return commands
+
+    def _release(self, key, queue, commands):
+        """Takes the lines the target's bucket allows off its queue"""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, self.clock)
+            self.buckets[key] = bucket
+        while queue and bucket.take():
+            commands.append(write_command(key[0], key[1],
+                                          self._next_text(queue)))
+        if not queue:
+            del self.queues[key]
+
+    def _next_text(self, queue):
+        text = queue.popleft().text
+        while (queue and self.coalesce_length and
+               len(text) + len(self.separator) + len(queue[0].text) <=
+               self.coalesce_length):
+            text += self.separator + queue.popleft().text
+        return text
+
+    def backlog(self):
+        """
+        Returns (lines queued, seconds the oldest has waited) per
+        (chatbot id, target)
+        """
+        now = self.clock()
+        with self.lock:
+            return {key: (len(queue), now - queue[0].queued)
+                    for key, queue in self.queues.items() if queue}
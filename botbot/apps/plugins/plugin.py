@@ -1,6 +1,8 @@
 import logging
 from botbot_plugins.base import PrivateMessage
 
+from .outbound import HIGH_PRIORITY
+
 LOG = logging.getLogger('botbot.plugin_runner')
 
 
@@ -47,12 +49,12 @@ class RealPluginMixin(object):
         ukey = self.unique_key(key)
         return self.app.storage.delete(ukey) == 1
 
-    def greenlet_respond(self, grnlt):
+    def greenlet_respond(self, grnlt, priority=HIGH_PRIORITY):
         """Callback for gevent return values"""
         msg = grnlt.value
-        self.respond(msg)
+        self.respond(msg, priority)
 
-    def respond(self, msg):
+    def respond(self, msg, priority=HIGH_PRIORITY):
         """Writes message back to the channel the line was received on"""
         # Internal method, not part of public API
         if msg:
@@ -64,7 +66,4 @@ class RealPluginMixin(object):
                 lines = msg.split('\n')
             for response_line in lines:
                 LOG.info('Write to %s: %s', nick, response_line)
-                response_cmd = 'WRITE {0} {1} {2}'.format(self.chatbot_id,
-                                                           nick,
-                                                           response_line)
-                self.app.bot_bus.lpush('bot', response_cmd)
+            self.app.push_responses(self.chatbot_id, nick, lines, priority)
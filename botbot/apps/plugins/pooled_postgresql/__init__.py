@@ -0,0 +1,4 @@
+"""
+PostgreSQL database backend sharing a bounded pool of connections between
+the threads or greenlets of a process, see ``base.install``.
+"""
@@ -0,0 +1,181 @@
+"""
+The plugin runner's concurrent calls (``run_plugins --db-pool-size``)
+each get a Django connection of their own. With this backend, those
+connections come from a pool of at most ``POOL_SIZE`` psycopg2
+connections per process, waiting up to ``POOL_TIMEOUT`` seconds for one
+to be free, and closing a connection puts it back in the pool.
+"""
+import threading
+import time
+from functools import partial
+
+import psycopg2
+import psycopg2.extensions
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.base.base import NO_DB_ALIAS
+from django.db.backends.postgresql import base
+
+POSTGRESQL_ENGINES = ('django.db.backends.postgresql',
+                      'django.db.backends.postgresql_psycopg2')
+# ConnectionPool per (alias, database name)
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool(object):
+    """
+    Up to ``size`` connections, opened on demand. Waiting for a free one
+    yields under gevent, since the lock is monkey-patched.
+    """
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.opened = 0
+        self.condition = threading.Condition()
+        # Totals, for the metrics
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+
+    @property
+    def in_use(self):
+        return self.opened - len(self.idle)
+
+    def get(self, connect):
+        """
+        Returns an idle connection, or one opened with ``connect()`` while
+        the pool isn't full
+        """
+        start = time.monotonic()
+        with self.condition:
+            self.checkouts += 1
+            waited = False
+            while not self.idle and self.opened >= self.size:
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise psycopg2.OperationalError(
+                        'No database connection free in the pool after '
+                        '{0}s'.format(self.timeout))
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                self.condition.wait(remaining)
+            self.wait_seconds += time.monotonic() - start
+            if self.idle:
+                return self.idle.pop()
+            self.opened += 1
+        try:
+            return connect()
+        except BaseException:
+            self.discard(None)
+            raise
+
+    def put(self, connection):
+        with self.condition:
+            self.idle.append(connection)
+            self.condition.notify()
+
+    def discard(self, connection):
+        """Closes a connection that can't be reused, making room for another"""
+        if connection is not None:
+            try:
+                connection.close()
+            except psycopg2.Error:
+                pass
+        with self.condition:
+            self.opened -= 1
+            self.condition.notify()
+
+    def close(self):
+        """Closes the idle connections"""
+        with self.condition:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            self.discard(connection)
+
+
+def install(size, timeout=10, alias=DEFAULT_DB_ALIAS):
+    """
+    Makes the connections of ``alias`` that are opened from now on, from
+    any thread or greenlet, come from a pool of ``size`` connections
+    """
+    settings_dict = connections.settings[alias]
+    if settings_dict['ENGINE'] not in POSTGRESQL_ENGINES + (__package__,):
+        raise ImproperlyConfigured(
+            'Only PostgreSQL connections can be pooled, not {0}'.format(
+                settings_dict['ENGINE']))
+    settings_dict.update(ENGINE=__package__, POOL_SIZE=size,
+                         POOL_TIMEOUT=timeout)
+    # This thread's connection was set up with the previous engine
+    connections[alias].close()
+    del connections[alias]
+
+
+def pools():
+    """Returns the pools of the process per (alias, database name)"""
+    with _pools_lock:
+        return dict(_pools)
+
+
+def close_pools():
+    for pool in pools().values():
+        pool.close()
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    @property
+    def connection_pool(self):
+        if self.alias == NO_DB_ALIAS:
+            # Connections to the maintenance database, e.g. to create the
+            # test database
+            return None
+        key = (self.alias, self.settings_dict['NAME'])
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(
+                    self.settings_dict['POOL_SIZE'],
+                    self.settings_dict['POOL_TIMEOUT'])
+            return pool
+
+    def get_new_connection(self, conn_params):
+        pool = self.connection_pool
+        if pool is None:
+            return super(DatabaseWrapper, self).get_new_connection(conn_params)
+        # Set when opening a connection, reused ones need it too
+        self.isolation_level = base.IsolationLevel(
+            self.settings_dict['OPTIONS'].get(
+                'isolation_level', base.IsolationLevel.READ_COMMITTED))
+        return pool.get(partial(
+            super(DatabaseWrapper, self).get_new_connection, conn_params))
+
+    def _close(self):
+        pool = self.connection_pool
+        if pool is None or self.connection is None:
+            return super(DatabaseWrapper, self)._close()
+        connection, self.connection = self.connection, None
+        if self._reusable(connection):
+            pool.put(connection)
+        else:
+            pool.discard(connection)
+
+    def _reusable(self, connection):
+        """Rolls back what the last user left, checks it still works"""
+        if connection.closed:
+            return False
+        try:
+            if (connection.info.transaction_status !=
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                connection.rollback()
+            if self.errors_occurred:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+        except psycopg2.Error:
+            return False
+        return True
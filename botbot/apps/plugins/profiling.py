@@ -0,0 +1,108 @@
+"""
+On-demand profiling of a running plugin runner.
+
+``kill -USR1 <pid>`` profiles the CPU for ``seconds`` seconds and writes a
+pstats file. ``kill -USR2 <pid>`` starts tracing memory allocations, the
+next ``kill -USR2`` stops it and writes what was allocated in between and
+is still alive. The signal handlers only take note of the request, the
+work happens in the runner's housekeeping, between two batches.
+"""
+import cProfile
+import datetime
+import logging
+import os
+import signal
+import tempfile
+import time
+import tracemalloc
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+
+class Profiler(object):
+    # Frames kept per traced allocation
+    traceback_limit = 25
+    # Lines of the memory report
+    report_size = 50
+
+    def __init__(self, directory=None, seconds=30, clock=time.monotonic):
+        self.directory = directory or tempfile.gettempdir()
+        self.seconds = seconds
+        self.clock = clock
+        self.cpu_requested = False
+        self.memory_requested = False
+        self.cpu_profile = None
+        self.cpu_deadline = None
+        self.memory_baseline = None
+
+    def install(self):
+        """Registers the SIGUSR1 (CPU) and SIGUSR2 (memory) handlers"""
+        signal.signal(signal.SIGUSR1, self.request_cpu)
+        signal.signal(signal.SIGUSR2, self.request_memory)
+
+    def request_cpu(self, signum=None, frame=None):
+        self.cpu_requested = True
+
+    def request_memory(self, signum=None, frame=None):
+        self.memory_requested = True
+
+    def tick(self):
+        """Starts and stops the requested profiles"""
+        if self.cpu_requested:
+            self.cpu_requested = False
+            if self.cpu_profile is None:
+                self.start_cpu()
+        if (self.cpu_profile is not None and
+                self.clock() >= self.cpu_deadline):
+            self.stop_cpu()
+        if self.memory_requested:
+            self.memory_requested = False
+            if self.memory_baseline is None:
+                self.start_memory()
+            else:
+                self.stop_memory()
+
+    def path(self, extension):
+        return os.path.join(self.directory, 'plugin-runner-{0}-{1}.{2}'.format(
+            os.getpid(), datetime.datetime.now().strftime('%Y%m%d-%H%M%S'),
+            extension))
+
+    def start_cpu(self):
+        LOG.info('Profiling CPU for %ss', self.seconds)
+        self.cpu_deadline = self.clock() + self.seconds
+        self.cpu_profile = cProfile.Profile()
+        self.cpu_profile.enable()
+
+    def stop_cpu(self):
+        profile, self.cpu_profile = self.cpu_profile, None
+        profile.disable()
+        path = self.path('pstats')
+        profile.dump_stats(path)
+        LOG.info('Wrote CPU profile to %s', path)
+        return path
+
+    def start_memory(self):
+        LOG.info('Tracing memory allocations until the next SIGUSR2')
+        tracemalloc.start(self.traceback_limit)
+        self.memory_baseline = self.snapshot()
+
+    def stop_memory(self):
+        snapshot = self.snapshot()
+        baseline, self.memory_baseline = self.memory_baseline, None
+        tracemalloc.stop()
+        stats = snapshot.compare_to(baseline, 'lineno')
+        path = self.path('tracemalloc')
+        snapshot.dump(path)
+        with open(path + '.txt', 'w') as report:
+            for stat in stats[:self.report_size]:
+                report.write('{0}\n'.format(stat))
+        LOG.info('Memory growth since the previous snapshot, top 5: %s',
+                 '; '.join(str(stat) for stat in stats[:5]))
+        LOG.info('Wrote memory snapshot to %s, report to %s.txt', path, path)
+        return path
+
+    def snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
@@ -0,0 +1,139 @@
+"""
+In-memory copy of the bots, channels and active plugins the runner routes
+lines for, so that dispatching a line never touches the database.
+"""
+import logging
+import time
+
+import redis
+
+from botbot.apps.bots import models as bots_models
+from .models import CHANNEL_CHANGES
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+
+class ChannelRegistry(object):
+    """
+    Loads every active chatbot and its channels, with their active plugins
+    and configurations, in a few queries. Lines of inactive chatbots are
+    dropped: the bot doesn't connect them, so those are stragglers from
+    before their deactivation.
+
+    ``Channel.save`` and ``ActivePlugin.save`` publish the changed channel on
+    Redis, ``ChatBot.save`` publishes the bot itself; ``poll`` reloads those
+    channels along with their chatbot, or the bot with all of its channels.
+    Everything is reloaded
+    every ``refresh_interval`` seconds anyway, to pick up changes made
+    without going through ``save`` (e.g. bulk deletes).
+    """
+
+    def __init__(self, bus, refresh_interval=600):
+        self.bus = bus
+        self.refresh_interval = refresh_interval
+        self.pubsub = None
+        self.chatbots = {}
+        # Channel per (chatbot id, name)
+        self.channels = {}
+        # (chatbot id, name) per channel id, to find renamed channels
+        self.channel_keys = {}
+        self.last_load = 0
+
+    def load(self):
+        """(Re)loads everything"""
+        if self.pubsub is None:
+            # Subscribe first, so changes made while loading aren't missed
+            self.pubsub = self.bus.pubsub()
+            self.pubsub.subscribe(CHANNEL_CHANGES)
+        chatbots = {chatbot.pk: chatbot for chatbot in
+                    bots_models.ChatBot.objects.filter(is_active=True)}
+        channels = {}
+        channel_keys = {}
+        for channel in self._channels().filter(chatbot__in=list(chatbots)):
+            key = (channel.chatbot_id, channel.name)
+            channels[key] = channel
+            channel_keys[channel.pk] = key
+        self.chatbots, self.channels = chatbots, channels
+        self.channel_keys = channel_keys
+        self.last_load = time.monotonic()
+        LOG.info('Loaded %s chatbots and %s channels',
+                 len(chatbots), len(channels))
+
+    def _channels(self):
+        return (bots_models.Channel.objects
+                .select_related('chatbot')
+                .prefetch_related('activeplugin_set__plugin'))
+
+    def chatbot(self, chatbot_id):
+        return self.chatbots.get(chatbot_id)
+
+    def channel(self, chatbot_id, name):
+        return self.channels.get((chatbot_id, name))
+
+    def poll(self):
+        """Applies the changes published since the last call"""
+        if time.monotonic() - self.last_load >= self.refresh_interval:
+            self.load()
+        try:
+            message = self.pubsub.get_message()
+            while message:
+                # Skip the (un)subscribe confirmations
+                if message['type'] == 'message':
+                    self.apply_change(message['data'])
+                message = self.pubsub.get_message()
+        except redis.RedisError:
+            # Changes may have been missed, start over on the next poll
+            LOG.warning('Lost the channel change subscription',
+                        exc_info=True)
+            self.last_load = 0
+
+    def apply_change(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        channel_id, _, fingerprint = data.partition(' ')
+        if channel_id == 'chatbot':
+            self.reload_chatbot(int(fingerprint))
+            return
+        channel_id = int(channel_id)
+        key = self.channel_keys.get(channel_id)
+        current = self.channels.get(key)
+        if (fingerprint and current is not None and
+                current.fingerprint == fingerprint):
+            return
+        self.reload_channel(channel_id)
+
+    def reload_channel(self, channel_id):
+        """Reloads a channel and its chatbot, which may be new"""
+        channel = self._channels().filter(pk=channel_id).first()
+        old_key = self.channel_keys.pop(channel_id, None)
+        if old_key is not None:
+            self.channels.pop(old_key, None)
+        if channel is not None and not channel.chatbot.is_active:
+            self.chatbots.pop(channel.chatbot_id, None)
+            channel = None
+        if channel is not None:
+            self.chatbots[channel.chatbot_id] = channel.chatbot
+            key = (channel.chatbot_id, channel.name)
+            self.channels[key] = channel
+            self.channel_keys[channel_id] = key
+        LOG.info('Reloaded channel %s', channel_id)
+
+    def reload_chatbot(self, chatbot_id):
+        """Reloads a chatbot and all of its channels, dropped if inactive"""
+        for channel_id, key in list(self.channel_keys.items()):
+            if key[0] == chatbot_id:
+                del self.channel_keys[channel_id]
+                self.channels.pop(key, None)
+        chatbot = bots_models.ChatBot.objects.filter(
+            pk=chatbot_id, is_active=True).first()
+        if chatbot is None:
+            self.chatbots.pop(chatbot_id, None)
+        else:
+            self.chatbots[chatbot_id] = chatbot
+            for channel in self._channels().filter(chatbot=chatbot):
+                # The same instance as in ``chatbots``
+                channel.chatbot = chatbot
+                key = (chatbot_id, channel.name)
+                self.channels[key] = channel
+                self.channel_keys[channel.pk] = key
+        LOG.info('Reloaded chatbot %s', chatbot_id)
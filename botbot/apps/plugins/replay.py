@@ -0,0 +1,345 @@
+"""
+Load testing of the plugin runner: packets recorded off a live queue, or
+synthetic ones, replayed into a runner backed by fakeredis.
+
+A recording is a gzipped file of JSON lines, ``{"t": <seconds since the
+start of the recording>, "packet": <packet>}``.
+"""
+import collections
+import datetime
+import gzip
+import json
+import logging
+import random
+import re
+import resource
+import struct
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.utils.text import slugify
+
+from botbot.apps.bots.models import Channel, ChatBot
+from .models import ActivePlugin, Plugin
+from .runner import PluginRunner
+from .transport import StreamTransport
+from .wire import decode_packet, encode_packet
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+# Kinds of synthetic lines and how often they come up
+DEFAULT_MIX = (('message', 85), ('mention', 5), ('command', 5), ('join', 5))
+DEFAULT_PLUGINS = ('logger', 'ping', 'bangmotivate')
+
+# A MONITOR line: <time> [<db> <client>] "<arg>" "<arg>" ...
+MONITOR_LINE = re.compile(rb'^[\d.]+ \[(\d+) [^\]]*\] (.*)$', re.S)
+MONITOR_ARG = re.compile(rb'"((?:[^"\\]|\\.)*)"', re.S)
+MONITOR_ESCAPE = re.compile(rb'\\(x[0-9a-fA-F]{2}|.)', re.S)
+MONITOR_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'a': b'\a',
+                   b'b': b'\b'}
+
+
+def _unescape(match):
+    escape = match.group(1)
+    if len(escape) == 3 and escape[:1] == b'x':
+        return bytes([int(escape[1:], 16)])
+    return MONITOR_ESCAPES.get(escape, escape)
+
+
+def parse_monitor_line(line):
+    """
+    Returns the database and the arguments of a command echoed by MONITOR,
+    or None for anything else
+    """
+    if isinstance(line, str):
+        line = line.encode('utf-8')
+    match = MONITOR_LINE.match(line)
+    if not match:
+        return None
+    return int(match.group(1)), [
+        MONITOR_ESCAPE.sub(_unescape, arg)
+        for arg in MONITOR_ARG.findall(match.group(2))]
+
+
+def monitor_packets(bus, key):
+    """
+    Yields the packets pushed onto the ``key`` list, as seen through
+    MONITOR, and None every idle second. MONITOR slows Redis down, keep
+    recordings short.
+    """
+    db = bus.connection_pool.connection_kwargs.get('db', 0)
+    key = key.encode('utf-8')
+    with bus.monitor() as monitor:
+        connection = monitor.connection
+        while True:
+            if not connection.can_read(timeout=1):
+                yield None
+                continue
+            command = parse_monitor_line(connection.read_response())
+            if command is None or command[0] != db:
+                continue
+            args = command[1]
+            if (len(args) > 2 and args[0].lower() in (b'rpush', b'lpush') and
+                    args[1] == key):
+                for packet in args[2:]:
+                    yield packet
+
+
+def stream_packets(bus, key):
+    """
+    Yields the packets added to the ``key`` stream from now on, and None
+    every idle second. Reading doesn't take them from the runners.
+    """
+    last_id = '$'
+    while True:
+        result = bus.xread({key: last_id}, block=1000)
+        if not result:
+            yield None
+            continue
+        for entry_id, fields in result[0][1]:
+            last_id = entry_id
+            packet = fields.get(StreamTransport.field)
+            if packet is not None:
+                yield packet
+
+
+def record(packets, path, seconds=0, count=0, clock=time.monotonic):
+    """
+    Writes the packets of a ``*_packets`` generator to a recording, for
+    ``seconds`` seconds and/or up to ``count`` packets. Returns the number
+    of packets written.
+    """
+    written = 0
+    start = clock()
+    with gzip.open(path, 'wt') as recording:
+        for packet in packets:
+            offset = clock() - start
+            if seconds and offset >= seconds:
+                break
+            if packet is None:
+                continue
+            try:
+                packet = decode_packet(packet)
+            except (ValueError, struct.error):
+                LOG.warning('Skipping a packet that can\'t be decoded: %r',
+                            packet)
+                continue
+            recording.write(json.dumps({'t': round(offset, 6),
+                                        'packet': packet}) + '\n')
+            written += 1
+            if count and written >= count:
+                break
+    return written
+
+
+def read_recording(path):
+    """Returns the (offset, packet) pairs of a recording"""
+    with gzip.open(path, 'rt') as recording:
+        entries = [json.loads(line) for line in recording if line.strip()]
+    return [(entry['t'], entry['packet']) for entry in entries]
+
+
+def parse_mix(value):
+    """Parses a line mix, e.g. message=80,mention=10,command=10"""
+    mix = []
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in dict(DEFAULT_MIX):
+            raise ValueError('unknown kind of line {0!r}'.format(kind))
+        mix.append((kind, float(weight or 1)))
+    return tuple(mix)
+
+
+def synthetic_packets(count, rate=100, channels=3, mix=DEFAULT_MIX,
+                      nick='BrainzBot', chatbot_id=1, users=20, seed=0):
+    """
+    Returns ``count`` (offset, packet) pairs arriving at ``rate`` lines
+    per second, spread over ``channels`` channels, with kinds of lines
+    picked according to ``mix``
+    """
+    rng = random.Random(seed)
+    kinds, weights = zip(*mix)
+    texts = {
+        'message': 'hello world {n}',
+        'mention': '{nick}: ping',
+        'command': settings.COMMAND_PREFIX + 'm {user}',
+        'join': '',
+    }
+    packets = []
+    for n in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        channel = '#load-{0}'.format(rng.randrange(channels))
+        user = 'user{0}'.format(rng.randrange(users))
+        text = texts[kind].format(n=n, nick=nick, user=user)
+        command = 'JOIN' if kind == 'join' else 'PRIVMSG'
+        packets.append((n / rate, {
+            'ChatBotId': chatbot_id,
+            'Raw': ':{0}!{0}@example.com {1} {2} :{3}'.format(
+                user, command, channel, text),
+            'Received': None,
+            'User': user,
+            'Host': 'example.com',
+            'Channel': channel,
+            'Command': command,
+            'Content': text,
+        }))
+    return packets
+
+
+def prepare_channels(packets, plugins=DEFAULT_PLUGINS, nick='BrainzBot'):
+    """
+    Creates the chatbots and channels the packets refer to, with the
+    given plugins active
+    """
+    plugin_objects = [
+        Plugin.objects.get_or_create(slug=slug, defaults={'name': slug})[0]
+        for slug in plugins]
+    channels = set((packet['ChatBotId'], packet['Channel'].strip())
+                   for _, packet in packets)
+    for chatbot_id in set(chatbot_id for chatbot_id, _ in channels):
+        ChatBot.objects.get_or_create(pk=chatbot_id, defaults={
+            'server': 'irc.example.net:6697', 'nick': nick,
+            'real_name': nick, 'is_active': True})
+    for index, (chatbot_id, name) in enumerate(sorted(channels)):
+        channel = Channel.objects.create(
+            chatbot_id=chatbot_id, name=name, status=Channel.ACTIVE,
+            is_public=True,
+            slug=slugify(name) or 'channel-{0}'.format(index))
+        for plugin in plugin_objects:
+            ActivePlugin.objects.create(channel=channel, plugin=plugin)
+
+
+def received_timestamp(now):
+    """Formats a UNIX timestamp the way the bot does"""
+    return datetime.datetime.fromtimestamp(
+        now, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f000Z')
+
+
+class ReplayRunner(PluginRunner):
+    """
+    A plugin runner reading its queue off fakeredis, keeping the latency
+    of its plugin calls per router
+    """
+
+    def __init__(self, **kwargs):
+        import fakeredis
+        kwargs['transport'] = 'list'
+        super(ReplayRunner, self).__init__(**kwargs)
+        # For the time spent per stage
+        self.track_latency = True
+        server = fakeredis.FakeServer()
+        self.bot_bus = fakeredis.FakeStrictRedis(server=server, db=1)
+        self.storage = fakeredis.FakeStrictRedis(server=server, db=0)
+        # Router per (plugin slug, method name)
+        self.route_routers = {}
+        # Seconds from a line being queued to the end of each call, per
+        # router
+        self.router_latencies = collections.defaultdict(list)
+
+    def register(self, plugin):
+        super(ReplayRunner, self).register(plugin)
+        for router in self.routers.values():
+            for routes in router.plugins.values():
+                for route in routes:
+                    self.route_routers[(route.slug, route.func.__name__)] = (
+                        route.router_name)
+
+    def record_call_time(self, slug, name, line, seconds):
+        super(ReplayRunner, self).record_call_time(slug, name, line, seconds)
+        self.router_latencies[self.route_routers.get((slug, name))].append(
+            time.time() - line._received.timestamp())
+
+
+def replay(runner, packets, speed=1, binary=False, clock=time.monotonic,
+           sleep=None):
+    """
+    Feeds (offset, packet) pairs through the runner's queue, ``speed``
+    times faster than they arrived, in the binary wire encoding if
+    ``binary``. With ``speed=0``, a batch is fed whenever the queue is
+    empty, as fast as the runner takes them.
+
+    Returns the seconds it took the runner to go through them.
+    """
+    if sleep is None:
+        sleep = runner.gevent.sleep if hasattr(runner, 'gevent') else (
+            time.sleep)
+    bus = runner.bot_bus
+    pending = collections.deque(sorted(packets, key=lambda entry: entry[0]))
+    start = clock()
+    while True:
+        elapsed = clock() - start
+        due = []
+        if speed:
+            while pending and pending[0][0] / speed <= elapsed:
+                due.append(pending.popleft()[1])
+        elif not bus.llen(runner.queue_key):
+            while pending and len(due) < runner.transport.batch_size:
+                due.append(pending.popleft()[1])
+        if due:
+            received = received_timestamp(time.time())
+            bus.rpush(runner.queue_key, *[
+                encode_packet(dict(packet, Received=received), binary)
+                for packet in due])
+        if bus.llen(runner.queue_key):
+            runner.process_packets(runner.fetch_packets())
+            # Lets the greenlets of the lanes run
+            sleep(0)
+        elif pending:
+            sleep(max(0, min(1, pending[0][0] / speed - elapsed)))
+        else:
+            break
+        runner.tick()
+    runner.close()
+    return clock() - start
+
+
+def percentiles(values, quantiles=(0.5, 0.9, 0.99)):
+    values = sorted(values)
+    return {q: values[min(len(values) - 1, int(q * len(values)))]
+            for q in quantiles}
+
+
+def report(runner, lines, seconds):
+    """Returns the results of a replay as lines of text"""
+    output = ['{0} lines in {1:.2f}s, {2:.1f} lines/s'.format(
+        lines, seconds, lines / seconds if seconds else 0)]
+    for router, latencies in sorted(runner.router_latencies.items(),
+                                    key=lambda item: str(item[0])):
+        output.append('{0}: {1} calls, latency {2}'.format(
+            router, len(latencies), ', '.join(
+                'p{0:g}={1:.4f}s'.format(q * 100, value)
+                for q, value in percentiles(latencies).items())))
+    if runner.latency.stages:
+        output.append('Time per stage: {0}'.format(', '.join(
+            '{0}={1:.3f}s'.format(stage, total)
+            for stage, total in runner.latency.stages.most_common())))
+    return output
+
+
+def report_memory(limit=10):
+    """
+    Returns the peak memory use, and the biggest allocation sites if
+    tracemalloc is tracing, as lines of text
+    """
+    output = ['Max RSS: {0:.1f} MiB'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)]
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        output.append('Traced memory: {0:.1f} MiB, peak {1:.1f} MiB'.format(
+            current / 2 ** 20, peak / 2 ** 20))
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),))
+        output.extend(str(stat)
+                      for stat in snapshot.statistics('lineno')[:limit])
+    return output
+
+
+def report_pools():
+    """Returns the use of the database connection pools as lines of text"""
+    from .pooled_postgresql.base import pools
+    return ['Database pool {0}: {1} connections, {2} checkouts, {3} waited '
+            '{4:.2f}s in all, {5} timed out'.format(
+                alias, pool.opened, pool.checkouts, pool.waits,
+                pool.wait_seconds, pool.timeouts)
+            for (alias, _), pool in sorted(pools().items())]
@@ -1,21 +1,46 @@
 # pylint: disable=W0212
-import json
+import asyncio
+import collections
+import functools
+import inspect
 import logging
 
 import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from importlib import import_module
 
 import redis
 import botbot_plugins.plugins
 from django.core.cache import cache
 from django.conf import settings
+from django.db import connections
 
 from botbot.apps.bots import models as bots_models
-from botbot.apps.plugins.utils import convert_nano_timestamp, log_on_error
+from botbot.apps.plugins.utils import (convert_nano_timestamp, fold_case,
+                                      required_literals)
+from . import metrics, offload
+from .latency import LatencyTracker
+from .logbuffer import LogBuffer
+from .outbound import (HIGH_PRIORITY, LOW_PRIORITY, OutboundScheduler,
+                       write_command)
 from .plugin import RealPluginMixin
+from .profiling import Profiler
+from .registry import ChannelRegistry
+from .shedding import DEFER_FIREHOSE, SKIP_NON_ESSENTIAL, ShedPolicy
+from .transport import ListTransport, StreamTransport
+from .wire import decode_packet
 
 
 CACHE_TIMEOUT_2H = 7200
+# Someone is waiting for the replies of these routers
+HIGH_PRIORITY_ROUTERS = ('mentions', 'commands', 'regex_commands')
 LOG = logging.getLogger('botbot.plugin_runner')
 
 
@@ -25,15 +50,143 @@ class Router(object):
     """
     def __init__(self, name):
         self.name = name
+        # routes per plugin slug, in registration order
         self.plugins = {}
 
+
+class Route(object):
+    """
+    A plugin method registered with a router, with its rule compiled
+    """
+    def __init__(self, router_name, rule, func, plugin):
+        self.router_name = router_name
+        self.priority = (HIGH_PRIORITY if router_name in HIGH_PRIORITY_ROUTERS
+                         else LOW_PRIORITY)
+        self.rule = rule
+        self.func = func
+        self.plugin = plugin
+        # Runs in the process pool, if the runner has one
+        self.cpu_bound = getattr(func, 'cpu_bound', False)
+        self.command = None
+        self.regex = None
+        if router_name == "commands":
+            self.command = rule
+        elif router_name == "regex_commands":
+            self.command = rule[0]
+            self.regex = re.compile(rule[1], re.IGNORECASE)
+        elif router_name != "firehose":
+            self.regex = re.compile(rule, re.IGNORECASE)
+
+        # Literals the text must contain for the regex to possibly match,
+        # either declared on the decorator or extracted from the pattern
+        literals = getattr(func, 'route_literals', None)
+        if literals is None and self.regex is not None:
+            literals = required_literals(self.regex.pattern)
+        self.literals = tuple(fold_case(literal)
+                              for literal in literals or () if literal)
+
+    @property
+    def slug(self):
+        return self.plugin.slug
+
+    def match(self, text, folded_text):
+        """
+        Matches the route's regex against the text, unless the case-folded
+        text lacks one of the required literals
+        """
+        for literal in self.literals:
+            if literal not in folded_text:
+                return None
+        return self.regex.match(text)
+
+
+class DispatchPlan(object):
+    """
+    The routes that apply to a set of active plugins, grouped so that
+    a line only needs a few lookups to find its candidate routes
+    """
+    def __init__(self, routers, active_slugs):
+        self.firehose = self._routes(routers["firehose"], active_slugs)
+        self.messages = self._routes(routers["messages"], active_slugs)
+        self.mentions = self._routes(routers["mentions"], active_slugs)
+        self.commands = self._by_command(routers["commands"], active_slugs)
+        self.regex_commands = self._by_command(routers["regex_commands"],
+                                               active_slugs)
+
+    @staticmethod
+    def _routes(router, active_slugs):
+        return [route
+                for slug, routes in router.plugins.items()
+                if slug in active_slugs
+                for route in routes]
+
+    @classmethod
+    def _by_command(cls, router, active_slugs):
+        commands = {}
+        for route in cls._routes(router, active_slugs):
+            commands.setdefault(route.command, []).append(route)
+        return commands
+
+
+@functools.lru_cache(maxsize=256)
+def direct_message_regex(nick):
+    """Matches lines addressed to ``nick``, the rest of the line is group 1"""
+    if len(nick) == 1:
+        # support @<plugin> or !<plugin>
+        regex = r'^{0}(.*)'.format(re.escape(nick))
+    else:
+        # support <nick>: <plugin>
+        regex = r'^{0}[:\s](.*)'.format(re.escape(nick))
+    return re.compile(regex, re.IGNORECASE)
+
+
+# Marks the lazy attributes of a Line that haven't been computed yet
+_UNSET = object()
+
+
+class PendingBatch(object):
+    """
+    Queue entries of a batch, acknowledged once every call holding the
+    batch (its dispatch, then the plugin calls of its lines) has released
+    it and the log rows added until then are written
+    """
+    __slots__ = ('ids', 'started', 'calls', 'log_mark', 'lock')
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.started = time.monotonic()
+        # Held by the dispatch until process_packets is done with it
+        self.calls = 1
+        # LogBuffer.added once the calls are done, see ack_batches
+        self.log_mark = None
+        self.lock = threading.Lock()
+
+    def hold(self):
+        with self.lock:
+            self.calls += 1
+
+    def release(self):
+        with self.lock:
+            self.calls -= 1
+
+
 class Line(object):
     """
     All the methods and data necessary for a plugin to act on a line
+
+    Lines are built for every packet, most of them only go through the
+    firehose, so anything that isn't needed to get there is computed the
+    first time it is used.
     """
+    __slots__ = ('app', 'full_text', 'user', '_chatbot_id', '_raw',
+                 '_channel_name', '_command', '_is_message', '_host',
+                 '_received_raw', '_received_cache', '_text',
+                 '_is_direct_message', '_chatbot_cache', '_channel_cache',
+                 '_active_plugin_slugs_cache', '_timings', '_batch')
+
     def __init__(self, packet, app):
+        self.app = app
         self.full_text = packet['Content']
-        self.text = packet['Content']
         self.user = packet['User']
 
         # Private attributes not accessible to external plugins
@@ -43,20 +196,74 @@ class Line(object):
         self._command = packet['Command']
         self._is_message = packet['Command'] == 'PRIVMSG'
         self._host = packet['Host']
+        self._received_raw = packet['Received']
 
-        self._received = convert_nano_timestamp(packet['Received'])
-
-        self.is_direct_message = self.check_direct_message()
+        self._received_cache = _UNSET
+        self._text = self.full_text
+        self._is_direct_message = _UNSET
+        self._chatbot_cache = _UNSET
+        self._channel_cache = _UNSET
+        self._active_plugin_slugs_cache = _UNSET
+        # Stage timings, see PluginRunner.process_packet
+        self._timings = None
+        # Queue entries the line came with, see PluginRunner.process_packets
+        self._batch = None
 
     def is_valid(self):
         if self._chatbot and self._channel:
             return True
         return False
 
+    def _resolve_direct_message(self):
+        if self._is_direct_message is _UNSET:
+            self._is_direct_message = self.check_direct_message()
+        return self._is_direct_message
+
+    def _resolve_private_message(self):
+        """Cheap nick comparison, without the direct message regex"""
+        if (self._is_direct_message is _UNSET
+                and self._channel_name == self._chatbot.nick):
+            LOG.debug('Private message detected')
+            # Set channel as user, so plugins reply by PM to correct user
+            self._channel_name = self.user
+            self._is_direct_message = True
+
+    @property
+    def text(self):
+        """The text of the line, without the bot's nick if addressed to it"""
+        self._resolve_direct_message()
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+
+    @property
+    def is_direct_message(self):
+        return self._resolve_direct_message()
+
+    @property
+    def _received(self):
+        if self._received_cache is _UNSET:
+            self._received_cache = convert_nano_timestamp(self._received_raw)
+        return self._received_cache
+
+    @property
+    def _registry(self):
+        return getattr(self.app, 'registry', None)
+
     @property
     def _chatbot(self):
         """Simple caching for ChatBot model"""
-        if not hasattr(self, '_chatbot_cache'):
+        if self._chatbot_cache is _UNSET:
+            registry = self._registry
+            if registry is not None:
+                chatbot = registry.chatbot(self._chatbot_id)
+                if chatbot is None:
+                    LOG.warning('Chatbot %s does not exist. Line dropped.',
+                                self._chatbot_id)
+                self._chatbot_cache = chatbot
+                return chatbot
             cache_key = 'chatbot:{0}'.format(self._chatbot_id)
             chatbot = cache.get(cache_key)
             if not chatbot:
@@ -64,8 +271,8 @@ class Line(object):
                     chatbot = bots_models.ChatBot.objects.get(
                         id=self._chatbot_id)
                 except bots_models.ChatBot.DoesNotExist:
-                    LOG.warn('Chatbot %s does not exist. Line dropped.',
-                             self._chatbot_id)
+                    LOG.warning('Chatbot %s does not exist. Line dropped.',
+                                self._chatbot_id)
                     return None
                 cache.set(cache_key, chatbot, CACHE_TIMEOUT_2H)
             self._chatbot_cache = chatbot
@@ -74,7 +281,21 @@ class Line(object):
     @property
     def _channel(self):
         """Simple caching for Channel model"""
-        if not hasattr(self, '_channel_cache'):
+        if self._channel_cache is _UNSET:
+            if not self._chatbot:
+                return None
+            # Private messages are looked up by the user they came from
+            self._resolve_private_message()
+            registry = self._registry
+            if registry is not None:
+                channel = registry.channel(self._chatbot_id,
+                                           self._channel_name)
+                if channel is None and self._channel_name.startswith('#'):
+                    LOG.warning('Chatbot %s should not be listening to %s. '
+                                'Line dropped.',
+                                self._chatbot_id, self._channel_name)
+                self._channel_cache = channel
+                return channel
             cache_key = 'channel:{0}-{1}'.format(self._chatbot_id, self._channel_name)
             channel = cache.get(cache_key)
 
@@ -83,9 +304,9 @@ class Line(object):
                     channel = self._chatbot.channel_set.get(
                         name=self._channel_name)
                 except self._chatbot.channel_set.model.DoesNotExist:
-                    LOG.warn('Chatbot %s should not be listening to %s. '
-                             'Line dropped.',
-                             self._chatbot_id, self._channel_name)
+                    LOG.warning('Chatbot %s should not be listening to %s. '
+                                'Line dropped.',
+                                self._chatbot_id, self._channel_name)
                     return None
                 cache.set(cache_key, channel, CACHE_TIMEOUT_2H)
 
@@ -104,7 +325,7 @@ class Line(object):
 
     @property
     def _active_plugin_slugs(self):
-        if not hasattr(self, '_active_plugin_slugs_cache'):
+        if self._active_plugin_slugs_cache is _UNSET:
             if self._channel:
                 self._active_plugin_slugs_cache = self._channel.active_plugin_slugs
             else:
@@ -116,27 +337,20 @@ class Line(object):
         If message is addressed to the bot, strip the bot's nick
         and return the rest of the message. Otherwise, return False.
         """
-
-        nick = self._chatbot.nick
+        chatbot = self._chatbot
+        if not chatbot:
+            return False
+        nick = chatbot.nick
 
         # Private message
-        if self._channel_name == nick:
-            LOG.debug('Private message detected')
-            # Set channel as user, so plugins reply by PM to correct user
-            self._channel_name = self.user
-
+        self._resolve_private_message()
+        if self._is_direct_message is True:
             return True
 
-        if len(nick) == 1:
-            # support @<plugin> or !<plugin>
-            regex = r'^{0}(.*)'.format(re.escape(nick))
-        else:
-            # support <nick>: <plugin>
-            regex = r'^{0}[:\s](.*)'.format(re.escape(nick))
-        match = re.match(regex, self.full_text, re.IGNORECASE)
+        match = direct_message_regex(nick).match(self.full_text)
         if match:
             LOG.debug('Direct message detected')
-            self.text = match.groups()[0].lstrip()
+            self._text = match.group(1).lstrip()
             return True
         return False
 
@@ -153,10 +367,47 @@ class PluginRunner(object):
     Calls to plugins are done via greenlets
     """
 
-    def __init__(self, use_gevent=False):
+    def __init__(self, use_gevent=False, batch_size=1, pool_size=100,
+                 plugin_timeout=30, plugin_concurrency=10, plugin_backlog=1000,
+                 queue_key=None,
+                 transport='list', stream_group='plugins', consumer=None,
+                 outbound_rate=0, outbound_burst=5, outbound_backlog=50,
+                 coalesce_length=0, command_pool_size=20, lane_backlog=10000,
+                 shed_depth=(), shed_lag=(), shed_backlog=100000,
+                 slow_line_threshold=0, profile_dir=None, profile_seconds=30,
+                 cpu_workers=0, db_pool_size=0, db_pool_timeout=10,
+                 log_batch_size=500, log_batch_delay=0.2):
         if use_gevent:
             import gevent
+            from .lanes import Lane
             self.gevent = gevent
+            # Replies to commands and mentions don't wait for the bulk of
+            # the work (logging, message regexes) to make room
+            self.lanes = {
+                HIGH_PRIORITY: Lane(HIGH_PRIORITY, command_pool_size,
+                                    lane_backlog),
+                LOW_PRIORITY: Lane(LOW_PRIORITY, pool_size, lane_backlog),
+            }
+        # Defaults for plugins that don't set call_timeout/max_concurrency
+        self.plugin_timeout = plugin_timeout
+        self.plugin_concurrency = plugin_concurrency
+        # Calls running and calls waiting for their turn per plugin slug
+        self.plugin_calls = collections.Counter()
+        self.plugin_waiting = collections.Counter()
+        # Calls over their plugin's limit per (plugin slug, priority), up
+        # to plugin_backlog per plugin (gevent)
+        self.plugin_queues = collections.defaultdict(collections.deque)
+        self.plugin_backlog = plugin_backlog
+        # Database connections are shared by the plugin calls, if enabled
+        self.db_pool_size = db_pool_size
+        if db_pool_size:
+            from .pooled_postgresql.base import install
+            install(db_pool_size, db_pool_timeout)
+        # Processes for the CPU bound plugin methods, if enabled
+        self.cpu_workers = cpu_workers
+        self.cpu_pool = None
+        if cpu_workers:
+            self.cpu_pool = offload.create_pool(cpu_workers)
         self.bot_bus = redis.StrictRedis.from_url(
             settings.REDIS_PLUGIN_QUEUE_URL)
         self.storage = redis.StrictRedis.from_url(
@@ -164,6 +415,69 @@ class PluginRunner(object):
 
         self.command_prefix = settings.COMMAND_PREFIX
 
+        if transport == 'stream':
+            self.transport = StreamTransport(
+                key=queue_key or 'q:stream', batch_size=batch_size,
+                group=stream_group, consumer=consumer)
+        else:
+            self.transport = ListTransport(key=queue_key or 'q',
+                                           batch_size=batch_size)
+
+        # RealPlugin class per plugin class
+        self.plugin_classes = {}
+        # (fingerprint, config, plugin instance) per (channel id, plugin slug)
+        self.channel_plugins = {}
+        # DispatchPlan per set of active plugin slugs
+        self.dispatch_plans = {}
+        # Responses held back until the current batch is dispatched
+        self.outbound = None
+        # Low priority plugin calls held back until the high priority
+        # ones of the current batch are started
+        self.deferred = None
+        # Paces responses per target, if enabled
+        self.outbound_scheduler = None
+        if outbound_rate:
+            self.outbound_scheduler = OutboundScheduler(
+                rate=outbound_rate, burst=outbound_burst,
+                max_backlog=outbound_backlog,
+                coalesce_length=coalesce_length)
+        # Degrades to fewer plugin calls while behind, if enabled
+        self.shedding = None
+        if shed_depth or shed_lag:
+            self.shedding = ShedPolicy(shed_depth, shed_lag)
+        # Firehose calls put aside while shedding, at most shed_backlog
+        self.shed_firehose = collections.deque()
+        self.shed_backlog = shed_backlog
+        # Shed decisions per (decision, plugin slug)
+        self.shed_counts = collections.Counter()
+        # Age of the oldest line since the last tick, in seconds
+        self.line_lag = 0
+        self.report_interval = 60
+        self.last_report = time.monotonic()
+        # Latency per channel, from the bot receiving a line to the end of
+        # its plugin calls. Only tracked for the slow line log or the
+        # metrics, it takes parsing every line's timestamp.
+        self.latency = LatencyTracker(slow_threshold=slow_line_threshold)
+        self.track_latency = bool(slow_line_threshold)
+        # Timings of the lines of the current batch
+        self.batch_timings = None
+        # The current batch, and those dispatched but not acknowledged yet
+        self.batch = None
+        self.unacked = collections.deque()
+        # Rows of the logger plugin, written in batches if enabled
+        self.log_buffer = None
+        if log_batch_size:
+            self.log_buffer = LogBuffer(log_batch_size, log_batch_delay,
+                                        record_time=self.latency.add_stage)
+        # Set by stop(), listen() returns once it's done with the batch
+        self.stopping = False
+        # CPU and memory profiles on SIGUSR1/SIGUSR2, once installed
+        self.profiler = Profiler(profile_dir, profile_seconds)
+        self.metrics = metrics.PluginRunnerMetrics()
+        self.metrics.collectors.append(self.collect_metrics)
+        # In-memory chatbots and channels, see load_registry
+        self.registry = None
+
         self.routers = {
             # plugins that listen to everything coming over the wire
             "firehose": Router("firehose"),
@@ -208,123 +522,901 @@ class PluginRunner(object):
                          plugin.slug, key, router_name, rule)
 
                 self.routers[router_name].plugins.setdefault(
-                    plugin.slug, []).append((rule, attr, plugin))
+                    plugin.slug, []).append(
+                        Route(router_name, rule, attr, plugin))
+        # Plans depend on the registered routes
+        self.dispatch_plans.clear()
+
+    def dispatch_plan(self, active_slugs):
+        """Returns the (cached) dispatch plan for a set of active plugins"""
+        active_slugs = frozenset(active_slugs)
+        try:
+            return self.dispatch_plans[active_slugs]
+        except KeyError:
+            plan = DispatchPlan(self.routers, active_slugs)
+            self.dispatch_plans[active_slugs] = plan
+            return plan
+
+    def serve_metrics(self, port):
+        """Serves the metrics in the Prometheus text format"""
+        self.track_latency = True
+        metrics.serve(self.metrics, port)
+
+    def collect_metrics(self):
+        """Updates the gauges that are read when the metrics are served"""
+        self.metrics.queue_depth.set(self.queue_length)
+        if self.shedding is not None:
+            self.metrics.shed_level.set(self.shedding.level)
+        if self.outbound_scheduler is not None:
+            self.metrics.outbound_backlog.set(sum(
+                length for length, _ in
+                self.outbound_scheduler.backlog().values()))
+        for (chatbot_id, channel), quantiles in (
+                self.latency.percentiles().items()):
+            for quantile, seconds in quantiles.items():
+                self.metrics.line_latency.set(seconds, chatbot_id, channel,
+                                              quantile)
+        for stage, seconds in list(self.latency.stages.items()):
+            self.metrics.stage_seconds.set(seconds, stage)
+        if hasattr(self, 'gevent'):
+            for slug, running in list(self.plugin_calls.items()):
+                self.metrics.plugin_running.set(running, slug)
+                self.metrics.plugin_waiting.set(self.plugin_waiting[slug],
+                                                slug)
+            for name, lane in self.lanes.items():
+                self.metrics.lane_running.set(lane.running, name)
+                self.metrics.lane_queued.set(lane.queued, name)
+        if self.log_buffer is not None:
+            self.metrics.log_buffered.set(len(self.log_buffer))
+            self.metrics.log_flushed.set(self.log_buffer.flushed)
+            self.metrics.log_dropped.set(self.log_buffer.dropped)
+        if self.db_pool_size:
+            from .pooled_postgresql.base import pools
+            for (alias, _), pool in pools().items():
+                self.metrics.db_pool_connections.set(len(pool.idle), alias,
+                                                     'idle')
+                self.metrics.db_pool_connections.set(pool.in_use, alias,
+                                                     'in_use')
+                self.metrics.db_pool_checkouts.set(pool.checkouts, alias)
+                self.metrics.db_pool_waits.set(pool.waits, alias)
+                self.metrics.db_pool_timeouts.set(pool.timeouts, alias)
+                self.metrics.db_pool_wait_seconds.set(pool.wait_seconds,
+                                                      alias)
+
+    def load_registry(self):
+        """
+        Routes lines with an in-memory copy of the chatbots and channels
+        instead of looking them up in the cache and the database
+        """
+        self.registry = ChannelRegistry(self.bot_bus)
+        self.registry.load()
 
     def listen(self):
-        """Listens for incoming messages on the Redis queue"""
-        while 1:
-            val = None
+        """Listens for incoming messages on the Redis queue until stopped"""
+        while not self.stopping:
+            packets = []
             try:
-                val = self.bot_bus.blpop('q', 1)
+                packets = self.fetch_packets()
+            except Exception:
+                LOG.error("Queue read failed", exc_info=True)
+            self.process_packets(packets)
+            self.tick()
+        self.close()
 
-                # Track q length
-                ql = self.bot_bus.llen('q')
+    def stop(self, signum=None, frame=None):
+        """Makes listen() return, e.g. on SIGTERM"""
+        self.stopping = True
 
-                if val:
-                    _, val = val
-                    LOG.debug('Received: %s', val)
-                    line = Line(json.loads(val), self)
+    def close(self):
+        """Waits for the plugin calls in progress, writes the buffered logs"""
+        LOG.info('Stopping plugins')
+        if hasattr(self, 'lanes'):
+            for lane in self.lanes.values():
+                lane.join()
+        if self.log_buffer is not None:
+            self.log_buffer.flush()
+        self.ack_batches()
 
-                    if line.is_valid():
-                        self.dispatch(line)
+    def ack_batches(self):
+        """
+        Acknowledges the batches whose plugin calls are done and whose log
+        rows are written, so that those of a crashed runner are delivered
+        again. Batches held up for longer than the transport's
+        ``max_hold``, e.g. by a hung call, are acknowledged anyway rather
+        than claimed and run again by the other consumers.
+        """
+        ready = []
+        held = collections.deque()
+        now = time.monotonic()
+        max_hold = self.transport.max_hold
+        for batch in self.unacked:
+            done = not batch.calls
+            if done and self.log_buffer is not None:
+                if batch.log_mark is None:
+                    batch.log_mark = self.log_buffer.added
+                done = self.log_buffer.settled_upto(batch.log_mark)
+            if not done and max_hold is not None and (
+                    now - batch.started >= max_hold):
+                LOG.warning('Giving up on %s queue entries held for %.0fs, '
+                            'acknowledging them', len(batch.ids),
+                            now - batch.started)
+                done = True
+            if done:
+                ready.append(batch)
+            else:
+                held.append(batch)
+        self.unacked = held
+        if ready:
+            try:
+                self.transport.ack(self.bot_bus, [
+                    entry_id for batch in ready for entry_id in batch.ids])
             except Exception:
-                LOG.error("Line Dispatch Failed", exc_info=True, extra={
-                    "line": val
-                })
+                LOG.error("Queue acknowledgement failed", exc_info=True)
+                # Tried again on the next tick
+                self.unacked.extend(ready)
+
+    def tick(self):
+        """
+        Housekeeping, called after every batch or at least once a second
+        when the queue is idle
+        """
+        self.profiler.tick()
+        if self.registry is not None:
+            try:
+                self.registry.poll()
+            except Exception:
+                LOG.error("Channel registry refresh failed", exc_info=True)
+        if self.shedding is not None:
+            self.update_shedding()
+        if self.outbound_scheduler is not None:
+            self.flush_responses()
+        if self.log_buffer is not None:
+            self.log_buffer.tick()
+            if self.db_pool_size:
+                connections.close_all()
+        self.ack_batches()
+        try:
+            self.transport.trim(self.bot_bus)
+        except Exception:
+            LOG.error("Queue trimming failed", exc_info=True)
+        now = time.monotonic()
+        if now - self.last_report >= self.report_interval:
+            self.last_report = now
+            if self.outbound_scheduler is not None:
+                self.report_backlog()
+            if self.shed_counts:
+                self.report_shedding()
+            self.report_latency()
+
+    def update_shedding(self):
+        """
+        Moves to the shedding level for the current lag, and once the
+        firehose is no longer deferred, catches up on the deferred calls
+        """
+        previous = self.shedding.level
+        level = self.shedding.update(self.queue_length, self.line_lag)
+        if level != previous:
+            LOG.warning('Load shedding level %s -> %s (%s lines queued, '
+                        'lag %.1fs)', previous, level, self.queue_length,
+                        self.line_lag)
+            self.shed_counts['level_{0}'.format(level), None] += 1
+        self.line_lag = 0
+        if level < DEFER_FIREHOSE and self.shed_firehose:
+            # A batch worth of calls per tick, not to fall behind again
+            for _ in range(min(len(self.shed_firehose),
+                               self.transport.batch_size * 10)):
+                line, route, arg_dict = self.shed_firehose.popleft()
+                try:
+                    self.run_plugin(line, route, arg_dict)
+                except Exception:
+                    LOG.error("Plugin call failed [%s.%s]", route.slug,
+                              route.func.__name__, exc_info=True)
+                finally:
+                    batch = getattr(line, '_batch', None)
+                    if batch is not None:
+                        batch.release()
+
+    def shed(self, line, route, arg_dict):
+        """
+        Returns True if the plugin call is shed at the current level:
+        skipped, or put aside if it's a firehose call
+        """
+        level = self.shedding.level
+        if level >= SKIP_NON_ESSENTIAL and not route.plugin.essential:
+            decision = 'skipped'
+        elif (level >= DEFER_FIREHOSE and route.router_name == 'firehose' and
+                len(self.shed_firehose) < self.shed_backlog):
+            self.shed_firehose.append((line, route, arg_dict))
+            # Not acknowledged until the call is caught up on
+            batch = getattr(line, '_batch', None)
+            if batch is not None:
+                batch.hold()
+            decision = 'deferred'
+        else:
+            return False
+        self.shed_counts[decision, route.slug] += 1
+        self.metrics.shed.inc(decision, route.slug)
+        return True
+
+    def report_shedding(self):
+        """Logs the shed decisions so far"""
+        LOG.info('Load shedding: level %s, %s firehose calls deferred, %s',
+                 self.shedding.level, len(self.shed_firehose), ', '.join(
+                     '{0} {1}={2}'.format(decision, slug or '', count)
+                     for (decision, slug), count in
+                     sorted(self.shed_counts.items(), key=str)))
+
+    def report_latency(self):
+        """Logs the channels with the slowest lines"""
+        slowest = sorted(self.latency.percentiles().items(),
+                         key=lambda item: item[1][0.99], reverse=True)[:5]
+        if slowest:
+            LOG.info('Slowest channels (p50/p99): %s', ', '.join(
+                '{0} on {1}={2:.3f}s/{3:.3f}s'.format(
+                    channel, chatbot_id, quantiles[0.5], quantiles[0.99])
+                for (chatbot_id, channel), quantiles in slowest))
+
+    def report_backlog(self):
+        """Logs how far behind the responses to each target are"""
+        backlog = self.outbound_scheduler.backlog()
+        if backlog:
+            LOG.info('Outbound backlog: %s', ', '.join(
+                '{0} on {1}={2} ({3:.1f}s)'.format(target, chatbot_id,
+                                                   length, age)
+                for (chatbot_id, target), (length, age) in backlog.items()))
+
+    @property
+    def queue_key(self):
+        return self.transport.key
+
+    @property
+    def queue_length(self):
+        """Queue length as of the last read"""
+        return self.transport.length
+
+    def fetch_packets(self):
+        """Returns the next batch of raw packets, in arrival order"""
+        return self.transport.fetch(self.bot_bus)
+
+    def process_packets(self, packets):
+        """Dispatches a batch of raw packets in arrival order"""
+        self.outbound = []
+        self.deferred = []
+        self.batch_timings = []
+        ids = self.transport.take_batch()
+        if ids:
+            self.batch = PendingBatch(ids)
+            self.unacked.append(self.batch)
+        try:
+            for val in packets:
+                self.process_packet(val)
+            self.run_deferred()
+        finally:
+            self.deferred = None
+            start = time.perf_counter()
+            self.flush_responses()
+            flushed = time.perf_counter() - start
+            batch_timings, self.batch_timings = self.batch_timings, None
+            for timings in batch_timings:
+                timings.add('flush', flushed)
+                timings.release()
+            if self.batch is not None:
+                self.batch.release()
+                self.batch = None
+
+    def run_deferred(self):
+        """Runs the low priority calls held back during the batch"""
+        deferred, self.deferred = self.deferred, None
+        for line, route, arg_dict in deferred:
+            try:
+                self.run_plugin(line, route, arg_dict)
+            except Exception:
+                LOG.error("Plugin call failed [%s.%s]", route.slug,
+                          route.func.__name__, exc_info=True)
+
+    def schedule_plugin(self, line, route, arg_dict):
+        """
+        Runs a plugin method for a line. While a batch is dispatched, calls
+        that nobody is waiting for are held back until the end of it.
+        """
+        self.metrics.routed.inc(route.router_name)
+        if (self.shedding is not None and self.shedding.level and
+                self.shed(line, route, arg_dict)):
+            return
+        if self.deferred is not None and route.priority == LOW_PRIORITY:
+            self.deferred.append((line, route, arg_dict))
+        else:
+            self.run_plugin(line, route, arg_dict)
+
+    def push_responses(self, chatbot_id, target, lines, priority):
+        """
+        Sends lines of text to a target through the bot. Lines produced
+        while a batch is dispatched are held back and sent together at the
+        end of it. If enabled, the outbound scheduler holds back those over
+        the target's rate until they are due.
+        """
+        if self.outbound_scheduler is not None:
+            commands = self.outbound_scheduler.add(chatbot_id, target, lines,
+                                                   priority)
+        else:
+            commands = [write_command(chatbot_id, target, text)
+                        for text in lines]
+        if self.outbound is not None:
+            self.outbound.extend(commands)
+        elif commands:
+            # LPUSH of several values keeps their order for the bot's RPOP
+            self.bot_bus.lpush('bot', *commands)
+
+    def flush_responses(self):
+        """
+        Sends the commands held back during the batch, and those the
+        outbound scheduler lets through, in one push
+        """
+        commands, self.outbound = self.outbound or [], None
+        if self.outbound_scheduler is not None:
+            commands.extend(self.outbound_scheduler.due())
+        if commands:
+            self.bot_bus.lpush('bot', *commands)
+
+    def process_packet(self, val):
+        """Decodes a single raw packet and dispatches it"""
+        now = time.time()
+        start = time.perf_counter()
+        self.metrics.lines.inc()
+        try:
+            LOG.debug('Received: %s', val)
+            line = Line(decode_packet(val), self)
+            line._batch = self.batch
+            if self.track_latency:
+                self.dispatch_timed(line, now, start)
+            elif line.is_valid():
+                self.dispatch(line)
+            else:
+                self.metrics.lines_dropped.inc()
+        except Exception:
+            self.metrics.lines_dropped.inc()
+            LOG.error("Line Dispatch Failed", exc_info=True, extra={
+                "line": val
+            })
+        self.metrics.dispatch_seconds.observe(time.perf_counter() - start)
+
+    def dispatch_timed(self, line, now, start):
+        """
+        Dispatches a line taken off the queue at ``now`` (UNIX time) and
+        decoding since ``start`` (perf counter), timing its stages
+        """
+        decoded = time.perf_counter()
+        timings = line._timings = self.latency.start(
+            line._received.timestamp())
+        timings.add('queue', now - timings.received)
+        timings.add('decode', decoded - start)
+        # Held until the line is dispatched, see process_packets
+        timings.hold()
+
+        if line.is_valid():
+            resolved = time.perf_counter()
+            timings.add('resolve', resolved - decoded)
+            timings.key = (line._chatbot_id, line._channel_name)
+            self.dispatch(line)
+            timings.add('dispatch', time.perf_counter() - resolved)
+        else:
+            self.metrics.lines_dropped.inc()
+        if self.batch_timings is not None:
+            self.batch_timings.append(timings)
+        else:
+            timings.release()
 
     def dispatch(self, line):
         """Given a line, dispatch it to the right plugins & functions."""
-        # This is a pared down version of the `check_for_plugin_route_matches`
-        # method for firehose plugins (no regexing or return values)
-        active_firehose_plugins = line._active_plugin_slugs.intersection(
-            self.routers["firehose"].plugins.keys())
-        for plugin_slug in active_firehose_plugins:
-            for _, func, plugin in self.routers["firehose"].plugins[plugin_slug]:
-                # firehose gets everything, no rule matching
-                LOG.info('Match: %s.%s', plugin_slug, func.__name__)
-                channel_plugin = self.setup_plugin_for_channel(
-                    plugin.__class__, line)
-                new_func = log_on_error(LOG, getattr(channel_plugin,
-                                                     func.__name__))
-                if hasattr(self, 'gevent'):
-                    self.gevent.Greenlet.spawn(new_func, line)
-                else:
-                    channel_plugin.respond(new_func(line))
+        plan = self.dispatch_plan(line._active_plugin_slugs)
+        if self.shedding is not None and self.shedding.lag_thresholds:
+            self.line_lag = max(self.line_lag,
+                                time.time() - line._received.timestamp())
+
+        for route in plan.firehose:
+            # firehose gets everything, no rule matching
+            LOG.info('Match: %s.%s', route.slug, route.func.__name__)
+            self.schedule_plugin(line, route, {})
 
         # pass line to other routers
         if line._is_message:
-            self.check_for_plugin_route_matches(line, self.routers["messages"])
+            self.check_for_regex_matches(line, plan.messages)
 
             if line.is_direct_message:
-                self.check_for_plugin_route_matches(line, self.routers["mentions"])
+                self.check_for_regex_matches(line, plan.mentions)
 
             if line.text.startswith(self.command_prefix):
-                self.check_for_plugin_route_matches(line, self.routers["commands"])
-                self.check_for_plugin_route_matches(line, self.routers["regex_commands"])
+                self.check_for_command_matches(line, plan)
+
+    def check_for_regex_matches(self, line, routes):
+        """Calls the functions of the routes whose regex matches the line"""
+        if not routes:
+            return
+        folded_text = fold_case(line.text)
+        for route in routes:
+            match = route.match(line.text, folded_text)
+            if match:
+                LOG.info('Match: %s.%s', route.slug, route.func.__name__)
+                self.schedule_plugin(line, route, match.groupdict())
+
+    def check_for_command_matches(self, line, plan):
+        """Calls the functions listening to the command the line starts with"""
+        args = line.text.split()
+        if not args or not args[0].startswith(self.command_prefix):
+            return
+        cmd = args[0][len(self.command_prefix):]
+
+        for route in plan.commands.get(cmd, ()):
+            LOG.info('Command: %s.%s', route.slug, route.func.__name__)
+            # We need a dict as run_plugin will unpack it
+            self.schedule_plugin(line, route, {"args": args[1:]})
+
+        regex_routes = plan.regex_commands.get(cmd)
+        if regex_routes:
+            linetext = " ".join(args[1:])
+            folded_text = fold_case(linetext)
+            for route in regex_routes:
+                match = route.match(linetext, folded_text)
+                if match:
+                    LOG.info('Command+Match: %s.%s',
+                             route.slug, route.func.__name__)
+                    self.schedule_plugin(line, route, match.groupdict())
 
     def setup_plugin_for_channel(self, fake_plugin_class, line):
-        """Given a dummy plugin class, initialize it for the line's channel"""
-        class RealPlugin(RealPluginMixin, fake_plugin_class):
-            pass
-        plugin = RealPlugin(slug=fake_plugin_class.__module__.split('.')[-1],
-                            channel=line._channel,
-                            chatbot_id=line._chatbot_id,
-                            app=self)
+        """
+        Given a dummy plugin class, return an initialized instance for the
+        line's channel. Instances are reused until the channel's fingerprint
+        or the plugin's configuration changes.
+        """
+        slug = fake_plugin_class.__module__.split('.')[-1]
+        channel = line._channel
+        plugin_config = channel.plugin_config(slug)
+        cache_key = (channel.pk, slug)
+        cached = self.channel_plugins.get(cache_key)
+        if cached:
+            fingerprint, config, plugin = cached
+            if fingerprint == channel.fingerprint and config == plugin_config:
+                return plugin
+
+        LOG.debug('Setting up %s for %s', slug, channel.name)
+        plugin = self.real_plugin_class(fake_plugin_class)(
+            slug=slug,
+            channel=channel,
+            chatbot_id=line._chatbot_id,
+            app=self)
         plugin.initialize()
+        self.channel_plugins[cache_key] = (
+            channel.fingerprint, plugin_config, plugin)
         return plugin
 
-    def run_plugin(self, line, plugin, plugin_slug, func, arg_dict):
+    def real_plugin_class(self, fake_plugin_class):
+        """Returns the plugin class combined with ``RealPluginMixin``"""
+        try:
+            return self.plugin_classes[fake_plugin_class]
+        except KeyError:
+            class RealPlugin(RealPluginMixin, fake_plugin_class):
+                pass
+            self.plugin_classes[fake_plugin_class] = RealPlugin
+            return RealPlugin
+
+    def plugin_method(self, route, channel_plugin):
+        """
+        Returns the method of the channel-specific plugin for the route,
+        wrapped to run in the process pool if it is CPU bound
+        """
+        method = getattr(channel_plugin, route.func.__name__)
+        if not route.cpu_bound or self.cpu_pool is None:
+            return method
+        config = getattr(channel_plugin, 'prod_config', None)
+
+        @functools.wraps(method)
+        def call_in_pool(line, **arg_dict):
+            # Waits cooperatively under gevent
+            pool = self.cpu_pool
+            try:
+                future = pool.submit(
+                    offload.call_in_process, route.plugin.__class__,
+                    route.slug, config, route.func.__name__,
+                    offload.LineCopy(line), arg_dict)
+                try:
+                    return future.result()
+                finally:
+                    # Not started yet, e.g. after a timeout
+                    future.cancel()
+            except BrokenProcessPool:
+                if pool is self.cpu_pool:
+                    LOG.error('A CPU worker died, restarting the pool')
+                    self.cpu_pool = offload.create_pool(self.cpu_workers)
+                raise
+        return call_in_pool
+
+    def run_plugin(self, line, route, arg_dict):
         # Instantiate a plugin specific to this channel
-        channel_plugin = self.setup_plugin_for_channel(plugin.__class__, line)
+        channel_plugin = self.setup_plugin_for_channel(
+            route.plugin.__class__, line)
         # get the method from the channel-specific plugin
-        new_func = log_on_error(LOG, getattr(channel_plugin, func.__name__))
+        new_func = self.plugin_method(route, channel_plugin)
 
         if hasattr(self, 'gevent'):
-            grnlt = self.gevent.Greenlet(new_func, line, **arg_dict)
-            grnlt.link_value(channel_plugin.greenlet_respond)
-            grnlt.start()
+            self.hold_line(line)
+            self.start_plugin_call(
+                (route, channel_plugin, new_func, line, arg_dict))
+        else:
+            self.hold_line(line)
+            self.send_response(
+                channel_plugin, line,
+                self.call_plugin_method(route.slug, new_func, line, arg_dict),
+                route.priority)
+
+    def hold_line(self, line):
+        """Keeps the line from being done until its call is responded to"""
+        timings = getattr(line, '_timings', None)
+        if timings is not None:
+            timings.hold()
+        batch = getattr(line, '_batch', None)
+        if batch is not None:
+            batch.hold()
+
+    def send_response(self, channel_plugin, line, msg, priority):
+        """Sends the response of a plugin call, which is done for the line"""
+        timings = getattr(line, '_timings', None)
+        try:
+            if msg:
+                start = time.perf_counter()
+                channel_plugin.respond(msg, priority)
+                if timings is not None:
+                    timings.add('respond', time.perf_counter() - start)
+        finally:
+            if timings is not None:
+                timings.release()
+            batch = getattr(line, '_batch', None)
+            if batch is not None:
+                batch.release()
+
+    def call_plugin_method(self, slug, method, line, arg_dict):
+        """
+        Calls a plugin method, logging its errors and recording its
+        execution time
+        """
+        name = method.__name__
+        self.metrics.calls.inc(slug, name)
+        start = time.perf_counter()
+        try:
+            return method(line, **arg_dict)
+        except Exception:
+            self.metrics.errors.inc(slug, name)
+            LOG.error("Plugin failed [%s]", name, exc_info=True)
+        finally:
+            self.record_call_time(slug, name, line,
+                                  time.perf_counter() - start)
+            if self.db_pool_size:
+                # Back to the pool for the other calls
+                connections.close_all()
+
+    def record_call_time(self, slug, name, line, seconds):
+        self.metrics.call_seconds.observe(seconds, slug)
+        timings = getattr(line, '_timings', None)
+        if timings is not None:
+            timings.add('{0}.{1}'.format(slug, name), seconds)
+
+    def start_plugin_call(self, call):
+        """
+        Starts a (route, channel plugin, method, line, arguments) call in
+        its lane if its plugin has fewer calls running than its
+        concurrency limit. Otherwise the call waits in the plugin's queue,
+        outside of the lanes, so that a busy plugin doesn't take the
+        greenlets of the others. Calls beyond ``plugin_backlog`` waiting
+        ones are dropped.
+        """
+        route, channel_plugin, _, line, _ = call
+        slug = route.slug
+        limit = route.plugin.max_concurrency or self.plugin_concurrency
+        if self.plugin_calls[slug] < limit:
+            self.plugin_calls[slug] += 1
+            self.lanes[route.priority].spawn(None, self.run_plugin_calls,
+                                             call)
+        elif self.plugin_waiting[slug] < self.plugin_backlog:
+            self.plugin_waiting[slug] += 1
+            self.plugin_queues[slug, route.priority].append(call)
         else:
-            channel_plugin.respond(new_func(line, **arg_dict))
-
-
-    def check_for_plugin_route_matches(self, line, router):
-        """Checks the active plugins' routes and calls functions on matches"""
-        # get the active routes for this channel
-        active_slugs = line._active_plugin_slugs.intersection(router.plugins.keys())
-        for plugin_slug in active_slugs:
-            for rule, func, plugin in router.plugins[plugin_slug]:
-                if router.name == "commands":
-                    cmd = rule
-                    args = line.text.split()
-                    if args[0] == self.command_prefix + cmd:
-                        LOG.info('Command: %s.%s', plugin_slug, func.__name__)
-                        # We need a dict as run_plugin will unpack it
-                        arg_dict = {"args": args[1:]}
-                        self.run_plugin(
-                          line, plugin, plugin_slug, func, arg_dict
-                        )
-
-                elif router.name == "regex_commands":
-                    cmd = rule[0]
-                    regex = rule[1]
-                    args = line.text.split()
-                    if args[0] == self.command_prefix + cmd:
-                        linetext = " ".join(args[1:])
-                        match = re.match(regex, linetext, re.IGNORECASE)
-                        if match:
-                            LOG.info('Command+Match: %s.%s', plugin_slug, func.__name__)
-                            self.run_plugin(
-                              line, plugin, plugin_slug, func, match.groupdict()
-                            )
-
-                else:
-                    regex = rule
-                    match = re.match(regex, line.text, re.IGNORECASE)
-                    if match:
-                        LOG.info('Match: %s.%s', plugin_slug, func.__name__)
-                        self.run_plugin(
-                            line, plugin, plugin_slug, func, match.groupdict()
-                        )
+            self.metrics.dropped_calls.inc(slug)
+            LOG.debug('Dropped a call to %s, %s calls are waiting', slug,
+                      self.plugin_backlog)
+            self.send_response(channel_plugin, line, None, route.priority)
+
+    def next_plugin_call(self, slug):
+        """Takes the next call waiting for the plugin, commands first"""
+        for priority in (HIGH_PRIORITY, LOW_PRIORITY):
+            queue = self.plugin_queues.get((slug, priority))
+            if queue:
+                self.plugin_waiting[slug] -= 1
+                return queue.popleft()
+        self.plugin_calls[slug] -= 1
+        return None
+
+    def run_plugin_calls(self, call):
+        """
+        Makes a call, then the calls waiting for the same plugin, in the
+        greenlet of the first one
+        """
+        slug = call[0].slug
+        try:
+            while call is not None:
+                route, channel_plugin, func, line, arg_dict = call
+                msg = None
+                try:
+                    msg = self.call_with_timeout(route, func, line, arg_dict)
+                finally:
+                    try:
+                        self.send_response(channel_plugin, line, msg,
+                                           route.priority)
+                    except Exception:
+                        LOG.error("Plugin response failed [%s]", slug,
+                                  exc_info=True)
+                call = self.next_plugin_call(slug)
+        finally:
+            if call is not None:
+                # Killed, the next call to the plugin takes over its queue
+                self.plugin_calls[slug] -= 1
+
+    def call_with_timeout(self, route, func, line, arg_dict):
+        """
+        Runs a plugin method, killing it if it takes more than the
+        plugin's timeout
+        """
+        seconds = route.plugin.call_timeout or self.plugin_timeout
+        try:
+            with self.gevent.Timeout(seconds):
+                return self.call_plugin_method(route.slug, func, line,
+                                               arg_dict)
+        except self.gevent.Timeout:
+            self.metrics.timeouts.inc(route.slug, route.func.__name__)
+            LOG.error('Plugin timed out after %ss [%s.%s]', seconds,
+                      route.slug, route.func.__name__)
+
+
+class AsyncPluginRunner(PluginRunner):
+    """
+    Registration and routing for plugins
+    Runs on an asyncio event loop: the queue is read with redis.asyncio,
+    coroutine plugin methods run on the loop and blocking ones run on a
+    bounded thread pool per priority. Routing, which may touch the ORM,
+    runs on a thread of its own, and waits while as many calls are in
+    flight as there are threads, so that the queue isn't read faster than
+    the calls are made.
+    """
+
+    def __init__(self, max_workers=10, command_pool_size=20, **kwargs):
+        super(AsyncPluginRunner, self).__init__(
+            command_pool_size=command_pool_size, **kwargs)
+        import redis.asyncio
+        self.async_bot_bus = redis.asyncio.StrictRedis.from_url(
+            settings.REDIS_PLUGIN_QUEUE_URL)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='plugin')
+        self.command_executor = ThreadPoolExecutor(
+            max_workers=command_pool_size, thread_name_prefix='command')
+        self.dispatch_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='dispatch')
+        self.loop = None
+        # Keep a reference to scheduled plugin calls until they finish
+        self.pending = set()
+        # Bounds the plugin calls scheduled and not finished yet
+        self.call_slots = asyncio.Semaphore(max_workers + command_pool_size)
+
+    def listen(self):
+        """Runs the event loop until stopped"""
+        asyncio.run(self.async_listen())
+        self.close()
+
+    async def async_listen(self):
+        """Listens for incoming messages on the Redis queue"""
+        self.loop = asyncio.get_running_loop()
+        while not self.stopping:
+            packets = []
+            try:
+                packets = await self.transport.async_fetch(
+                    self.async_bot_bus)
+            except Exception:
+                LOG.error("Queue read failed", exc_info=True)
+            if packets:
+                # Django refuses ORM access from the event loop thread
+                await self.loop.run_in_executor(
+                    self.dispatch_executor, self.process_packets, packets)
+            await self.loop.run_in_executor(self.dispatch_executor,
+                                            self.tick)
+        if self.pending:
+            await asyncio.wait([asyncio.wrap_future(future)
+                                for future in list(self.pending)])
+        await self.async_bot_bus.aclose()
+
+    def run_plugin(self, line, route, arg_dict):
+        # Called from the thread pool, hand the call over to the loop
+        channel_plugin = self.setup_plugin_for_channel(
+            route.plugin.__class__, line)
+        method = self.plugin_method(route, channel_plugin)
+        # Holds up the dispatch, and so the next read, until there's room
+        asyncio.run_coroutine_threadsafe(self.call_slots.acquire(),
+                                         self.loop).result()
+        self.hold_line(line)
+        future = asyncio.run_coroutine_threadsafe(
+            self.call_in_slot(channel_plugin, method, line, arg_dict,
+                              route.priority),
+            self.loop)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+
+    async def call_in_slot(self, *args):
+        """Makes a call, then frees its slot for the next one"""
+        try:
+            await self.call_plugin(*args)
+        finally:
+            self.call_slots.release()
+
+    def push_responses(self, chatbot_id, target, lines, priority):
+        # Responses arrive from several threads, send them right away
+        if self.outbound_scheduler is not None:
+            commands = self.outbound_scheduler.add(chatbot_id, target, lines,
+                                                   priority)
+        else:
+            commands = [write_command(chatbot_id, target, text)
+                        for text in lines]
+        if commands:
+            self.bot_bus.lpush('bot', *commands)
+
+    async def call_plugin(self, channel_plugin, method, line, arg_dict,
+                          priority=HIGH_PRIORITY):
+        """
+        Awaits a coroutine method or runs a blocking one in the pool of
+        its priority
+        """
+        executor = (self.command_executor if priority == HIGH_PRIORITY
+                    else self.executor)
+        slug = getattr(channel_plugin, 'slug', None)
+        msg = None
+        try:
+            if inspect.iscoroutinefunction(method):
+                self.metrics.calls.inc(slug, method.__name__)
+                start = time.perf_counter()
+                try:
+                    msg = await method(line, **arg_dict)
+                except Exception:
+                    self.metrics.errors.inc(slug, method.__name__)
+                    LOG.error("Plugin failed [%s]", method.__name__,
+                              exc_info=True)
+                finally:
+                    self.record_call_time(slug, method.__name__, line,
+                                          time.perf_counter() - start)
+            else:
+                msg = await self.loop.run_in_executor(
+                    executor, self.call_plugin_method, slug, method, line,
+                    arg_dict)
+        finally:
+            if msg:
+                await self.loop.run_in_executor(
+                    executor, self.send_response, channel_plugin, line, msg,
+                    priority)
+            else:
+                self.send_response(channel_plugin, line, msg, priority)
+
+
+class ShardedPluginRunner(PluginRunner):
+    """
+    Supervisor for a plugin runner process per shard
+
+    Lines are spread over the shards' queues by a hash of their chatbot
+    and channel, so each channel is handled by one process and keeps its
+    ordering. Dead workers are restarted and the queue length of every
+    shard is reported periodically.
+    """
+    # Minimum seconds between two starts of a shard's worker
+    restart_delay = 5
+
+    def __init__(self, shards, worker_args, report_interval=60,
+                 metrics_port=0, **kwargs):
+        super(ShardedPluginRunner, self).__init__(**kwargs)
+        self.shards = shards
+        # Command line arguments for the worker processes
+        self.worker_args = worker_args
+        # Workers serve their metrics on the following ports
+        self.metrics_port = metrics_port
+        self.shard_depth = self.metrics.add(metrics.Gauge(
+            'botbot_plugin_shard_queue_depth',
+            'Lines waiting in the queue of each shard, as of the last '
+            'report', ['shard']))
+        self.report_interval = report_interval
+        self.last_report = time.monotonic()
+        # (process, start time) per shard
+        self.workers = {}
+        # Queue length per shard, as of the last report
+        self.shard_lengths = {}
+
+    def shard_queue(self, shard):
+        return '{0}:shard:{1}'.format(self.queue_key, shard)
+
+    def shard_for(self, packet):
+        """Stable shard number for the packet's chatbot and channel"""
+        key = '{0}:{1}'.format(packet['ChatBotId'], packet['Channel'].strip())
+        return zlib.crc32(key.encode('utf-8')) % self.shards
+
+    def listen(self):
+        """Starts the workers and feeds them until interrupted"""
+        try:
+            self.check_workers()
+            super(ShardedPluginRunner, self).listen()
+        finally:
+            for process, _ in self.workers.values():
+                process.terminate()
+            for process, _ in self.workers.values():
+                process.wait()
+
+    def process_packets(self, packets):
+        """Appends each packet to the queue of its shard"""
+        if not packets:
+            return
+        pipe = self.bot_bus.pipeline(transaction=False)
+        for val in packets:
+            self.metrics.lines.inc()
+            try:
+                shard = self.shard_for(decode_packet(val))
+            except Exception:
+                LOG.error("Line Sharding Failed", exc_info=True, extra={
+                    "line": val
+                })
+                continue
+            pipe.rpush(self.shard_queue(shard), val)
+        pipe.execute()
+        # The shard queues have them from now on
+        try:
+            self.transport.ack(self.bot_bus, self.transport.take_batch())
+        except Exception:
+            LOG.error("Queue acknowledgement failed", exc_info=True)
+
+    def tick(self):
+        self.profiler.tick()
+        self.check_workers()
+        try:
+            self.transport.trim(self.bot_bus)
+        except Exception:
+            LOG.error("Queue trimming failed", exc_info=True)
+        if time.monotonic() - self.last_report >= self.report_interval:
+            self.report_lag()
+
+    def check_workers(self):
+        """(Re)starts the workers that aren't running"""
+        now = time.monotonic()
+        for shard in range(self.shards):
+            process, started = self.workers.get(shard, (None, None))
+            if process is not None:
+                if process.poll() is None:
+                    continue
+                if now - started < self.restart_delay:
+                    continue
+                LOG.error('Shard %s worker exited with %s, restarting',
+                          shard, process.returncode)
+            self.workers[shard] = (self.start_worker(shard), now)
+
+    def start_worker(self, shard):
+        args = [sys.executable, sys.argv[0], 'run_plugins',
+                '--queue', self.shard_queue(shard)] + self.worker_args
+        if self.metrics_port:
+            args.extend(['--metrics-port',
+                         str(self.metrics_port + 1 + shard)])
+        LOG.info('Starting shard %s worker: %s', shard, ' '.join(args))
+        return subprocess.Popen(args)
+
+    def report_lag(self):
+        """Logs the number of lines waiting in each shard's queue"""
+        self.last_report = time.monotonic()
+        pipe = self.bot_bus.pipeline(transaction=False)
+        for shard in range(self.shards):
+            pipe.llen(self.shard_queue(shard))
+        self.shard_lengths = dict(enumerate(pipe.execute()))
+        for shard, length in self.shard_lengths.items():
+            self.shard_depth.set(length, shard)
+        LOG.info('Shard lag: %s', ', '.join(
+            '{0}={1}'.format(shard, length)
+            for shard, length in self.shard_lengths.items()))
 
 
 def start_plugins(*args, **kwargs):
@@ -332,7 +1424,42 @@ def start_plugins(*args, **kwargs):
     Used by the management command to start-up plugin listener
     and register the plugins.
     """
-    LOG.info('Starting plugins. Gevent=%s', kwargs['use_gevent'])
-    app = PluginRunner(**kwargs)
+    use_asyncio = kwargs.pop('use_asyncio', False)
+    shards = kwargs.pop('shards', 0)
+    worker_args = kwargs.pop('worker_args', [])
+    metrics_port = kwargs.pop('metrics_port', 0)
+    if shards:
+        LOG.info('Starting %s plugin runner shards', shards)
+        app = ShardedPluginRunner(
+            shards, worker_args, metrics_port=metrics_port,
+            **{key: kwargs[key] for key in kwargs
+               if key in ('batch_size', 'queue_key', 'transport',
+                          'stream_group', 'consumer')})
+        if metrics_port:
+            app.serve_metrics(metrics_port)
+        app.profiler.install()
+        # Terminates the workers on the way out
+        signal.signal(signal.SIGTERM, app.stop)
+        signal.signal(signal.SIGINT, app.stop)
+        app.listen()
+        return
+
+    LOG.info('Starting plugins. Gevent=%s, asyncio=%s, batch size=%s',
+             kwargs['use_gevent'], use_asyncio, kwargs.get('batch_size', 1))
+    if use_asyncio:
+        app = AsyncPluginRunner(**kwargs)
+    else:
+        kwargs.pop('max_workers', None)
+        app = PluginRunner(**kwargs)
     app.register_all_plugins()
+    app.load_registry()
+    if kwargs['use_gevent']:
+        from . import cooperative
+        cooperative.check(app.bot_bus)
+    if metrics_port:
+        app.serve_metrics(metrics_port)
+    app.profiler.install()
+    # Lets the calls in progress finish and the buffered logs be written
+    signal.signal(signal.SIGTERM, app.stop)
+    signal.signal(signal.SIGINT, app.stop)
     app.listen()
@@ -0,0 +1,50 @@
+"""
+Degraded modes for the plugin runner while it's behind on the queue.
+"""
+import bisect
+
+# Nothing is shed
+NORMAL = 0
+# Plugins that set ``essential = False`` are skipped
+SKIP_NON_ESSENTIAL = 1
+# Firehose calls (e.g. logging) are also put aside until the lag recovers
+DEFER_FIREHOSE = 2
+
+
+class ShedPolicy(object):
+    """
+    Picks the shedding level from the queue depth and the age of the
+    lines, each compared with its thresholds: reaching the first threshold
+    of either one skips non-essential plugins, reaching the second one also
+    defers the firehose.
+
+    A level is kept until its measure drops below ``recovery`` times its
+    threshold, so that the runner doesn't flap around a threshold.
+    """
+
+    def __init__(self, depth_thresholds=(), lag_thresholds=(),
+                 recovery=0.5):
+        self.depth_thresholds = sorted(depth_thresholds)
+        self.lag_thresholds = sorted(lag_thresholds)
+        self.recovery = recovery
+        self.level = NORMAL
+
+    def _level_for(self, depth, lag, factor=1):
+        return max(
+            bisect.bisect_right([t * factor for t in self.depth_thresholds],
+                                depth),
+            bisect.bisect_right([t * factor for t in self.lag_thresholds],
+                                lag))
+
+    def update(self, depth, lag):
+        """
+        Takes the current queue depth and lag (in seconds), returns the
+        new level
+        """
+        level = self._level_for(depth, lag)
+        if level < self.level:
+            # Only step down once below the recovery mark
+            level = min(self.level,
+                        self._level_for(depth, lag, self.recovery))
+        self.level = level
+        return level
@@ -1,9 +1,41 @@
  # -*- coding: utf-8 -*-
+import asyncio
 import datetime
+import json
+import os
+import pickle
+import pstats
+import re
+import signal
+import tempfile
+import tracemalloc
+import urllib.request
+from unittest import mock
 
+import fakeredis
+import gevent
+from botbot_plugins.base import BasePlugin, PrivateMessage
+from botbot_plugins.decorators import (cpu_bound, listens_to_all,
+                                       listens_to_command,
+                                       listens_to_mentions,
+                                       listens_to_regex_command)
+import psycopg2
+import redis
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
 from django.test import TestCase
-from datetime import datetime, timezone
-from . import utils
+from django.test.utils import override_settings
+from django.utils import timezone
+from botbot.apps.bots.models import ChatBot
+from botbot.apps.logs.models import REDACTED_TEXT, Log
+from . import (cooperative, latency, logbuffer, metrics, offload, outbound,
+               profiling, registry, replay, runner, shedding, transport,
+               utils, wire)
+from .core import logger
+from . import models as plugins_models
+from .models import CHANNEL_CHANGES, ActivePlugin, Plugin
+from .pooled_postgresql import base as pooled_postgresql
 
 
 class UtilsTestCase(TestCase):
@@ -18,5 +50,1413 @@ class UtilsTestCase(TestCase):
         timestamp = '2014-01-27T16:35:53.1234Z'
         py_date = utils.convert_nano_timestamp(timestamp)
         self.assertEqual(py_date,
-                         datetime.datetime(2014, 1, 27, 16, 35, 
-                                           53, 123400, tzinfo=datetime.UTC))
\ No newline at end of file
+                         datetime.datetime(2014, 1, 27, 16, 35,
+                                           53, 123400, tzinfo=datetime.UTC))
+
+    def test_nano_timestamp_fallback(self):
+        # not the fixed layout the bot sends, goes through strptime
+        timestamp = '2014-1-27T16:35:53.12Z'
+        py_date = utils.convert_nano_timestamp(timestamp)
+        self.assertEqual(py_date,
+                         datetime.datetime(2014, 1, 27, 16, 35,
+                                           53, 120000, tzinfo=datetime.UTC))
+
+class BatchedQueueTestCase(TestCase):
+    def setUp(self):
+        self.runner = runner.PluginRunner(batch_size=3)
+        self.runner.bot_bus = fakeredis.FakeStrictRedis()
+
+    def test_fetch_packets_in_arrival_order(self):
+        self.runner.bot_bus.rpush('q', 'one', 'two', 'three', 'four')
+        self.assertEqual(self.runner.fetch_packets(),
+                         [b'one', b'two', b'three'])
+        self.assertEqual(self.runner.queue_length, 1)
+        self.assertEqual(self.runner.fetch_packets(), [b'four'])
+        self.assertEqual(self.runner.queue_length, 0)
+
+    def test_fetch_single_packet(self):
+        self.runner.transport.batch_size = 1
+        self.runner.bot_bus.rpush('q', 'one', 'two')
+        self.assertEqual(self.runner.fetch_packets(), [b'one'])
+        self.assertEqual(self.runner.queue_length, 1)
+
+
+class RecordingPlugin(object):
+    """Stand-in for a channel plugin that remembers its responses"""
+    def __init__(self):
+        self.responses = []
+
+    def respond(self, msg, priority=None):
+        self.responses.append(msg)
+
+    async def coroutine_method(self, line, word):
+        return 'async {}'.format(word)
+
+    def blocking_method(self, line, word):
+        return 'blocking {}'.format(word)
+
+    def failing_method(self, line, word):
+        raise ValueError(word)
+
+
+class AsyncPluginRunnerTestCase(TestCase):
+    def setUp(self):
+        self.runner = runner.AsyncPluginRunner(max_workers=2)
+        self.plugin = RecordingPlugin()
+
+    def call(self, method):
+        async def run():
+            self.runner.loop = asyncio.get_running_loop()
+            await self.runner.call_plugin(
+                self.plugin, method, None, {'word': 'hi'})
+        asyncio.run(run())
+
+    def test_coroutine_method(self):
+        self.call(self.plugin.coroutine_method)
+        self.assertEqual(self.plugin.responses, ['async hi'])
+
+    def test_blocking_method(self):
+        self.call(self.plugin.blocking_method)
+        self.assertEqual(self.plugin.responses, ['blocking hi'])
+
+    def test_failing_method(self):
+        with self.assertLogs('botbot.plugin_runner', level='ERROR'):
+            self.call(self.plugin.failing_method)
+        self.assertEqual(self.plugin.responses, [])
+
+    def test_calls_in_flight_bounded(self):
+        app = runner.AsyncPluginRunner(max_workers=1, command_pool_size=1)
+        app.register(SlowPlugin())
+        route = app.routers['messages'].plugins['tests'][0]
+        line = FakeLine(FakeChannel())
+        started = []
+
+        async def run():
+            app.loop = asyncio.get_running_loop()
+            done = asyncio.Event()
+
+            async def call_plugin(*args):
+                started.append(args)
+                await done.wait()
+            app.call_plugin = call_plugin
+            dispatch = app.loop.run_in_executor(None, lambda: [
+                app.run_plugin(line, route, {}) for _ in range(3)])
+            await asyncio.sleep(0.05)
+            # The third call waits for one of the first two
+            self.assertEqual(len(started), 2)
+            self.assertFalse(dispatch.done())
+            done.set()
+            await dispatch
+            while app.pending:
+                await asyncio.sleep(0.01)
+        asyncio.run(run())
+        self.assertEqual(len(started), 3)
+
+
+class CountingPlugin(BasePlugin):
+    """Plugin that counts how often it is initialized"""
+    initialized = 0
+
+    def initialize(self):
+        CountingPlugin.initialized += 1
+
+
+class FakeChannel(object):
+    """Just enough of a Channel to set up a plugin"""
+    def __init__(self):
+        self.pk = 1
+        self.name = '#test'
+        self.fingerprint = 'abc'
+        self.config = {}
+
+    def plugin_config(self, plugin_slug):
+        return dict(self.config)
+
+
+class FakeLine(object):
+    def __init__(self, channel):
+        self._channel = channel
+        self._chatbot_id = 1
+
+
+class ChannelPluginCacheTestCase(TestCase):
+    def setUp(self):
+        CountingPlugin.initialized = 0
+        self.runner = runner.PluginRunner()
+        self.channel = FakeChannel()
+        self.line = FakeLine(self.channel)
+
+    def setup_plugin(self):
+        return self.runner.setup_plugin_for_channel(CountingPlugin, self.line)
+
+    def test_instance_is_reused(self):
+        plugin = self.setup_plugin()
+        self.assertIs(self.setup_plugin(), plugin)
+        self.assertEqual(CountingPlugin.initialized, 1)
+        self.assertEqual(len(self.runner.plugin_classes), 1)
+
+    def test_rebuilt_on_fingerprint_change(self):
+        plugin = self.setup_plugin()
+        self.channel.fingerprint = 'def'
+        self.assertIsNot(self.setup_plugin(), plugin)
+        self.assertEqual(CountingPlugin.initialized, 2)
+
+    def test_rebuilt_on_config_change(self):
+        plugin = self.setup_plugin()
+        self.channel.config = {'key': 'value'}
+        self.assertIsNot(self.setup_plugin(), plugin)
+        self.assertEqual(CountingPlugin.initialized, 2)
+
+
+class RoutedPlugin(BasePlugin):
+    @listens_to_all(r'(?:.*)\b(?P<issue>[A-Z]+-\d+)\b(?:.*)')
+    def issue(self, line, issue):
+        pass
+
+    @listens_to_mentions(r'^ping$')
+    def ping(self, line):
+        pass
+
+    @listens_to_command('m')
+    def motivate(self, line, args):
+        pass
+
+    @listens_to_regex_command('remember', r'(?P<key>\w+)=(?P<value>.*)')
+    def remember(self, line, key, value):
+        pass
+
+
+class RoutedLine(object):
+    _active_plugin_slugs = {'tests'}
+    _is_message = True
+
+    def __init__(self, text, is_direct_message=False):
+        self.text = text
+        self.is_direct_message = is_direct_message
+
+
+class RecordingRunner(runner.PluginRunner):
+    """Runner that records plugin calls instead of running them"""
+    def __init__(self, **kwargs):
+        super(RecordingRunner, self).__init__(**kwargs)
+        self.calls = []
+
+    def run_plugin(self, line, route, arg_dict):
+        self.calls.append((route.func.__name__, arg_dict))
+
+
+class RoutingTestCase(TestCase):
+    def setUp(self):
+        self.runner = RecordingRunner()
+        self.runner.command_prefix = '!'
+        self.runner.register(RoutedPlugin())
+
+    def dispatch(self, text, **kwargs):
+        self.runner.calls = []
+        self.runner.dispatch(RoutedLine(text, **kwargs))
+        return self.runner.calls
+
+    def test_regex_route(self):
+        self.assertEqual(self.dispatch('see mbs-123 please'),
+                         [('issue', {'issue': 'mbs-123'})])
+        self.assertEqual(self.dispatch('nothing to see'), [])
+
+    def test_mention_route(self):
+        self.assertEqual(self.dispatch('ping'), [])
+        self.assertEqual(self.dispatch('ping', is_direct_message=True),
+                         [('ping', {})])
+
+    def test_command_route(self):
+        self.assertEqual(self.dispatch('!m everyone here'),
+                         [('motivate', {'args': ['everyone', 'here']})])
+        self.assertEqual(self.dispatch('!mm everyone'), [])
+
+    def test_regex_command_route(self):
+        self.assertEqual(self.dispatch('!remember foo=bar baz'),
+                         [('remember', {'key': 'foo', 'value': 'bar baz'})])
+        self.assertEqual(self.dispatch('!remember foo'), [])
+
+    def test_commands_ahead_of_messages_in_batch(self):
+        self.runner.deferred = []
+        self.runner.dispatch(RoutedLine('!m MBS-1'))
+        self.assertEqual(self.runner.calls,
+                         [('motivate', {'args': ['MBS-1']})])
+        self.runner.run_deferred()
+        self.assertEqual(self.runner.calls[1], ('issue', {'issue': 'MBS-1'}))
+        self.assertIsNone(self.runner.deferred)
+
+    def test_inactive_plugin(self):
+        line = RoutedLine('!m everyone')
+        line._active_plugin_slugs = {'logger'}
+        self.runner.dispatch(line)
+        self.assertEqual(self.runner.calls, [])
+
+    def test_plan_is_cached(self):
+        plan = self.runner.dispatch_plan({'tests'})
+        self.assertIs(self.runner.dispatch_plan({'tests'}), plan)
+        self.assertEqual(list(plan.commands), ['m'])
+
+
+class LiteralPrefilterTestCase(TestCase):
+    def test_required_literals(self):
+        self.assertEqual(utils.required_literals(
+            r'(?:.*)\b(?P<repo>[\w\-\_]+)#(?P<pulls>\d+(?:,\d+)*)\b(?:.*)'),
+            ['#'])
+        self.assertEqual(utils.required_literals(r'(?:.*)\b([A-Z]+-\d+)\b'),
+                         ['-'])
+        self.assertEqual(utils.required_literals(r'(.*)\bUPDATE:JIRA'),
+                         ['UPDATE:JIRA'])
+        self.assertEqual(utils.required_literals(r'^help (?P<command>.*)'),
+                         ['help '])
+        self.assertEqual(utils.required_literals(r'(?:ab)+c?(x|y)'), ['ab'])
+        self.assertEqual(utils.required_literals(r'(?:.*)'), [])
+
+    def test_fold_case(self):
+        # re.IGNORECASE considers these equal to "i" and "k"
+        self.assertEqual(utils.fold_case('ıK'), 'ik')
+
+    def test_route_skips_regex(self):
+        route = runner.Route('messages', r'(?:.*)\b(?P<n>\d+)#',
+                             lambda line: None, RoutedPlugin())
+        self.assertEqual(route.literals, ('#',))
+        self.assertIsNone(route.match('12 apples', '12 apples'))
+        self.assertEqual(route.match('12#', '12#').group('n'), '12')
+
+    def test_declared_literals(self):
+        @listens_to_all(r'(?P<issue>[A-Z]+-\d+)', literals=['MBS-'])
+        def func(line, issue):
+            pass
+        route = runner.Route('messages', func.route_rule[1], func,
+                             RoutedPlugin())
+        self.assertEqual(route.literals, ('mbs-',))
+        self.assertIsNone(route.match('LB-1', 'lb-1'))
+        self.assertTrue(route.match('mbs-1', 'mbs-1'))
+
+
+class SlowPlugin(BasePlugin):
+    max_concurrency = 1
+
+    @listens_to_all(r'.*')
+    def slow(self, line):
+        gevent.sleep(1)
+        return 'done'
+
+
+class GeventLimitsTestCase(TestCase):
+    def setUp(self):
+        self.runner = runner.PluginRunner(use_gevent=True, pool_size=5,
+                                          plugin_timeout=0.01)
+        self.plugin = SlowPlugin()
+        self.runner.register(self.plugin)
+        self.route = self.runner.routers['messages'].plugins['tests'][0]
+        self.line = FakeLine(FakeChannel())
+
+    def test_timeout_kills_call(self):
+        with self.assertLogs('botbot.plugin_runner', level='ERROR') as logs:
+            self.runner.run_plugin(self.line, self.route, {})
+            self.runner.lanes['low'].join()
+        self.assertIn('timed out', logs.output[0])
+        self.assertEqual(self.runner.plugin_calls['tests'], 0)
+
+    def test_concurrency_limit(self):
+        self.runner.plugin_timeout = 0.05
+        with self.assertLogs('botbot.plugin_runner', level='ERROR') as logs:
+            self.runner.run_plugin(self.line, self.route, {})
+            self.runner.run_plugin(self.line, self.route, {})
+            gevent.sleep(0.01)
+            self.assertEqual(self.runner.plugin_calls['tests'], 1)
+            self.assertEqual(self.runner.plugin_waiting['tests'], 1)
+            self.runner.lanes['low'].join()
+        # The second call waited for the first one, then ran
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(self.runner.plugin_calls['tests'], 0)
+
+    def test_waiting_calls_leave_the_lane_free(self):
+        self.runner.plugin_timeout = 0.05
+        low = self.runner.lanes['low']
+        with self.assertLogs('botbot.plugin_runner', level='ERROR'):
+            for _ in range(10):
+                self.runner.run_plugin(self.line, self.route, {})
+            replies = []
+            low.spawn(lambda grnlt: replies.append(grnlt.value),
+                      lambda: 'other plugin')
+            gevent.sleep(0.01)
+            self.assertEqual(replies, ['other plugin'])
+            self.assertEqual(low.running, 1)
+            self.assertEqual(self.runner.plugin_waiting['tests'], 9)
+            self.runner.plugin_timeout = 0.001
+            low.join()
+        self.assertEqual(self.runner.plugin_calls['tests'], 0)
+        self.assertEqual(self.runner.plugin_waiting['tests'], 0)
+
+    def test_calls_over_the_backlog_dropped(self):
+        self.runner.plugin_backlog = 2
+        with self.assertLogs('botbot.plugin_runner', level='ERROR') as logs:
+            for _ in range(4):
+                self.runner.run_plugin(self.line, self.route, {})
+            self.runner.lanes['low'].join()
+        self.assertEqual(len(logs.output), 3)
+        self.assertEqual(
+            self.runner.metrics.dropped_calls.values[('tests',)], 1)
+
+    def test_batch_over_the_limit_is_logged(self):
+        chatbot = ChatBot.objects.create(
+            server='irc.example.net:6697', nick='BrainzBot', real_name='x')
+        channel = chatbot.channel_set.create(name='#test', slug='test')
+        ActivePlugin.objects.create(
+            channel=channel, plugin=Plugin.objects.create(slug='logger'))
+        app = runner.PluginRunner(use_gevent=True, batch_size=50,
+                                  plugin_concurrency=10)
+        app.bot_bus = fakeredis.FakeStrictRedis()
+        app.register(logger.Plugin())
+        with self.assertLogs('botbot.plugin_runner', level='INFO'):
+            app.process_packets([json.dumps({
+                'Content': 'line {0}'.format(n), 'User': 'someone',
+                'ChatBotId': chatbot.pk,
+                'Raw': ':someone!x@example.net PRIVMSG #test :line {0}'.format(
+                    n),
+                'Channel': '#test',
+                'Command': 'PRIVMSG', 'Host': 'example.net',
+                'Received': '2014-01-27T16:35:53.123456789Z'})
+                for n in range(50)])
+            app.close()
+        self.assertEqual(Log.objects.count(), 50)
+
+    def test_busy_lane_does_not_hold_back_others(self):
+        self.runner.plugin_timeout = 0.2
+        low, high = self.runner.lanes['low'], self.runner.lanes['high']
+        self.runner.run_plugin(self.line, self.route, {})
+        replies = []
+        high.spawn(lambda grnlt: replies.append(grnlt.value), lambda: 'pong')
+        gevent.sleep(0.05)
+        self.assertEqual(replies, ['pong'])
+        self.assertEqual(low.running, 1)
+        with self.assertLogs('botbot.plugin_runner', level='ERROR'):
+            low.join()
+
+
+class ShardedPluginRunnerTestCase(TestCase):
+    def setUp(self):
+        self.runner = runner.ShardedPluginRunner(3, ['--batch-size', '10'])
+        self.runner.bot_bus = fakeredis.FakeStrictRedis()
+
+    def packet(self, channel, content):
+        return json.dumps({'ChatBotId': 1, 'Channel': channel,
+                           'Content': content})
+
+    def test_channel_lines_stay_together(self):
+        packets = [self.packet('#{0}'.format(n % 5), str(n))
+                   for n in range(20)]
+        self.runner.process_packets(packets)
+        bus = self.runner.bot_bus
+        queued = []
+        for shard in range(3):
+            lines = [json.loads(val)
+                     for val in bus.lrange('q:shard:{0}'.format(shard), 0, -1)]
+            for line in lines:
+                self.assertEqual(self.runner.shard_for(line), shard)
+            queued.extend(lines)
+        self.assertEqual(len(queued), 20)
+        # arrival order is kept per channel
+        for channel in set(line['Channel'] for line in queued):
+            contents = [int(line['Content']) for line in queued
+                        if line['Channel'] == channel]
+            self.assertEqual(contents, sorted(contents))
+
+    def test_dead_workers_are_restarted(self):
+        started = []
+
+        class FakeProcess(object):
+            returncode = 1
+
+            def poll(self):
+                return 1
+
+        def start_worker(shard):
+            started.append(shard)
+            return FakeProcess()
+
+        self.runner.start_worker = start_worker
+        self.runner.restart_delay = 0
+        self.runner.check_workers()
+        with self.assertLogs('botbot.plugin_runner', level='ERROR'):
+            self.runner.check_workers()
+        self.assertEqual(started, [0, 1, 2, 0, 1, 2])
+
+    def test_sigterm_terminates_workers(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1,
+                       signal.SIGUSR2):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        terminated = []
+
+        class FakeProcess(object):
+            def poll(self):
+                return None
+
+            def terminate(self):
+                terminated.append(self)
+
+            def wait(self):
+                pass
+
+        def fetch_packets(app):
+            os.kill(os.getpid(), signal.SIGTERM)
+            return []
+
+        with mock.patch.object(runner.redis.StrictRedis, 'from_url',
+                               return_value=fakeredis.FakeStrictRedis()), \
+                mock.patch.object(runner.ShardedPluginRunner, 'start_worker',
+                                  lambda app, shard: FakeProcess()), \
+                mock.patch.object(runner.ShardedPluginRunner, 'fetch_packets',
+                                  fetch_packets), \
+                self.assertLogs('botbot.plugin_runner', level='INFO'):
+            runner.start_plugins(shards=2, use_gevent=False)
+        self.assertEqual(len(terminated), 2)
+
+
+class StreamTransportTestCase(TestCase):
+    def setUp(self):
+        self.bus = fakeredis.FakeStrictRedis()
+        self.transport = transport.StreamTransport(
+            batch_size=2, consumer='one', claim_idle=60)
+
+    def add(self, *packets):
+        for packet in packets:
+            self.bus.xadd('q:stream', {'packet': packet})
+
+    def test_fetch_and_ack(self):
+        self.add('one', 'two', 'three')
+        self.assertEqual(self.transport.fetch(self.bus), [b'one', b'two'])
+        self.assertEqual(self.bus.xpending('q:stream', 'plugins')['pending'],
+                         2)
+        self.transport.ack(self.bus)
+        self.assertEqual(self.bus.xpending('q:stream', 'plugins')['pending'],
+                         0)
+        self.assertEqual(self.transport.fetch(self.bus), [b'three'])
+
+    def test_claim_from_dead_consumer(self):
+        self.add('one', 'two')
+        dead = transport.StreamTransport(batch_size=2, consumer='dead')
+        self.assertEqual(dead.fetch(self.bus), [b'one', b'two'])
+        # never acknowledged, claimed once idle for long enough
+        self.transport.claim_idle = 0
+        self.assertEqual(self.transport.fetch(self.bus), [b'one', b'two'])
+        self.transport.ack(self.bus)
+        self.assertEqual(self.bus.xpending('q:stream', 'plugins')['pending'],
+                         0)
+
+    def test_own_entries_not_claimed(self):
+        self.add('one', 'two', 'three')
+        self.transport.claim_idle = 0
+        self.assertEqual(self.transport.fetch(self.bus), [b'one', b'two'])
+        # Still being worked on, not claimed back
+        self.assertEqual(self.transport.fetch(self.bus), [b'three'])
+        self.assertEqual(self.transport.fetch(self.bus), [])
+
+    def test_recover_entries_of_earlier_run(self):
+        self.add('one', 'two', 'three')
+        self.assertEqual(self.transport.fetch(self.bus), [b'one', b'two'])
+        restarted = transport.StreamTransport(batch_size=2, consumer='one')
+        with self.assertLogs('botbot.plugin_runner', level='WARNING'):
+            self.assertEqual(restarted.fetch(self.bus), [b'one', b'two'])
+        self.assertEqual(restarted.fetch(self.bus), [b'three'])
+
+    def test_trim_acknowledged(self):
+        self.add('one', 'two', 'three')
+        self.transport.trim_interval = 0
+        self.transport.fetch(self.bus)
+        self.assertEqual(self.transport.trim(self.bus), 0)
+        one, two = self.transport.take_batch()
+        self.transport.ack(self.bus, [one])
+        self.assertEqual(self.transport.trim(self.bus), 1)
+        self.transport.ack(self.bus, [two])
+        # 'three' hasn't been delivered yet
+        self.assertEqual(self.transport.trim(self.bus), 1)
+        self.assertEqual(self.transport.fetch(self.bus), [b'three'])
+
+    def test_runner_acks_once_done(self):
+        chatbot = ChatBot.objects.create(
+            server='irc.example.net:6697', nick='BrainzBot', real_name='x')
+        channel = chatbot.channel_set.create(name='#test', slug='test')
+        ActivePlugin.objects.create(
+            channel=channel, plugin=Plugin.objects.create(slug='logger'))
+        app = runner.PluginRunner(use_gevent=True, batch_size=2,
+                                  transport='stream', consumer='one',
+                                  log_batch_delay=60)
+        app.bot_bus = self.bus
+        app.register(logger.Plugin())
+        self.add(*[json.dumps({
+            'Content': 'line {0}'.format(n), 'User': 'someone',
+            'ChatBotId': chatbot.pk,
+            'Raw': ':someone!x@example.net PRIVMSG #test :line {0}'.format(n),
+            'Channel': '#test', 'Command': 'PRIVMSG', 'Host': 'example.net',
+            'Received': '2014-01-27T16:35:53.123456789Z'}) for n in range(2)])
+
+        def pending():
+            return self.bus.xpending('q:stream', 'plugins')['pending']
+
+        app.process_packets(app.fetch_packets())
+        # The logger calls haven't run yet
+        app.tick()
+        self.assertEqual(pending(), 2)
+        app.lanes['low'].join()
+        # Their rows aren't written yet
+        app.tick()
+        self.assertEqual(pending(), 2)
+        app.log_buffer.flush()
+        app.tick()
+        self.assertEqual(pending(), 0)
+        self.assertEqual(Log.objects.count(), 2)
+
+    def test_runner_gives_up_on_stuck_batch(self):
+        app = runner.PluginRunner(transport='stream', consumer='one')
+        app.bot_bus = self.bus
+        self.add('one', 'two')
+
+        def pending():
+            return self.bus.xpending('q:stream', 'plugins')['pending']
+
+        # Not actual packets, only their acknowledgement matters
+        with self.assertLogs('botbot.plugin_runner', level='ERROR'):
+            app.process_packets(app.fetch_packets())
+            stuck = app.unacked[0]
+            # A call that never returns
+            stuck.hold()
+            app.process_packets(app.fetch_packets())
+        app.tick()
+        # The later batch isn't held up by the stuck one
+        self.assertEqual(pending(), 1)
+        self.assertEqual(list(app.unacked), [stuck])
+        app.transport.max_hold = 0
+        with self.assertLogs('botbot.plugin_runner', level='WARNING'):
+            app.tick()
+        self.assertEqual(pending(), 0)
+        self.assertEqual(len(app.unacked), 0)
+
+
+class PipelinedResponsesTestCase(TestCase):
+    def setUp(self):
+        self.runner = runner.PluginRunner()
+        self.runner.bot_bus = fakeredis.FakeStrictRedis()
+        self.plugin = self.runner.setup_plugin_for_channel(
+            CountingPlugin, FakeLine(FakeChannel()))
+
+    def sent(self):
+        # the bot pops from the right
+        return [cmd.decode('utf-8')
+                for cmd in reversed(self.runner.bot_bus.lrange('bot', 0, -1))]
+
+    def test_respond_outside_batch(self):
+        self.plugin.respond('one\ntwo')
+        self.assertEqual(self.sent(), ['WRITE 1 #test one',
+                                       'WRITE 1 #test two'])
+
+    def test_responses_held_until_end_of_batch(self):
+        self.runner.outbound = []
+        self.plugin.respond('one\ntwo')
+        self.plugin.respond(PrivateMessage('nick', 'three'))
+        self.assertEqual(self.sent(), [])
+        self.runner.flush_responses()
+        self.assertEqual(self.sent(), ['WRITE 1 #test one',
+                                       'WRITE 1 #test two',
+                                       'WRITE 1 nick three'])
+        self.assertIsNone(self.runner.outbound)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class OutboundSchedulerTestCase(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = outbound.OutboundScheduler(
+            rate=1, burst=2, max_backlog=4, clock=self.clock)
+
+    def test_paced_per_target(self):
+        self.assertEqual(self.scheduler.add(1, '#a', ['one', 'two', 'three']),
+                         ['WRITE 1 #a one', 'WRITE 1 #a two'])
+        self.assertEqual(self.scheduler.add(1, '#b', ['four']),
+                         ['WRITE 1 #b four'])
+        self.assertEqual(self.scheduler.due(), [])
+        self.assertEqual(self.scheduler.backlog(), {(1, '#a'): (1, 0)})
+        self.clock.now += 1
+        self.assertEqual(self.scheduler.due(), ['WRITE 1 #a three'])
+        self.assertEqual(self.scheduler.backlog(), {})
+
+    def test_idle_buckets_forgotten(self):
+        self.scheduler.add(1, '#a', ['one'])
+        self.assertIn((1, '#a'), self.scheduler.buckets)
+        self.clock.now += 1
+        self.scheduler.due()
+        self.assertEqual(self.scheduler.buckets, {})
+
+    def test_coalesce(self):
+        self.scheduler.coalesce_length = 10
+        self.assertEqual(self.scheduler.add(1, '#a', ['one', 'two', 'three']),
+                         ['WRITE 1 #a one | two', 'WRITE 1 #a three'])
+
+    def test_low_priority_shed_first(self):
+        # Takes the tokens, what follows is queued
+        self.scheduler.add(1, '#a', ['sent1', 'sent2'])
+        self.scheduler.add(1, '#a', ['high1', 'high2'], outbound.HIGH_PRIORITY)
+        self.scheduler.add(1, '#a', ['low1', 'low2', 'low3', 'low4'])
+        self.assertEqual([line.text for line in self.scheduler.queues[1, '#a']],
+                         ['high1', 'high2', 'low3', 'low4'])
+        self.assertEqual(self.scheduler.dropped[1, '#a'], 2)
+
+    def test_runner_paces_responses(self):
+        app = runner.PluginRunner(outbound_rate=1, outbound_burst=1)
+        app.bot_bus = fakeredis.FakeStrictRedis()
+        app.outbound_scheduler.clock = self.clock
+        plugin = app.setup_plugin_for_channel(CountingPlugin,
+                                              FakeLine(FakeChannel()))
+        app.outbound = []
+        plugin.respond('one\ntwo')
+        app.flush_responses()
+        self.assertEqual(app.bot_bus.lrange('bot', 0, -1), [b'WRITE 1 #test one'])
+        self.clock.now += 1
+        app.tick()
+        self.assertEqual(app.bot_bus.lrange('bot', 0, -1),
+                         [b'WRITE 1 #test two', b'WRITE 1 #test one'])
+
+    def test_sent_without_waiting_for_tick(self):
+        app = runner.PluginRunner(outbound_rate=1, outbound_burst=1)
+        app.bot_bus = fakeredis.FakeStrictRedis()
+        app.outbound_scheduler.clock = self.clock
+        plugin = app.setup_plugin_for_channel(CountingPlugin,
+                                              FakeLine(FakeChannel()))
+        plugin.respond('one\ntwo')
+        self.assertEqual(app.bot_bus.lrange('bot', 0, -1),
+                         [b'WRITE 1 #test one'])
+        self.assertEqual(app.outbound_scheduler.backlog(),
+                         {(1, '#test'): (1, 0)})
+
+
+class LineTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.chatbot = ChatBot.objects.create(
+            server='irc.example.net:6697', nick='BrainzBot', real_name='x')
+        self.chatbot.channel_set.create(name='#test', slug='test')
+
+    def line(self, content, channel='#test'):
+        return runner.Line({'Content': content, 'User': 'someone',
+                            'ChatBotId': self.chatbot.pk, 'Raw': content,
+                            'Channel': channel, 'Command': 'PRIVMSG',
+                            'Host': 'example.net',
+                            'Received': '2014-01-27T16:35:53.123456789Z'},
+                           None)
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(self.line('hi'), '__dict__'))
+
+    def test_fields_computed_on_use(self):
+        line = self.line('hi')
+        self.assertIs(line._received_cache, runner._UNSET)
+        self.assertIs(line._chatbot_cache, runner._UNSET)
+        self.assertEqual(line._received.microsecond, 123456)
+        self.assertTrue(line.is_valid())
+        self.assertFalse(line.is_direct_message)
+        self.assertEqual(line.text, 'hi')
+
+    def test_mention(self):
+        line = self.line('brainzbot: ping')
+        self.assertTrue(line.is_direct_message)
+        self.assertEqual(line.text, 'ping')
+        self.assertEqual(line.full_text, 'brainzbot: ping')
+
+    def test_private_message(self):
+        line = self.line('ping', channel='BrainzBot')
+        self.assertTrue(line.is_direct_message)
+        self.assertEqual(line._channel_name, 'someone')
+
+    def test_channel_without_direct_message_regex(self):
+        with mock.patch.object(runner, 'direct_message_regex') as regex:
+            self.assertTrue(self.line('hi').is_valid())
+            private = self.line('ping', channel='BrainzBot')
+            private._channel
+        regex.assert_not_called()
+        self.assertEqual(private._channel_name, 'someone')
+        self.assertTrue(private.is_direct_message)
+        self.assertEqual(private.text, 'ping')
+
+
+class ChannelRegistryTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.chatbot = ChatBot.objects.create(
+            server='irc.example.net:6697', nick='BrainzBot', real_name='x',
+            is_active=True)
+        self.channel = self.chatbot.channel_set.create(name='#test',
+                                                       slug='test')
+        self.active = ActivePlugin.objects.create(
+            channel=self.channel, configuration={'key': 'one'},
+            plugin=Plugin.objects.create(slug='ping', name='ping'))
+        self.app = runner.PluginRunner()
+        self.app.bot_bus = fakeredis.FakeStrictRedis()
+        self.app.load_registry()
+
+    def line(self, channel='#test'):
+        return runner.Line({'Content': 'hi', 'User': 'someone',
+                            'ChatBotId': self.chatbot.pk, 'Raw': 'hi',
+                            'Channel': channel, 'Command': 'PRIVMSG',
+                            'Host': 'example.net',
+                            'Received': '2014-01-27T16:35:53.123456789Z'},
+                           self.app)
+
+    def test_routing_without_queries(self):
+        with self.assertNumQueries(0):
+            line = self.line()
+            self.assertTrue(line.is_valid())
+            self.assertEqual(line._active_plugin_slugs, {'ping'})
+            self.assertEqual(line._channel.plugin_config('ping'),
+                             {'key': 'one'})
+            self.assertEqual(line._channel.plugin_config('other'), {})
+            self.assertFalse(self.line('#unknown').is_valid())
+
+    def test_published_change_reloads_channel(self):
+        self.active.configuration = {'key': 'two'}
+        self.active.save()
+        self.app.bot_bus.publish(CHANNEL_CHANGES,
+                                 '{0} '.format(self.channel.pk))
+        self.app.tick()
+        self.assertEqual(self.line()._channel.plugin_config('ping'),
+                         {'key': 'two'})
+
+    def test_known_fingerprint_skipped(self):
+        loaded = self.app.registry.channel(self.chatbot.pk, '#test')
+        with self.assertNumQueries(0):
+            self.app.registry.apply_change('{0} {1}'.format(
+                self.channel.pk, loaded.fingerprint))
+        self.assertIs(self.app.registry.channel(self.chatbot.pk, '#test'),
+                      loaded)
+
+    def test_renamed_channel(self):
+        self.channel.name = '#renamed'
+        self.channel.save()
+        self.app.registry.apply_change('{0} {1}'.format(
+            self.channel.pk, self.channel.fingerprint))
+        self.assertIsNone(self.app.registry.channel(self.chatbot.pk, '#test'))
+        self.assertFalse(self.line('#test').is_valid())
+        self.assertTrue(self.line('#renamed').is_valid())
+
+    def test_new_chatbot(self):
+        chatbot = ChatBot.objects.create(
+            server='irc.example.org:6697', nick='Other', real_name='x',
+            is_active=True)
+        channel = chatbot.channel_set.create(name='#other', slug='other')
+        self.app.registry.apply_change('{0} {1}'.format(
+            channel.pk, channel.fingerprint))
+        self.assertEqual(self.app.registry.chatbot(chatbot.pk), chatbot)
+        self.assertIsNotNone(self.app.registry.channel(chatbot.pk, '#other'))
+
+    def test_inactive_chatbot_until_activated(self):
+        self.chatbot.is_active = False
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.chatbot.save()
+        # One for the bot, whatever its number of channels
+        self.assertEqual(len(callbacks), 1)
+        self.app.registry.apply_change('chatbot {0}'.format(self.chatbot.pk))
+        self.assertIsNone(self.app.registry.chatbot(self.chatbot.pk))
+        self.assertFalse(self.line().is_valid())
+        self.chatbot.is_active = True
+        self.chatbot.save()
+        self.app.registry.apply_change('chatbot {0}'.format(self.chatbot.pk))
+        self.assertTrue(self.line().is_valid())
+
+    def test_chatbot_save_publishes_once(self):
+        self.chatbot.channel_set.create(name='#more', slug='more')
+        bus = mock.Mock()
+        with mock.patch.object(plugins_models, '_publisher', bus), \
+                self.settings(REDIS_PLUGIN_QUEUE_URL='redis://localhost'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.chatbot.save()
+        bus.publish.assert_called_once_with(
+            CHANNEL_CHANGES, 'chatbot {0}'.format(self.chatbot.pk))
+
+    def test_publish_failure_logged(self):
+        bus = mock.Mock()
+        bus.publish.side_effect = redis.TimeoutError()
+        with mock.patch.object(plugins_models, '_publisher', bus), \
+                self.settings(REDIS_PLUGIN_QUEUE_URL='redis://localhost'):
+            with self.assertLogs('botbot.apps.plugins.models', 'WARNING'), \
+                    self.captureOnCommitCallbacks(execute=True):
+                self.chatbot.save()
+
+    def test_empty_plugin_set_is_cached(self):
+        self.active.delete()
+        channel = self.chatbot.channel_set.get()
+        self.assertEqual(channel.active_plugin_slugs, set())
+        with self.assertNumQueries(0):
+            self.assertEqual(channel.active_plugin_slugs, set())
+
+
+class ShedPolicyTestCase(TestCase):
+    def test_levels(self):
+        policy = shedding.ShedPolicy(depth_thresholds=(100, 1000),
+                                     lag_thresholds=(10,))
+        self.assertEqual(policy.update(50, 0), shedding.NORMAL)
+        self.assertEqual(policy.update(50, 12),
+                         shedding.SKIP_NON_ESSENTIAL)
+        self.assertEqual(policy.update(2000, 0), shedding.DEFER_FIREHOSE)
+        # stays until under half of the threshold
+        self.assertEqual(policy.update(600, 0), shedding.DEFER_FIREHOSE)
+        self.assertEqual(policy.update(400, 0),
+                         shedding.SKIP_NON_ESSENTIAL)
+        self.assertEqual(policy.update(0, 0), shedding.NORMAL)
+
+
+class ShedPlugin(BasePlugin):
+    essential = False
+
+    @listens_to_all(r'.*\b(?P<issue>[A-Z]+-\d+)')
+    def issue(self, line, issue):
+        pass
+
+
+class FirehosePlugin(BasePlugin):
+    def logit(self, line):
+        pass
+
+    logit.route_rule = ('firehose', r'(.*)')
+
+
+class LoadSheddingTestCase(TestCase):
+    def setUp(self):
+        self.runner = RecordingRunner(shed_depth=(10, 100))
+        self.runner.register(ShedPlugin())
+        self.runner.register(FirehosePlugin())
+        self.runner.command_prefix = '!'
+
+    def dispatch(self, depth):
+        self.runner.transport.length = depth
+        self.runner.tick()
+        self.runner.calls = []
+        self.runner.dispatch(RoutedLine('see MBS-1'))
+        return [name for name, _ in self.runner.calls]
+
+    def test_shed_and_recover(self):
+        self.assertEqual(sorted(self.dispatch(0)), ['issue', 'logit'])
+        self.assertEqual(self.dispatch(20), ['logit'])
+        self.assertEqual(self.dispatch(200), [])
+        self.assertEqual(len(self.runner.shed_firehose), 1)
+        # back under the first threshold: deferred calls are caught up on
+        self.runner.transport.length = 0
+        self.runner.tick()
+        self.assertEqual([name for name, _ in self.runner.calls], ['logit'])
+        self.assertEqual(sorted(self.dispatch(0)), ['issue', 'logit'])
+        self.assertEqual(self.runner.shed_counts['skipped', 'tests'], 2)
+        self.assertEqual(self.runner.shed_counts['deferred', 'tests'], 1)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.runner = runner.PluginRunner()
+        self.runner.bot_bus = fakeredis.FakeStrictRedis()
+
+    def test_render(self):
+        registry = metrics.Metrics()
+        counter = registry.add(metrics.Counter('calls_total', 'Calls',
+                                               ['plugin']))
+        histogram = registry.add(metrics.Histogram('seconds', 'Time',
+                                                   buckets=(0.1, 1)))
+        counter.inc('say "hi"')
+        counter.inc('say "hi"', amount=2)
+        histogram.observe(0.1)
+        histogram.observe(5)
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP calls_total Calls',
+            '# TYPE calls_total counter',
+            'calls_total{plugin="say \\"hi\\""} 3',
+            '# HELP seconds Time',
+            '# TYPE seconds histogram',
+            'seconds_bucket{le="0.1"} 1',
+            'seconds_bucket{le="1"} 1',
+            'seconds_bucket{le="+Inf"} 2',
+            'seconds_sum 5.1',
+            'seconds_count 2',
+        ])
+
+    def test_plugin_calls_and_errors(self):
+        def fails(line):
+            raise ValueError(line)
+
+        def works(line, word):
+            return word
+
+        with self.assertLogs('botbot.plugin_runner', level='ERROR'):
+            self.runner.call_plugin_method('tests', fails, 'line', {})
+        self.assertEqual(self.runner.call_plugin_method(
+            'tests', works, 'line', {'word': 'hi'}), 'hi')
+        values = self.runner.metrics.calls.values
+        self.assertEqual(values, {('tests', 'fails'): 1,
+                                  ('tests', 'works'): 1})
+        self.assertEqual(self.runner.metrics.errors.values,
+                         {('tests', 'fails'): 1})
+        self.assertEqual(
+            self.runner.metrics.call_seconds.values['tests',][0][-1], 0)
+
+    def test_served_over_http(self):
+        self.runner.bot_bus.rpush('q', 'one', 'two')
+        self.runner.fetch_packets()
+        server = metrics.serve(self.runner.metrics, 0, '127.0.0.1')
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+        body = urllib.request.urlopen(url).read().decode('utf-8')
+        self.assertIn('botbot_plugin_queue_depth 1\n', body)
+
+
+class LatencyTrackerTestCase(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.clock.now = 100.0
+        self.tracker = latency.LatencyTracker(slow_threshold=5,
+                                              clock=self.clock)
+
+    def finish(self, received, key=(1, '#test')):
+        timings = self.tracker.start(received)
+        timings.key = key
+        timings.add('queue', 100.0 - received)
+        timings.hold()
+        timings.hold()
+        timings.release()
+        timings.release()
+        return timings
+
+    def test_slow_line_logged_once(self):
+        with self.assertLogs('botbot.plugin_runner', level='WARNING') as logs:
+            timings = self.finish(90.0)
+            # a call deferred past the end of the line
+            timings.hold()
+            timings.release()
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('#test (chatbot 1): 10.000s, queue=10.000s',
+                      logs.output[0])
+        self.assertEqual(self.tracker.stages['queue'], 10)
+
+    def test_percentiles(self):
+        for n in range(100):
+            self.finish(100.0 - n / 100.0)
+        self.finish(99.0, key=(1, '#other'))
+        percentiles = self.tracker.percentiles()
+        for quantile, seconds in percentiles[1, '#test'].items():
+            self.assertAlmostEqual(seconds, quantile)
+        self.assertEqual(percentiles[1, '#other'][0.99], 1)
+
+
+class LineLatencyTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.chatbot = ChatBot.objects.create(
+            server='irc.example.net:6697', nick='BrainzBot', real_name='x')
+        channel = self.chatbot.channel_set.create(name='#test', slug='test')
+        ActivePlugin.objects.create(
+            channel=channel, plugin=Plugin.objects.create(slug='tests'))
+        self.runner = runner.PluginRunner(slow_line_threshold=3600)
+        self.runner.bot_bus = fakeredis.FakeStrictRedis()
+        self.runner.register(RoutedPlugin())
+
+    def packet(self):
+        return json.dumps({
+            'Content': 'brainzbot: ping', 'User': 'someone',
+            'ChatBotId': self.chatbot.pk, 'Raw': '', 'Channel': '#test',
+            'Command': 'PRIVMSG', 'Host': 'example.net',
+            'Received': '2014-01-27T16:35:53.123456789Z'})
+
+    def test_stages_recorded_per_channel(self):
+        self.runner.process_packets([self.packet()])
+        self.assertIn((self.chatbot.pk, '#test'),
+                      self.runner.latency.percentiles())
+        self.assertEqual(
+            sorted(self.runner.latency.stages),
+            ['decode', 'dispatch', 'flush', 'queue', 'resolve', 'tests.ping'])
+
+    def test_not_tracked_by_default(self):
+        app = runner.PluginRunner()
+        app.bot_bus = fakeredis.FakeStrictRedis()
+        app.register(RoutedPlugin())
+        with mock.patch.object(runner, 'convert_nano_timestamp',
+                               side_effect=AssertionError('parsed')):
+            app.process_packets([self.packet()])
+        self.assertEqual(app.metrics.calls.values[('tests', 'ping')], 1)
+        self.assertEqual(app.latency.percentiles(), {})
+
+
+class ProfilerTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.clock = FakeClock()
+        self.profiler = profiling.Profiler(self.directory.name, seconds=10,
+                                           clock=self.clock)
+
+    def test_cpu_profile(self):
+        self.profiler.request_cpu()
+        self.profiler.tick()
+        self.assertIsNotNone(self.profiler.cpu_profile)
+        self.clock.now += 10
+        with self.assertLogs('botbot.plugin_runner', level='INFO') as logs:
+            self.profiler.tick()
+        self.assertIsNone(self.profiler.cpu_profile)
+        path = logs.output[0].split(' to ')[-1]
+        self.assertTrue(path.endswith('.pstats'))
+        pstats.Stats(path)
+
+    def test_memory_snapshots(self):
+        self.profiler.request_memory()
+        self.profiler.tick()
+        self.assertTrue(tracemalloc.is_tracing())
+        self.profiler.request_memory()
+        with self.assertLogs('botbot.plugin_runner', level='INFO'):
+            self.profiler.tick()
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(
+            sorted(name.rsplit('.', 1)[-1]
+                   for name in os.listdir(self.directory.name)),
+            ['tracemalloc', 'txt'])
+
+    def test_signals(self):
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        self.profiler.install()
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.assertTrue(self.profiler.cpu_requested)
+        self.assertFalse(self.profiler.memory_requested)
+
+
+class ReplayTestCase(TestCase):
+    def test_needs_fakeredis(self):
+        with mock.patch('importlib.util.find_spec', return_value=None):
+            with self.assertRaisesRegex(CommandError, 'requirements-dev'):
+                call_command('replay_packets', synthetic=1)
+
+    def test_parse_monitor_line(self):
+        line = (b'1339518083.107412 [1 127.0.0.1:60866] "RPUSH" "q" '
+                b'"{\\"Content\\": \\"caf\\xc3\\xa9\\\\n\\"}"')
+        self.assertEqual(replay.parse_monitor_line(line),
+                         (1, [b'RPUSH', b'q',
+                              '{"Content": "caf\u00e9\\n"}'.encode('utf-8')]))
+        self.assertIsNone(replay.parse_monitor_line(b'OK'))
+
+    def test_recording(self):
+        clock = FakeClock()
+
+        def packets():
+            yield b'{"Content": "one"}'
+            clock.now = 0.5
+            yield None
+            yield b'not json'
+            yield b'{"Content": "two"}'
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'packets.jsonl.gz')
+            with self.assertLogs('botbot.plugin_runner', level='WARNING'):
+                self.assertEqual(replay.record(packets(), path, clock=clock),
+                                 2)
+            self.assertEqual(replay.read_recording(path),
+                             [(0, {'Content': 'one'}),
+                              (0.5, {'Content': 'two'})])
+
+    def test_synthetic_mix(self):
+        packets = replay.synthetic_packets(
+            100, rate=50, channels=2,
+            mix=replay.parse_mix('mention=1,join=1'))
+        self.assertEqual(packets[-1][0], 99 / 50)
+        self.assertEqual(set(packet['Channel'] for _, packet in packets),
+                         {'#load-0', '#load-1'})
+        self.assertEqual(set(packet['Content'] for _, packet in packets),
+                         {'BrainzBot: ping', ''})
+        with self.assertRaises(ValueError):
+            replay.parse_mix('message=1,shout=2')
+
+    def test_replay(self):
+        packets = replay.synthetic_packets(
+            20, mix=replay.parse_mix('message=1,mention=1'))
+        replay.prepare_channels(packets, plugins=['ping'])
+        app = replay.ReplayRunner(batch_size=5)
+        app.register_all_plugins()
+        app.load_registry()
+        with self.assertLogs('botbot.plugin_runner', level='INFO'):
+            seconds = replay.replay(app, packets, speed=0)
+        mentions = sum(1 for _, packet in packets
+                       if packet['Content'] == 'BrainzBot: ping')
+        self.assertEqual(len(app.router_latencies['mentions']), mentions)
+        self.assertEqual(app.bot_bus.llen('bot'), mentions)
+        self.assertTrue(replay.report(app, len(packets), seconds)[0]
+                        .startswith('20 lines in '))
+
+
+class WireFormatTestCase(TestCase):
+    packet = {
+        'ChatBotId': 3, 'Raw': ':someone!x@example.net PRIVMSG #test :hi',
+        'User': 'someone', 'Host': 'x@example.net', 'Channel': '#test',
+        'Command': 'PRIVMSG', 'Content': 'hi',
+        'Received': '2014-01-27T16:35:53.123456789Z',
+    }
+
+    def test_json(self):
+        encoded = wire.encode_packet(self.packet).encode('utf-8')
+        self.assertEqual(wire.decode_packet(encoded), self.packet)
+
+    def test_binary(self):
+        encoded = wire.encode_packet(self.packet, binary=True)
+        self.assertLess(len(encoded),
+                        len(wire.encode_packet(self.packet)))
+        # Down to the microsecond, like the time strings
+        self.assertEqual(wire.decode_packet(encoded),
+                         dict(self.packet, Received=1390840553123456000))
+        self.assertEqual(utils.convert_nano_timestamp(1390840553123456000),
+                         utils.convert_nano_timestamp(self.packet['Received']))
+
+    def test_binary_not_ascii(self):
+        packet = dict(self.packet, User='sömeone', Content='¡hola! ☃',
+                      Received=1390840553123456789)
+        self.assertEqual(
+            wire.decode_packet(wire.encode_packet(packet, binary=True)),
+            packet)
+
+    def test_runner_reads_both(self):
+        chatbot = ChatBot.objects.create(
+            server='irc.example.net:6697', nick='BrainzBot', real_name='x')
+        channel = chatbot.channel_set.create(name='#test', slug='test')
+        ActivePlugin.objects.create(
+            channel=channel, plugin=Plugin.objects.create(slug='tests'))
+        app = runner.PluginRunner()
+        app.bot_bus = fakeredis.FakeStrictRedis()
+        app.register(RoutedPlugin())
+        packet = dict(self.packet, ChatBotId=chatbot.pk,
+                      Content='brainzbot: ping')
+        with self.assertLogs('botbot.plugin_runner', level='INFO'):
+            app.process_packets([wire.encode_packet(packet).encode('utf-8'),
+                                 wire.encode_packet(packet, binary=True)])
+        self.assertEqual(app.metrics.lines_dropped.values, {})
+        self.assertEqual(app.metrics.calls.values, {('tests', 'ping'): 2})
+
+
+class CPUBoundPlugin(BasePlugin):
+    @cpu_bound
+    @listens_to_mentions(r'^pid$')
+    def pid(self, line):
+        return '{0} {1}'.format(line.user, os.getpid())
+
+
+class OffloadTestCase(TestCase):
+    def test_line_copy(self):
+        line = runner.Line({
+            'Content': 'brainzbot: pid', 'User': 'someone', 'ChatBotId': 1,
+            'Raw': '', 'Channel': '#test', 'Command': 'PRIVMSG',
+            'Host': 'example.net',
+            'Received': '2014-01-27T16:35:53.123456789Z'}, None)
+        line._chatbot_cache = ChatBot(nick='BrainzBot')
+        copy = pickle.loads(pickle.dumps(offload.LineCopy(line)))
+        self.assertEqual((copy.text, copy.is_direct_message, copy.user),
+                         ('pid', True, 'someone'))
+        self.assertEqual(copy._received, line._received)
+
+    def test_cpu_bound_call_in_pool(self):
+        chatbot = ChatBot.objects.create(
+            server='irc.example.net:6697', nick='BrainzBot', real_name='x')
+        channel = chatbot.channel_set.create(name='#test', slug='test')
+        ActivePlugin.objects.create(
+            channel=channel, plugin=Plugin.objects.create(slug='tests'))
+        app = runner.PluginRunner(cpu_workers=1)
+        self.addCleanup(app.cpu_pool.shutdown)
+        app.bot_bus = fakeredis.FakeStrictRedis()
+        app.register(CPUBoundPlugin())
+        with self.assertLogs('botbot.plugin_runner', level='INFO'):
+            app.process_packets([json.dumps({
+                'Content': 'brainzbot: pid', 'User': 'someone',
+                'ChatBotId': chatbot.pk, 'Raw': '', 'Channel': '#test',
+                'Command': 'PRIVMSG', 'Host': 'example.net',
+                'Received': '2014-01-27T16:35:53.123456789Z'})])
+        _, _, target, user, pid = app.bot_bus.rpop('bot').decode(
+            'utf-8').split(' ')
+        self.assertEqual((target, user), ('#test', 'someone'))
+        self.assertNotEqual(int(pid), os.getpid())
+
+
+class CooperativeTestCase(TestCase):
+    def test_measure(self):
+        # The tests don't run monkey-patched
+        self.assertFalse(cooperative.is_patched())
+        total, wall = cooperative.measure(gevent.sleep, 4, 0.02)
+        self.assertGreaterEqual(total, 0.08)
+        self.assertLess(wall, total / 2)
+        total, wall = cooperative.measure(cooperative.sleep_probe, 2, 0.02)
+        self.assertGreaterEqual(wall, total * 0.9)
+
+
+class FakeConnection(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTestCase(TestCase):
+    def test_size_and_timeout(self):
+        pool = pooled_postgresql.ConnectionPool(2, timeout=0.01)
+        first = pool.get(FakeConnection)
+        second = pool.get(FakeConnection)
+        self.assertIsNot(first, second)
+        with self.assertRaises(psycopg2.OperationalError):
+            pool.get(FakeConnection)
+        self.assertEqual((pool.in_use, pool.waits, pool.timeouts), (2, 1, 1))
+        pool.put(first)
+        self.assertIs(pool.get(FakeConnection), first)
+        pool.discard(second)
+        self.assertTrue(second.closed)
+        self.assertIsNot(pool.get(FakeConnection), second)
+        self.assertEqual(pool.checkouts, 5)
+
+    def test_failed_connect_frees_its_slot(self):
+        pool = pooled_postgresql.ConnectionPool(1, timeout=0.01)
+
+        def connect():
+            raise psycopg2.OperationalError('refused')
+        with self.assertRaises(psycopg2.OperationalError):
+            pool.get(connect)
+        self.assertEqual(pool.in_use, 0)
+        pool.get(FakeConnection)
+
+    def test_wrapper_reuses_connections(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('Needs PostgreSQL')
+        self.addCleanup(pooled_postgresql.close_pools)
+        wrapper = pooled_postgresql.DatabaseWrapper(dict(
+            connection.settings_dict,
+            ENGINE='botbot.apps.plugins.pooled_postgresql',
+            POOL_SIZE=1, POOL_TIMEOUT=0.1), 'pooled')
+        pids = []
+        for _ in range(2):
+            with wrapper.cursor() as cursor:
+                # Left open, the pool rolls it back
+                wrapper.set_autocommit(False)
+                cursor.execute('SELECT pg_backend_pid()')
+                pids.append(cursor.fetchone()[0])
+            wrapper.close()
+        self.assertEqual(pids[0], pids[1])
+        pool = wrapper.connection_pool
+        self.assertEqual((pool.opened, pool.checkouts), (1, 2))
+
+
+class LogBufferTestCase(TestCase):
+    def setUp(self):
+        chatbot = ChatBot.objects.create(
+            server='irc.example.net:6697', nick='BrainzBot', real_name='x')
+        self.channel = chatbot.channel_set.create(name='#test', slug='test')
+        self.now = 0
+
+    def log(self, n, nick='someone'):
+        return Log(channel=self.channel, timestamp=timezone.now(), nick=nick,
+                   text='line {0}'.format(n), command='PRIVMSG')
+
+    def texts(self):
+        return list(Log.objects.order_by('pk').values_list('text', flat=True))
+
+    def test_size_and_delay(self):
+        buffer = logbuffer.LogBuffer(max_rows=3, max_delay=0.2,
+                                     clock=lambda: self.now)
+        for n in range(4):
+            buffer.add(self.log(n))
+        self.assertEqual(Log.objects.count(), 3)
+        buffer.tick()
+        self.assertEqual(len(buffer), 1)
+        self.now = 0.2
+        buffer.tick()
+        self.assertEqual(self.texts(), ['line 0', 'line 1', 'line 2',
+                                        'line 3'])
+        self.assertEqual(buffer.flushed, 4)
+
+    @override_settings(EXCLUDE_NICKS=['redact'])
+    def test_redacted(self):
+        buffer = logbuffer.LogBuffer()
+        buffer.add(self.log(0, nick='redact'))
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(self.texts(), [REDACTED_TEXT])
+
+    def test_bad_row_dropped(self):
+        buffer = logbuffer.LogBuffer()
+        for n in range(3):
+            buffer.add(self.log(n, nick='x' * 300 if n == 1 else 'someone'))
+        with self.assertLogs('botbot.plugin_runner', level='ERROR'):
+            self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(self.texts(), ['line 0', 'line 2'])
+        self.assertEqual(buffer.dropped, 1)
+
+    def test_lines_delivered_again(self):
+        timestamp = timezone.now()
+        buffer = logbuffer.LogBuffer()
+        for _ in range(2):
+            for n in range(3):
+                log = self.log(n)
+                log.timestamp = timestamp
+                log.raw = ':someone!x@example.net PRIVMSG #test :{0}'.format(
+                    log.text)
+                buffer.add(log)
+            buffer.flush()
+        self.assertEqual(self.texts(), ['line 0', 'line 1', 'line 2'])
+        self.assertEqual(len(set(Log.objects.values_list('ingestion_key',
+                                                         flat=True))), 3)
+
+    def test_empty_raw_keyed_by_text(self):
+        timestamp = timezone.now()
+        buffer = logbuffer.LogBuffer()
+        for n in range(2):
+            log = self.log(n)
+            log.timestamp = timestamp
+            log.raw = ''
+            buffer.add(log)
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(self.texts(), ['line 0', 'line 1'])
+
+    def test_put_back(self):
+        buffer = logbuffer.LogBuffer(max_rows=3, max_pending=4)
+        buffer.add(self.log(4))
+        with self.assertLogs('botbot.plugin_runner', level='ERROR'):
+            buffer.put_back([self.log(n) for n in range(4)])
+        self.assertEqual([row.text for row in buffer.rows],
+                         ['line 1', 'line 2', 'line 3', 'line 4'])
+        self.assertEqual(buffer.dropped, 1)
+
+    def test_written_when_runner_stops(self):
+        app = runner.PluginRunner(log_batch_size=10)
+        app.bot_bus = fakeredis.FakeStrictRedis()
+        app.log_buffer.add(self.log(0))
+        app.stop()
+        with self.assertLogs('botbot.plugin_runner', level='INFO'):
+            app.listen()
+        self.assertEqual(self.texts(), ['line 0'])
+
+
+class IgnorePrefixesTestCase(TestCase):
+    def test_alternation(self):
+        patterns = logger.compile_prefixes(('!-', '', r'\[off\]', r'(a)\1'))
+        self.assertEqual([pattern.pattern for pattern in patterns],
+                         [r'(?:!-)|(?:\[off\])', r'(a)\1'])
+        should_ignore = logger.matcher(['!-', r'\[off\]', r'(a)\1'])
+        self.assertTrue(should_ignore('!- not logged'))
+        self.assertTrue(should_ignore('[OFF] not logged'))
+        self.assertTrue(should_ignore('AA'))
+        self.assertFalse(should_ignore('ab [off]'))
+
+    def test_same_as_separate_prefixes(self):
+        for prefixes in ('!-', None, ['(?i)x', 'y'], ['a|b', 'c$']):
+            for text in ('!- x', 'X', 'y', 'b', 'c', 'cd', ''):
+                self.assertEqual(
+                    logger.should_ignore_text(text, prefixes),
+                    logger._match_each(logger.normalize_prefixes(prefixes),
+                                       text), (prefixes, text))
+
+    def test_invalid_prefix(self):
+        self.assertIsNone(logger.compile_prefixes(('!-', '(')))
+        should_ignore = logger.matcher(['!-', '('])
+        self.assertTrue(should_ignore('!- x'))
+        with self.assertRaises(re.error):
+            should_ignore('x')
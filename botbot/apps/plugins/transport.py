@@ -0,0 +1,305 @@
+"""
+Ways for lines to get from the bot to the plugin runner.
+
+A transport reads batches of raw packets off Redis. The runner takes the
+ids of each batch with ``take_batch()`` and acknowledges them once it is
+done with the batch. Reads are available with a regular and with a
+``redis.asyncio`` client.
+"""
+import logging
+import os
+import socket
+import time
+
+import redis
+
+LOG = logging.getLogger('botbot.plugin_runner')
+
+
+def _entry_id(value):
+    """Sort key of a stream entry id"""
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    milliseconds, _, sequence = value.partition('-')
+    return int(milliseconds), int(sequence or 0)
+
+
+def _next_entry_id(value):
+    """The smallest entry id after ``value``"""
+    milliseconds, sequence = _entry_id(value)
+    return '{0}-{1}'.format(milliseconds, sequence + 1)
+
+
+class ListTransport(object):
+    """
+    Lines pushed onto a Redis list by the bot, the default. A line is
+    gone from Redis as soon as it is read, so there is nothing to
+    acknowledge.
+    """
+
+    def __init__(self, key='q', batch_size=1):
+        self.key = key
+        # Maximum number of packets taken off the queue per round trip
+        self.batch_size = max(1, batch_size)
+        # Queue length as of the last read
+        self.length = 0
+
+    def fetch(self, bus):
+        """
+        Waits (up to a second) for a packet on the queue, then takes up to
+        ``batch_size - 1`` more and the remaining queue length in a single
+        round trip. Returns the raw packets in arrival order.
+        """
+        val = bus.blpop(self.key, 1)
+        if not val:
+            self.length = 0
+            return []
+        pipe = bus.pipeline()
+        self._queue_rest(pipe)
+        return self._collect(val[1], pipe.execute())
+
+    async def async_fetch(self, bus):
+        val = await bus.blpop(self.key, 1)
+        if not val:
+            self.length = 0
+            return []
+        async with bus.pipeline() as pipe:
+            self._queue_rest(pipe)
+            results = await pipe.execute()
+        return self._collect(val[1], results)
+
+    # Lines are off the list once read, nothing is held
+    max_hold = None
+
+    def take_batch(self):
+        return []
+
+    def ack(self, bus, ids=None):
+        pass
+
+    def trim(self, bus):
+        pass
+
+    def _queue_rest(self, pipe):
+        if self.batch_size > 1:
+            pipe.lpop(self.key, self.batch_size - 1)
+        pipe.llen(self.key)
+
+    def _collect(self, val, results):
+        """
+        Combines the packet from the blocking pop with the results of the
+        follow-up pipeline (optional LPOP, then LLEN)
+        """
+        self.length = results[-1]
+        packets = [val]
+        if self.batch_size > 1 and results[0]:
+            packets.extend(results[0])
+        LOG.debug('Received %s packets, %s left in queue',
+                  len(packets), self.length)
+        return packets
+
+
+class StreamTransport(object):
+    """
+    Lines added to a Redis stream (``XADD <key> * packet <json>``) and read
+    through a consumer group, so several runners can share the load.
+
+    Entries are acknowledged once the runner is done with them, or once
+    it has held them for ``max_hold`` seconds, half of ``claim_idle``.
+    Entries another consumer left pending for longer than ``claim_idle``
+    seconds, e.g. because it crashed, are claimed and dispatched again, as
+    are those left pending under this consumer name by an earlier run.
+    Every
+    ``trim_interval`` seconds, the entries that every consumer group has
+    acknowledged are deleted from the stream.
+    """
+    field = b'packet'
+
+    def __init__(self, key='q:stream', batch_size=1, group='plugins',
+                 consumer=None, claim_idle=60, trim_interval=10):
+        self.key = key
+        self.batch_size = max(1, batch_size)
+        self.group = group
+        self.consumer = consumer or '{0}-{1}'.format(socket.gethostname(),
+                                                     os.getpid())
+        self.claim_idle = claim_idle
+        # Entries held longer would be claimed by the other consumers
+        self.max_hold = claim_idle / 2
+        # Where the next scan for entries to claim starts
+        self.claim_cursor = '-'
+        self.last_claim = 0
+        self.trim_interval = trim_interval
+        self.last_trim = time.monotonic()
+        # Ids of the entries of the last batch, until taken by the runner
+        self.pending = []
+        # Entries not delivered to the group yet (or pending, on Redis < 7)
+        self.length = 0
+        self.group_created = False
+        # Reading the entries an earlier run left pending, from this id on
+        self.recover_cursor = '0'
+
+    def fetch(self, bus):
+        """
+        Returns entries claimed from dead consumers if it's time to look
+        for them, otherwise blocks (up to a second) for new entries
+        """
+        if not self.group_created:
+            self._create_group(bus)
+        if self.recover_cursor is not None:
+            packets = self._collect_recovered(bus.xreadgroup(
+                self.group, self.consumer, {self.key: self.recover_cursor},
+                count=self.batch_size))
+            if self.pending:
+                return packets
+        if self._claim_due():
+            ids = self._claimable(bus.xpending_range(
+                self.key, self.group, self.claim_cursor, '+',
+                self.batch_size, idle=self._claim_idle_ms or None))
+            if ids:
+                packets = self._collect_claimed(bus.xclaim(
+                    self.key, self.group, self.consumer,
+                    self._claim_idle_ms, ids))
+                if self.pending:
+                    return packets
+        result = bus.xreadgroup(self.group, self.consumer, {self.key: '>'},
+                                count=self.batch_size, block=1000)
+        return self._collect(result)
+
+    async def async_fetch(self, bus):
+        if not self.group_created:
+            self.group_created = True
+            try:
+                await bus.xgroup_create(self.key, self.group, id='0',
+                                        mkstream=True)
+            except redis.ResponseError as exc:
+                self._check_busy_group(exc)
+        if self.recover_cursor is not None:
+            packets = self._collect_recovered(await bus.xreadgroup(
+                self.group, self.consumer, {self.key: self.recover_cursor},
+                count=self.batch_size))
+            if self.pending:
+                return packets
+        if self._claim_due():
+            ids = self._claimable(await bus.xpending_range(
+                self.key, self.group, self.claim_cursor, '+',
+                self.batch_size, idle=self._claim_idle_ms or None))
+            if ids:
+                packets = self._collect_claimed(await bus.xclaim(
+                    self.key, self.group, self.consumer,
+                    self._claim_idle_ms, ids))
+                if self.pending:
+                    return packets
+        result = await bus.xreadgroup(self.group, self.consumer,
+                                      {self.key: '>'},
+                                      count=self.batch_size, block=1000)
+        return self._collect(result)
+
+    def take_batch(self):
+        """Returns the ids of the entries of the last batch"""
+        ids, self.pending = self.pending, []
+        return ids
+
+    def ack(self, bus, ids=None):
+        """Acknowledges entries, by default those of the last batch"""
+        if ids is None:
+            ids = self.take_batch()
+        if ids:
+            pipe = bus.pipeline()
+            pipe.xack(self.key, self.group, *ids)
+            pipe.xinfo_groups(self.key)
+            self._collect_ack(pipe.execute())
+
+    def trim(self, bus):
+        """
+        Deletes the entries older than the oldest one a consumer group
+        still needs, if it's time to
+        """
+        now = time.monotonic()
+        if now - self.last_trim < self.trim_interval:
+            return 0
+        self.last_trim = now
+        oldest = []
+        for info in bus.xinfo_groups(self.key):
+            if info['pending']:
+                oldest.append(_entry_id(
+                    bus.xpending(self.key, info['name'])['min']))
+            else:
+                # Past the last entry delivered to the group
+                oldest.append(_entry_id(
+                    _next_entry_id(info['last-delivered-id'])))
+        if not oldest:
+            return 0
+        return bus.xtrim(self.key, minid='{0}-{1}'.format(*min(oldest)),
+                         approximate=False)
+
+    def _create_group(self, bus):
+        """Creates the consumer group (and stream) unless they exist"""
+        self.group_created = True
+        try:
+            bus.xgroup_create(self.key, self.group, id='0', mkstream=True)
+        except redis.ResponseError as exc:
+            self._check_busy_group(exc)
+
+    def _check_busy_group(self, exc):
+        # The group already exists
+        if 'BUSYGROUP' not in str(exc):
+            raise exc
+
+    @property
+    def _claim_idle_ms(self):
+        return int(self.claim_idle * 1000)
+
+    def _claim_due(self):
+        now = time.monotonic()
+        if now - self.last_claim < self.claim_idle:
+            return False
+        self.last_claim = now
+        return True
+
+    def _claimable(self, pending):
+        """
+        Ids of the idle entries of a page of XPENDING owned by other
+        consumers. This runner's own entries are still being worked on.
+        """
+        if len(pending) < self.batch_size:
+            self.claim_cursor = '-'
+        else:
+            # Keep scanning until the end of the pending entries
+            self.claim_cursor = _next_entry_id(pending[-1]['message_id'])
+            self.last_claim = 0
+        consumer = self.consumer.encode('utf-8')
+        return [entry['message_id'] for entry in pending
+                if entry['consumer'] not in (consumer, self.consumer)]
+
+    def _collect_recovered(self, result):
+        packets = self._collect(result)
+        if self.pending:
+            LOG.warning('Recovered %s stream entries left pending by an '
+                        'earlier run', len(self.pending))
+            self.recover_cursor = self.pending[-1]
+        else:
+            self.recover_cursor = None
+        return packets
+
+    def _collect_claimed(self, entries):
+        if entries:
+            LOG.warning('Claimed %s stream entries from other consumers',
+                        len(entries))
+        return self._packets(entries)
+
+    def _collect(self, result):
+        if not result:
+            return []
+        # [[key, [(id, fields), ...]]]
+        return self._packets(result[0][1])
+
+    def _packets(self, entries):
+        self.pending = [entry_id for entry_id, _ in entries]
+        # Entries deleted from the stream come back without fields
+        return [fields[self.field] for _, fields in entries if fields]
+
+    def _collect_ack(self, results):
+        for info in results[-1]:
+            if info['name'] in (self.group, self.group.encode('utf-8')):
+                lag = info.get('lag')
+                self.length = info['pending'] if lag is None else lag
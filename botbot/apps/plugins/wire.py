@@ -0,0 +1,116 @@
+"""
+Encodings of the packets the bot queues for the plugin runner.
+
+Packets are JSON objects by default. The binary encoding drops the field
+names and the escaping: a marker byte, the chatbot id (unsigned 32 bits),
+the time the bot received the line (signed 64 bits, nanoseconds since the
+epoch) and the byte lengths (unsigned 16 bits) of the UTF-8 ``FIELDS``,
+all big-endian, followed by the fields themselves.
+
+The encoding is detected per packet, so the runners keep reading JSON
+packets while a bot switches to the binary encoding. A bot should only
+switch once none of its runners is older than this module.
+
+``python -m botbot.apps.plugins.wire [lines]`` compares their decoding
+cost.
+"""
+import json
+import struct
+import sys
+import timeit
+
+from botbot.apps.plugins.utils import convert_nano_timestamp, EPOCH
+
+# Can't start a JSON text
+BINARY_MARKER = b'\xb1'
+FIELDS = ('Raw', 'User', 'Host', 'Channel', 'Command', 'Content')
+HEADER = struct.Struct('>cIq{0}H'.format(len(FIELDS)))
+
+
+def decode_packet(val):
+    """Returns the packet dict of a JSON or binary encoded packet"""
+    if val[:1] != BINARY_MARKER:
+        return json.loads(val)
+    (_, chatbot_id, received,
+     raw, user, host, channel, command, content) = HEADER.unpack_from(val)
+    body = str(val[HEADER.size:], 'utf-8', 'replace')
+    if len(body) != len(val) - HEADER.size:
+        # Not ASCII, the byte lengths aren't character offsets
+        return _decode_fields(val, chatbot_id, received,
+                              (raw, user, host, channel, command))
+    user += raw
+    host += user
+    channel += host
+    command += channel
+    return {
+        'ChatBotId': chatbot_id,
+        'Received': received,
+        'Raw': body[:raw],
+        'User': body[raw:user],
+        'Host': body[user:host],
+        'Channel': body[host:channel],
+        'Command': body[channel:command],
+        'Content': body[command:],
+    }
+
+
+def _decode_fields(val, chatbot_id, received, lengths):
+    packet = {'ChatBotId': chatbot_id, 'Received': received}
+    start = HEADER.size
+    for field, length in zip(FIELDS, lengths):
+        end = start + length
+        packet[field] = str(val[start:end], 'utf-8', 'replace')
+        start = end
+    packet[FIELDS[-1]] = str(val[start:], 'utf-8', 'replace')
+    return packet
+
+
+def encode_packet(packet, binary=False):
+    """
+    Encodes a packet, ``Received`` is either the bot's time string or
+    nanoseconds since the epoch
+    """
+    if not binary:
+        return json.dumps(packet)
+    received = packet['Received']
+    if not isinstance(received, int):
+        delta = convert_nano_timestamp(received) - EPOCH
+        received = ((delta.days * 86400 + delta.seconds) * 10 ** 6 +
+                    delta.microseconds) * 1000
+    values = [packet[field].encode('utf-8') for field in FIELDS]
+    return HEADER.pack(BINARY_MARKER, packet['ChatBotId'], received,
+                       *[len(value) for value in values]) + b''.join(values)
+
+
+def benchmark(lines=100000):
+    """
+    Returns (bytes, microseconds to decode) per line, per encoding,
+    including the conversion of the time the bot received the line
+    """
+    text = 'a typical line of chat, long enough to be realistic'
+    packet = {
+        'ChatBotId': 1,
+        'Raw': ':nick!~user@example.com PRIVMSG #channel :' + text,
+        'Received': '2014-01-27T16:35:53.123456789Z',
+        'User': 'nick',
+        'Host': '~user@example.com',
+        'Channel': '#channel',
+        'Command': 'PRIVMSG',
+        'Content': text,
+    }
+    results = {}
+    for name, binary in (('json', False), ('binary', True)):
+        encoded = encode_packet(packet, binary)
+        if not binary:
+            # As read off Redis
+            encoded = encoded.encode('utf-8')
+        seconds = timeit.timeit(
+            lambda: convert_nano_timestamp(decode_packet(encoded)['Received']),
+            number=lines)
+        results[name] = (len(encoded), seconds / lines * 10 ** 6)
+    return results
+
+
+if __name__ == '__main__':
+    for name, (size, micros) in benchmark(*map(int, sys.argv[1:2])).items():
+        print('{0}: {1} bytes, {2:.2f}us per line'.format(name, size, micros))
@@ -21,6 +21,13 @@ class BasePlugin(object):
     "All plugins inherit this class"
     app = None
     config_class = None
+    # Limits for concurrent runners, None uses the runner's defaults:
+    # seconds a call may take and number of calls in progress at once
+    call_timeout = None
+    max_concurrency = None
+    # Non-essential plugins are the first skipped while the runner is
+    # shedding load
+    essential = True
 
     def __init__(self, *args, **kwargs):
         self.slug = self.__module__.split('.')[-1]
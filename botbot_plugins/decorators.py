@@ -1,24 +1,36 @@
-def listens_to_mentions(regex):
+def listens_to_mentions(regex, literals=None):
     """
     Decorator to add function and rule to routing table
 
     Returns Line that triggered the function.
+
+    `literals` optionally lists strings a line has to contain (ignoring
+    case) for the regex to match. Lines lacking one are skipped without
+    running the regex. By default they are worked out from the regex.
     """
 
     def decorator(func):
         func.route_rule = ('mentions', regex)
+        if literals is not None:
+            func.route_literals = literals
         return func
     return decorator
 
-def listens_to_all(regex):
+def listens_to_all(regex, literals=None):
     """
     Decorator to add function and rule to routing table
 
     Returns Line that triggered the function.
+
+    `literals` optionally lists strings a line has to contain (ignoring
+    case) for the regex to match. Lines lacking one are skipped without
+    running the regex. By default they are worked out from the regex.
     """
 
     def decorator(func):
         func.route_rule = ('messages', regex)
+        if literals is not None:
+            func.route_literals = literals
         return func
     return decorator
 
@@ -38,16 +50,32 @@ def listens_to_command(cmd):
         return func
     return decorator
 
-def listens_to_regex_command(cmd, regex):
+def listens_to_regex_command(cmd, regex, literals=None):
     """
     Decorator to listen for command with arguments checked by regex
 
     Returns Line that triggered the function.
 
     The best of both worlds
+
+    `literals` works as for `listens_to_all`, against the arguments.
     """
 
     def decorator(func):
         func.route_rule = ('regex_commands', (cmd, regex))
+        if literals is not None:
+            func.route_literals = literals
         return func
     return decorator
+
+def cpu_bound(func):
+    """
+    Decorator marking a method as CPU bound (e.g. scanning a large text).
+    Runners started with a process pool (``--cpu-workers``) call it in
+    another process, so that it doesn't stall the other plugin calls.
+
+    The method gets a copy of the line and of the plugin's configuration,
+    and can't use the plugin's storage.
+    """
+    func.cpu_bound = True
+    return func
@@ -19,6 +19,7 @@ class Plugin(BasePlugin):
 
     http://motivate.im/
     """
+    essential = False
 
     @listens_to_command("m")
     def motivate(self, line, args):
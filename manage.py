@@ -2,11 +2,13 @@
 import sys
 
 if __name__ == "__main__":
-    if (len(sys.argv) > 1 and
-            'run_plugins' in sys.argv and '--with-gevent' in sys.argv):
-        # import gevent as soon as possible
-        from gevent import monkey; monkey.patch_all()
-        from psycogreen.gevent import patch_psycopg; patch_psycopg()
+    if len(sys.argv) > 1 and (
+            'check_gevent' in sys.argv or
+            ('run_plugins' in sys.argv or 'replay_packets' in sys.argv) and
+            '--with-gevent' in sys.argv):
+        # patch before anything imports socket or threading
+        from botbot.apps.plugins import cooperative
+        cooperative.patch()
 
     import os
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "botbot.settings")